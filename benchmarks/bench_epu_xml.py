@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+import argparse
+import os
+from pathlib import Path
+
+import numpy as np
+
+import bench_helper
+from util.epu_xml import dom_beam_shift, read_beam_shifts, scan_beam_shift
+
+PROG = Path(__file__).name
+VER = 20261017
+
+XML = '''<?xml version="1.0" encoding="utf-8"?>
+<MicroscopeImage xmlns="http://schemas.datacontract.org/2004/07/Fei.SharedObjects" xmlns:i="http://www.w3.org/2001/XMLSchema-instance">
+<camera><Binning xmlns:a="http://schemas.datacontract.org/2004/07/System.Drawing"><a:x>1</a:x><a:y>1</a:y></Binning>
+<ExposureTime>%(exposure)s</ExposureTime><PixelSize>%(pixels)s</PixelSize></camera>
+<microscopeData><acquisition><acceleratingVoltage>300000</acceleratingVoltage></acquisition>
+<optics><BeamShift xmlns:a="http://schemas.datacontract.org/2004/07/Fei.Types"><a:_x>%(x).12f</a:_x><a:_y>%(y).12f</a:_y></BeamShift>
+<BeamTilt xmlns:a="http://schemas.datacontract.org/2004/07/Fei.Types"><a:_x>0.01</a:_x><a:_y>-0.02</a:_y></BeamTilt></optics>
+</microscopeData>
+<CustomData xmlns:a="http://schemas.microsoft.com/2003/10/Serialization/Arrays">%(custom)s</CustomData>
+</MicroscopeImage>
+'''
+
+
+def make_xml_files(folder, n_files, seed=0):
+    "Writes n_files synthetic EPU .xml files (about 20 KB, BeamShift in the first KB); skipped if already present"
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    shifts = rng.normal(0, 0.1, (n_files, 2))
+    custom = "".join("<a:KeyValueOfstringanyType><a:Key>Item%d</a:Key><a:Value>%f</a:Value></a:KeyValueOfstringanyType>"
+                     % (i, i / 7) for i in range(250))
+    files = [os.path.join(folder, "FoilHole_%08d_Data.xml" % i) for i in range(n_files)]
+    for filename, (x, y) in zip(files, shifts):
+        if not os.path.exists(filename):
+            with open(filename, "w") as xml:
+                xml.write(XML % {"exposure": 2.5, "pixels": 0.83, "x": x, "y": y, "custom": custom})
+    return files
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+Throughput of reading the beam shifts of synthetic EPU .xml files (optics_split.py, util/epu_xml.py):
+minidom of every file (the former reader) against the scan up to </BeamShift>, with 1 and --threads threads.
+Use --dir on the network storage of the microscope for realistic latencies
+
+Example: {PROG} --files 20000 --dir /mnt/epu/bench_xml --threads 16 32
+[version {VER}]'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--files', type=int, default=5000, help="Number of .xml files")
+    add('--dir', default="./bench_xml", help="Folder for the synthetic .xml files")
+    add('--threads', type=int, nargs='+', default=[16], help="Numbers of threads to test")
+    args = parser.parse_args()
+
+    files = make_xml_files(args.dir, args.files)
+    print("\n %-10s %-10s %10s %12s" % ("reader", "threads", "time, s", "files/s"))
+    reference = None
+    for name, reader, threads in [("minidom", dom_beam_shift, 1), ("scan", scan_beam_shift, 1)] + \
+            [("scan", scan_beam_shift, n) for n in args.threads]:
+        seconds, shifts = bench_helper.timed(read_beam_shifts, files, threads, reader, False)
+        print(" %-10s %-10d %10.2f %12.0f" % (name, threads, seconds, len(files) / seconds))
+        if reference is None:
+            reference = shifts
+        elif not np.array_equal(reference, shifts):
+            print(" => WARNING: the beam shifts differ from the minidom ones")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Shared helpers for the benchmark scripts: synthetic Relion 3.1+ star files and a simple timer
+'''
+
+import multiprocessing
+import os
+import sys
+import time
+import random
+from pathlib import Path
+
+# makes "util" importable when the benchmarks are run from any folder
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+OPTICS_BLOCK = '''
+# version 30001
+
+data_optics
+
+loop_ 
+_rlnOpticsGroupName #1 
+_rlnOpticsGroup #2 
+_rlnMicrographOriginalPixelSize #3 
+_rlnVoltage #4 
+_rlnSphericalAberration #5 
+_rlnAmplitudeContrast #6 
+_rlnImagePixelSize #7 
+_rlnImageSize #8 
+_rlnImageDimensionality #9 
+'''
+
+PARTICLE_LABELS = ["_rlnCoordinateX", "_rlnCoordinateY", "_rlnAutopickFigureOfMerit", "_rlnClassNumber",
+                   "_rlnAnglePsi", "_rlnImageName", "_rlnMicrographName", "_rlnOpticsGroup",
+                   "_rlnCtfMaxResolution", "_rlnCtfFigureOfMerit", "_rlnDefocusU", "_rlnDefocusV",
+                   "_rlnDefocusAngle", "_rlnCtfBfactor", "_rlnCtfScalefactor", "_rlnPhaseShift",
+                   "_rlnOriginXAngst", "_rlnOriginYAngst"]
+
+
+def particle_row(r, i, n_micrographs=500, n_groups=1):
+    "One data row of a synthetic particles.star file"
+    mic = i % n_micrographs
+    return ("%.6f %.6f %.6f %d %.6f %06d@Extract/job007/Movies/FoilHole_%08d_fractions.mrcs "
+            "MotionCorr/job002/Movies/FoilHole_%08d_fractions.mrc %d %.6f %.6f %.6f %.6f %.6f "
+            "0.000000 1.000000 0.000000 %.6f %.6f \n") % (
+        r.uniform(0, 4000), r.uniform(0, 4000), r.uniform(-2, 5), r.randint(1, 10), r.uniform(-180, 180),
+        i // n_micrographs + 1, mic, mic, mic % n_groups + 1, r.uniform(2, 8), r.uniform(0, 0.3),
+        r.uniform(8000, 25000), r.uniform(8000, 25000), r.uniform(0, 180), r.uniform(-5, 5), r.uniform(-5, 5))
+
+
+def make_particles_star(filename, n_rows, n_micrographs=500, n_groups=1, seed=0):
+    '''
+    Writes a synthetic particles.star file with n_rows particles (skipped if the file with the same size of the data already exists)
+    Returns the file name
+    '''
+    stamp = "%s.rows" % filename
+    if os.path.exists(filename) and os.path.exists(stamp):
+        with open(stamp) as f:
+            if f.read().strip() == "%d %d %d %d" % (n_rows, n_micrographs, n_groups, seed):
+                return filename
+    r = random.Random(seed)
+    with open(filename, "w") as f:
+        f.write(OPTICS_BLOCK)
+        for g in range(1, n_groups + 1):
+            f.write("opticsGroup%d            %d     0.830000   300.000000     2.700000     0.100000     1.660000          256            2 \n" % (g, g))
+        f.write("\n\n# version 30001\n\ndata_particles\n\nloop_ \n")
+        for i, label in enumerate(PARTICLE_LABELS):
+            f.write("%s #%d \n" % (label, i + 1))
+        chunk = 100000
+        for start in range(0, n_rows, chunk):
+            f.write("".join(particle_row(r, i, n_micrographs, n_groups) for i in range(start, min(start + chunk, n_rows))))
+        f.write("\n")
+    with open(stamp, "w") as f:
+        f.write("%d %d %d %d" % (n_rows, n_micrographs, n_groups, seed))
+    return filename
+
+
+def timed(func, *args, **kwargs):
+    "Returns (seconds, result) of func(*args, **kwargs)"
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def peak_rss_mb():
+    "Peak resident set size of the process in MB (Linux/MacOS)"
+    try:
+        import resource
+    except ImportError:
+        return float("nan")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+def _measure(func, args, queue):
+    seconds, _ = timed(func, *args)
+    queue.put((seconds, peak_rss_mb()))
+
+
+def run_isolated(func, *args):
+    "Runs func(*args) in a fresh process; returns (seconds, peak RSS in MB) of this measurement only"
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_measure, args=(func, args, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+import argparse
+import os
+import shutil
+from pathlib import Path
+
+import bench_helper
+from util.star_cache import load_cached
+from util.star_table import read_star
+
+PROG = Path(__file__).name
+VER = 20261017
+
+
+def open_and_sum(filename, cache_dir=None):
+    "Opens the star file (through the cache if cache_dir is given) and touches one numeric column"
+    particles = load_cached(filename, cache_dir).data_block
+    particles["_rlnCoordinateX"].sum()
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+Time to open a synthetic particles.star file with read_star and through the binary cache (util/star_cache.py):
+the first cached open parses the file and writes the cache, the next ones memory-map it.
+Every measurement runs in its own process.
+
+Example: {PROG} --rows 1000000 5000000 --dir /scratch/bench
+[version {VER}]'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--rows', type=int, nargs='+', default=[1000000, 5000000], help="Numbers of particles to test")
+    add('--dir', default="./", help="Folder for the synthetic star files and the cache")
+    args = parser.parse_args()
+
+    cache_dir = os.path.join(args.dir, "bench_cache")
+    print("\n %-14s %-10s %12s %14s" % ("open", "rows", "time, s", "peak RSS, MB"))
+    for n_rows in args.rows:
+        filename = bench_helper.make_particles_star(os.path.join(args.dir, "bench_particles_%d.star" % n_rows), n_rows)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        for name, cache in (("read_star", None), ("cache, first", cache_dir), ("cache, second", cache_dir),
+                            ("cache, third", cache_dir)):
+            seconds, rss = bench_helper.run_isolated(open_and_sum, filename, cache)
+            print(" %-14s %-10d %12.2f %14.0f" % (name, n_rows, seconds, rss))
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
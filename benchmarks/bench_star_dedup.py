@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+import bench_helper
+from util.star_spatial import dedup_mask
+
+PROG = Path(__file__).name
+VER = 20261017
+
+
+def synthetic_picks(n_rows, n_micrographs, size=4096, seed=0):
+    "Random picks: (micrograph codes, x, y, score)"
+    rng = np.random.default_rng(seed)
+    return (rng.integers(0, n_micrographs, n_rows), rng.uniform(0, size, n_rows), rng.uniform(0, size, n_rows),
+            rng.random(n_rows))
+
+
+def pairwise_dedup(groups, x, y, distance, score):
+    "Reference: greedy suppression with all the distances of the picks of every micrograph (O(picks^2) per micrograph)"
+    keep = np.zeros(len(x), dtype=bool)
+    for group in np.unique(groups):
+        rows = np.flatnonzero(groups == group)
+        rows = rows[np.lexsort((rows, -score[rows]))]
+        close = (x[rows, None] - x[rows]) ** 2 + (y[rows, None] - y[rows]) ** 2 < distance ** 2
+        dropped = np.zeros(len(rows), dtype=bool)
+        for i in range(len(rows)):
+            if not dropped[i]:
+                dropped |= close[i]
+                dropped[i] = False
+                keep[rows[i]] = True
+    return keep
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+Time of removing duplicate picks closer than --distance pixels (star_modif.py --dedup, util/star_spatial.py)
+on random picks: the uniform grid against all the pairwise distances per micrograph (only up to --pairwise_rows)
+
+Example: {PROG} --rows 1000000 10000000 --distance 40
+[version {VER}]'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--rows', type=int, nargs='+', default=[100000, 1000000, 10000000], help="Numbers of particles to test")
+    add('--micrographs', type=int, default=5000, help="Number of micrographs (4096 x 4096 pixels)")
+    add('--distance', type=float, default=40, help="Distance of the duplicates, pixels")
+    add('--pairwise_rows', type=int, default=1000000, help="Largest number of particles for the pairwise reference")
+    args = parser.parse_args()
+
+    print("\n %-10s %-10s %12s %14s %12s" % ("rows", "method", "time, s", "rows/s", "kept"))
+    for n_rows in args.rows:
+        groups, x, y, score = synthetic_picks(n_rows, args.micrographs)
+        methods = [("grid", dedup_mask)]
+        if n_rows <= args.pairwise_rows:
+            methods.append(("pairwise", pairwise_dedup))
+        results = []
+        for name, func in methods:
+            seconds, keep = bench_helper.timed(func, groups, x, y, args.distance, score)
+            results.append(keep)
+            print(" %-10d %-10s %12.2f %14.0f %12d" % (n_rows, name, seconds, n_rows / seconds, keep.sum()))
+        if len(results) > 1 and not np.array_equal(results[0], results[1]):
+            print(" => WARNING: the grid and the pairwise results differ")
+
+
+if __name__ == '__main__':
+    main()
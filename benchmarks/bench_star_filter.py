@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+import argparse
+import os
+from pathlib import Path
+
+import bench_helper
+from util.star_query import filter_star
+
+PROG = Path(__file__).name
+VER = 20261017
+EXPRESSION = "rlnCtfMaxResolution < 4 and rlnDefocusU between 8000 and 25000 and rlnClassNumber in {3, 7}"
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+Time and peak memory of the streamed filter of star_modif.py --filter (util/star_query.py)
+with three predicates on a synthetic particles.star file:
+    {EXPRESSION}
+
+Example: {PROG} --rows 5000000 --dir /scratch/bench
+[version {VER}]'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--rows', type=int, nargs='+', default=[1000000, 5000000], help="Numbers of particles to test")
+    add('--dir', default="./", help="Folder for the synthetic star files")
+    args = parser.parse_args()
+
+    print("\n %-10s %12s %14s %14s" % ("rows", "time, s", "rows/s", "peak RSS, MB"))
+    for n_rows in args.rows:
+        filename = bench_helper.make_particles_star(os.path.join(args.dir, "bench_particles_%d.star" % n_rows), n_rows)
+        output = os.path.join(args.dir, "bench_filter.star")
+        seconds, rss = bench_helper.run_isolated(filter_star, filename, EXPRESSION, output)
+        print(" %-10d %12.2f %14.0f %14.0f" % (n_rows, seconds, n_rows / seconds, rss))
+        os.remove(output)
+
+
+if __name__ == '__main__':
+    main()
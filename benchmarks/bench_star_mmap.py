@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+import argparse
+import os
+from pathlib import Path
+
+import bench_helper
+from util.star_helper import star_analyze
+from util.star_mmap import StarMap
+from util.star_query import filter_star
+from util.star_table import read_star
+
+PROG = Path(__file__).name
+VER = 20261017
+
+
+def mmap_sample(filename, index_file=None):
+    "Row index of the memory-mapped file (built or loaded) + 100 random rows"
+    with StarMap(filename, index_file) as star:
+        star.sample(star.data_block.name, 100, seed=0)
+
+
+def check_comment_rows(directory):
+    '''
+    Round-trip check: rows on both sides of a comment line inside a loop are kept by read_star, StarMap
+    (index built and loaded) and the streaming filter. Returns the list of the readers which lose rows
+    '''
+    filename = os.path.join(directory, "bench_comment_rows.star")
+    with open(filename, "w") as f:
+        f.write("\n# version 30001\n\ndata_particles\n\nloop_ \n_rlnA #1 \n_rlnB #2 \n1 2 \n3 4 \n# comment\n5 6 \n")
+    expected = [1, 3, 5]
+    failed = []
+    if read_star(filename).data_block["_rlnA"].tolist() != expected:
+        failed.append("read_star")
+    index_file = filename + ".idx.npz"
+    for name, index in (("StarMap", None), ("StarMap, new index", index_file), ("StarMap, index file", index_file)):
+        with StarMap(filename, index) as star:
+            if star.rows(star.data_block.name, 0, 10)["_rlnA"].tolist() != expected:
+                failed.append(name)
+    output = os.path.join(directory, "bench_comment_rows_filtered.star")
+    filter_star(filename, "rlnA > 0", output)
+    if read_star(output).data_block["_rlnA"].tolist() != expected:
+        failed.append("filter_star")
+    for name in (filename, index_file, output):
+        os.remove(name)
+    return failed
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+Time and peak memory to get 100 random rows of a synthetic particles.star file: memory-mapped file with
+a row index (util/star_mmap.py; index built, then loaded from the .npz index file) against parsing
+the whole file with star_analyze and read_star. Every measurement runs in its own process.
+
+Example: {PROG} --rows 1000000 5000000 --dir /scratch/bench
+[version {VER}]'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--rows', type=int, nargs='+', default=[1000000, 5000000], help="Numbers of particles to test")
+    add('--dir', default="./", help="Folder for the synthetic star files")
+    args = parser.parse_args()
+
+    failed = check_comment_rows(args.dir)
+    print("\n => Rows around a comment line inside a loop: %s" % ("lost by " + ", ".join(failed) if failed else "kept"))
+    print("\n %-16s %-10s %12s %14s" % ("reader", "rows", "time, s", "peak RSS, MB"))
+    for n_rows in args.rows:
+        filename = bench_helper.make_particles_star(os.path.join(args.dir, "bench_particles_%d.star" % n_rows), n_rows)
+        index_file = filename + ".idx.npz"
+        if os.path.exists(index_file):
+            os.remove(index_file)
+        tests = (("star_analyze", star_analyze, (filename,)), ("read_star", read_star, (filename,)),
+                 ("mmap, no index", mmap_sample, (filename,)), ("mmap, new index", mmap_sample, (filename, index_file)),
+                 ("mmap, index file", mmap_sample, (filename, index_file)))
+        for name, func, func_args in tests:
+            seconds, rss = bench_helper.run_isolated(func, *func_args)
+            print(" %-16s %-10d %12.2f %14.0f" % (name, n_rows, seconds, rss))
+        os.remove(index_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+import argparse
+import os
+from pathlib import Path
+
+import bench_helper
+from util.star_parallel import default_workers
+from util.star_table import read_star
+
+PROG = Path(__file__).name
+VER = 20261017
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+Scaling of read_star with the number of worker processes (util/star_parallel.py) on a synthetic particles.star file.
+{default_workers()} cores are available to this process.
+
+Example: {PROG} --rows 10000000 --workers 1 2 4 8 16 --dir /scratch/bench
+[version {VER}]'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--rows', type=int, nargs='+', default=[5000000], help="Numbers of particles to test")
+    add('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16], help="Numbers of processes to test")
+    add('--dir', default="./", help="Folder for the synthetic star files")
+    args = parser.parse_args()
+
+    print("\n %-10s %-10s %12s %14s %10s" % ("workers", "rows", "time, s", "rows/s", "speedup"))
+    for n_rows in args.rows:
+        filename = bench_helper.make_particles_star(os.path.join(args.dir, "bench_particles_%d.star" % n_rows), n_rows)
+        single = None
+        for workers in args.workers:
+            seconds, _ = bench_helper.run_isolated(read_star, filename, workers)
+            single = single or seconds
+            print(" %-10d %-10d %12.2f %14.0f %10.2f" % (workers, n_rows, seconds, n_rows / seconds, single / seconds))
+
+
+if __name__ == '__main__':
+    main()
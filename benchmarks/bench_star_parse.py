@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+import argparse
+import os
+from pathlib import Path
+
+import bench_helper
+from util.star_helper import star_analyze
+
+PROG = Path(__file__).name
+VER = 20261017
+
+
+def legacy_pop_loop(star_filename):
+    "The access pattern of the former star_analyze: readlines() and lines.pop(0) for every line"
+    with open(star_filename, 'r') as star_file:
+        lines = star_file.readlines()
+    for line in lines[:]:
+        line.split()
+        lines.pop(0)
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+Benchmark of star_analyze (util/star_helper.py) on synthetic particles.star files.
+Linear scaling is expected: the rows/s column should stay constant.
+
+Example: {PROG} --rows 1000000 5000000 10000000 --dir /scratch/bench --legacy 200000 400000
+[version {VER}]'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--rows', type=int, nargs='+', default=[1000000, 5000000, 10000000], help="Numbers of particles to test")
+    add('--dir', default="./", help="Folder for the synthetic star files")
+    add('--legacy', type=int, nargs='*', default=[],
+        help="Numbers of particles to test with the former readlines()+pop(0) loop (keep them small: it is quadratic)")
+    args = parser.parse_args()
+
+    print("\n %-12s %-10s %12s %14s %14s" % ("parser", "rows", "time, s", "rows/s", "peak RSS, MB"))
+    for name, func, sizes in (("legacy", legacy_pop_loop, args.legacy), ("star_analyze", star_analyze, args.rows)):
+        for n_rows in sizes:
+            filename = bench_helper.make_particles_star(os.path.join(args.dir, "bench_particles_%d.star" % n_rows), n_rows)
+            seconds, rss = bench_helper.run_isolated(func, filename)
+            print(" %-12s %-10d %12.2f %14.0f %14.0f" % (name, n_rows, seconds, n_rows / seconds, rss))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+import argparse
+import os
+from pathlib import Path
+
+import bench_helper
+from util.star_helper import star_analyze
+from util.star_table import read_star
+
+PROG = Path(__file__).name
+VER = 20261017
+KEY = "_rlnImageName"
+
+
+def analyze_keys(filename):
+    "star_analyze + the key of every row, as star_modif.py read selection files"
+    MainHeader, OpticsGroupData, OpticsHeader, StarData, StarFileType = star_analyze(filename)
+    i = MainHeader[KEY] - 1
+    return set(row[i] for row in StarData.values())
+
+
+def table_keys(filename):
+    "read_star of all columns"
+    return read_star(filename).data_block.unique(KEY)
+
+
+def projected_keys(filename):
+    "read_star of the key column only"
+    return read_star(filename, columns={KEY}).data_block.unique(KEY)
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+Time and peak memory of reading the {KEY} keys of a synthetic particles.star file
+(selection files of star_modif.py --extract/--exclude): star_analyze, read_star of all columns
+and read_star(columns={{"{KEY}"}}) (util/star_table.py)
+
+Example: {PROG} --rows 1000000 5000000 --dir /scratch/bench
+[version {VER}]'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--rows', type=int, nargs='+', default=[1000000], help="Numbers of particles to test")
+    add('--dir', default="./", help="Folder for the synthetic star files")
+    args = parser.parse_args()
+
+    print("\n %-10s %-14s %12s %14s" % ("rows", "reader", "time, s", "peak RSS, MB"))
+    for n_rows in args.rows:
+        filename = bench_helper.make_particles_star(os.path.join(args.dir, "bench_particles_%d.star" % n_rows), n_rows)
+        for name, func in (("star_analyze", analyze_keys), ("all columns", table_keys), ("projected", projected_keys)):
+            seconds, rss = bench_helper.run_isolated(func, filename)
+            print(" %-10d %-14s %12.2f %14.0f" % (n_rows, name, seconds, rss))
+
+
+if __name__ == '__main__':
+    main()
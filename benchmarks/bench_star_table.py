@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+import argparse
+import os
+from pathlib import Path
+
+import bench_helper
+from util.star_helper import star_analyze
+from util.star_table import read_star
+
+PROG = Path(__file__).name
+VER = 20261017
+
+
+def dict_rows_scale(filename):
+    "star_analyze + coordinates multiplied row by row, as the scripts did"
+    MainHeader, OpticsGroupData, OpticsHeader, StarData, StarFileType = star_analyze(filename)
+    x = MainHeader["_rlnCoordinateX"] - 1
+    for row in StarData.values():
+        row[x] = "%.6f" % (float(row[x]) * 2)
+
+
+def table_scale(filename):
+    "read_star + one array operation"
+    particles = read_star(filename).data_block
+    particles["_rlnCoordinateX"] = particles["_rlnCoordinateX"] * 2
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+Memory and time of the columnar StarTable (util/star_table.py) against the dictionary of rows of star_analyze
+on synthetic particles.star files: read + scaling of one column. Every measurement runs in its own process.
+
+Example: {PROG} --rows 1000000 5000000 --dir /scratch/bench
+[version {VER}]'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--rows', type=int, nargs='+', default=[1000000, 5000000], help="Numbers of particles to test")
+    add('--dir', default="./", help="Folder for the synthetic star files")
+    args = parser.parse_args()
+
+    print("\n %-14s %-10s %12s %14s %14s" % ("reader", "rows", "time, s", "rows/s", "peak RSS, MB"))
+    for n_rows in args.rows:
+        filename = bench_helper.make_particles_star(os.path.join(args.dir, "bench_particles_%d.star" % n_rows), n_rows)
+        for name, func in (("star_analyze", dict_rows_scale), ("read_star", table_scale)):
+            seconds, rss = bench_helper.run_isolated(func, filename)
+            print(" %-14s %-10d %12.2f %14.0f %14.0f" % (name, n_rows, seconds, n_rows / seconds, rss))
+
+
+if __name__ == '__main__':
+    main()
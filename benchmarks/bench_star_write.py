@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+import argparse
+import os
+from pathlib import Path
+
+import bench_helper
+from util.star_helper import star_analyze
+from util.star_table import StarWriter, read_star
+
+PROG = Path(__file__).name
+VER = 20261017
+
+
+def per_field_write(StarData, output):
+    "One write call per field, as write_out_star did"
+    with open(output, "w") as outputFile:
+        for k, v in StarData.items():
+            for item in v:
+                outputFile.write("%s " % item)
+            outputFile.write("\n")
+
+
+def rows_write(StarData, output):
+    "Whole rows formatted into multi-MB buffers (StarWriter.write_rows)"
+    with StarWriter(output) as writer:
+        writer.write_rows(StarData.values())
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+Write throughput for the data rows of a synthetic particles.star file: one write call per field
+(as the scripts did), whole rows through the buffered StarWriter (util/star_table.py), and
+column chunks of a StarTable (StarTable.write), also gzip-compressed with one compressing thread per core
+(MB/s of the uncompressed text).
+
+Example: {PROG} --rows 1000000 5000000 --dir /scratch/bench
+[version {VER}]'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--rows', type=int, nargs='+', default=[1000000, 5000000], help="Numbers of particles to test")
+    add('--dir', default="./", help="Folder for the synthetic star files")
+    args = parser.parse_args()
+
+    print("\n %-18s %-10s %12s %12s" % ("writer", "rows", "time, s", "MB/s"))
+    for n_rows in args.rows:
+        filename = bench_helper.make_particles_star(os.path.join(args.dir, "bench_particles_%d.star" % n_rows), n_rows)
+        output = os.path.join(args.dir, "bench_write.star")
+        StarData = star_analyze(filename)[3]
+        table = read_star(filename)
+        tests = (("per field", per_field_write, (StarData, output)), ("StarWriter rows", rows_write, (StarData, output)),
+                 ("StarTable.write", table.write, (output,)), ("StarTable.write gz", table.write, (output + ".gz",)))
+        for name, func, func_args in tests:
+            seconds, _ = bench_helper.timed(func, *func_args)
+            size = os.path.getsize(output) / 1024 ** 2
+            print(" %-18s %-10d %12.2f %12.1f" % (name, n_rows, seconds, size / seconds))
+        os.remove(output)
+        os.remove(output + ".gz")
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # -*- coding: utf-8 -*-
 
-ver=221027
+ver=261017
 
 import os
 import sys
@@ -21,6 +21,7 @@ import argparse
 import glob
 import pathlib
 import subprocess
+from util.star_table import read_star, StarTable, StarBlock
 
 def is_number(string):
     try:
@@ -41,38 +42,21 @@ def cbox_to_star(filename, mult_factor):
     file_extension=pathlib.Path(filename).suffix
     file_stem=pathlib.Path(filename).stem
     new_file = file_stem + ".star"
-    f1=open(filename, 'r')
-    f2=open(new_file, 'w')
-    lines=f1.readlines()
-    # multiplication of the coordinates of the STAR file:
+    # multiplication of the coordinates of the CBOX file (whole columns at once):
     if file_extension == ".cbox" or file_extension == "cbox":
-        f2.write("\ndata_\n\nloop_\n")
-        for line in lines:
-            line=line.strip() 
-            if line.startswith('_'):
-                if '_CoordinateX' in line:
-                    _CoordinateX_index=find_index(line)
-                    f2.write("_rlnCoordinateX #1 \n")
-                elif '_CoordinateY' in line:
-                    _CoordinateY_index=find_index(line)
-                    f2.write("_rlnCoordinateY #2 \n")
-            elif not line.startswith("#") and len(line.split()) > 4:
-                line=line.strip()
-                line=line.split()
-                for count, line_element in enumerate(line):
-                    #print(count, line_element)
-                        if count == _CoordinateX_index-1:
-                            line[count]= mult_by(line_element, mult_factor)
-                        elif count == _CoordinateY_index-1:
-                            line[count]= mult_by(line_element, mult_factor)
-                temp=' '.join(line[:2])
-                f2.write(temp+'\n')
+        cbox=read_star(filename)
+        boxes=[block for block in cbox.blocks.values() if "_CoordinateX" in block and "_CoordinateY" in block]
+        if not boxes:
+            print(" =>  ERROR! No _CoordinateX/_CoordinateY columns found in %s" %filename)
+            return
+        star=StarTable()
+        coordinates=star.add_block(StarBlock("", loop=True))
+        for axis in ("X", "Y"):
+            coordinates["_rlnCoordinate%s" %axis]=boxes[-1]["_Coordinate%s" %axis].astype(float)*mult_factor
+            coordinates.formats["_rlnCoordinate%s" %axis]="%.2f"
+        star.write(new_file)
     else:
         print(" =>  ERROR! The program works only with .cbox filetypes")
-    f1.close()
-    f2.write("\n")
-    f2.close()
-    print("%s file created" %new_file)
 
 
 def main(path, label, mult_factor):
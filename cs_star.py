@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from util.star_cs import cs_to_star, load_cs, round_trip_lost, save_cs, star_to_cs
+from util.star_table import read_star
+
+PROG = Path(__file__).name
+VER = 20261017
+UNDERLINE = ("=" * 70) + ("=" * (len(PROG) + 2))  # line for the output
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+cs_star.py converts particles between cryoSPARC .cs files and Relion star files (the direction is given by the
+extension of the input file): image names, micrographs, coordinates, CTF, poses, shifts, classes and optics groups.
+
+Note:
+ - .cs files are memory-mapped and converted column by column: millions of particles take seconds
+ - For .star => .cs the size of the micrographs (--mic_shape) is needed to convert the coordinates
+ - Paths are kept as they are (a leading ">" of cryoSPARC paths is dropped): run the script from the folder
+   the paths are relative to, or correct them afterwards
+
+{VER}
+
+Example: cs_star.py --i P12_J40_passthrough_particles.cs --o particles.star
+         cs_star.py --i particles.star --o particles.cs --mic_shape 4092 5760
+
+Pavel Afanasyev
+https://github.com/afanasyevp/cryoem_tools/
+ {UNDERLINE}'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--i', required=True, metavar="file", help="Input file: particles.cs or particles.star")
+    add('--o', required=True, metavar="file", help="Output file: particles.star or particles.cs")
+    add('--mic_shape', metavar="px", type=int, nargs=2,
+        help="Height and width of the micrographs in pixels (.star => .cs, for the coordinates)")
+    add('--seed', metavar="int", type=int, help="Seed of the random uids of the particles (.star => .cs)")
+    add('--check', action='store_true',
+        help="Convert the result back (.star => .cs) and report the columns lost in the round trip")
+    args = parser.parse_args()
+
+    parser.print_help()
+    start_time = time.time()
+    try:
+        if args.i.endswith(".cs"):
+            table, skipped = cs_to_star(load_cs(args.i))
+            table.write(args.o)
+            n = len(table.data_block)
+        else:
+            table = read_star(args.i)
+            if args.mic_shape is None and "_rlnCoordinateX" in table.data_block:
+                print("\n => WARNING: --mic_shape is not given: the coordinates are not converted")
+            particles, skipped = star_to_cs(table, args.mic_shape, args.seed)
+            save_cs(args.o, particles)
+            print(" => %s created!" % args.o)
+            n = len(particles)
+            if args.check:
+                lost = round_trip_lost(table, particles, skipped)
+                print(" => Round trip .star => .cs => .star: %s"
+                      % ("lost " + ", ".join(lost) if lost else "no columns lost"))
+    except (OSError, ValueError) as e:
+        print("\n => ERROR! %s" % e)
+        sys.exit(2)
+    if skipped:
+        print(" => Not converted: %s" % ", ".join(skipped))
+    print(" => %d particles converted (%.2f s)" % (n, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
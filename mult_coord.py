@@ -13,7 +13,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # -*- coding: utf-8 -*-
 
-ver=221025
+ver=261017
 
 import os
 import sys
@@ -21,6 +21,8 @@ import argparse
 import glob
 import pathlib
 import subprocess
+from util.star_table import read_star
+from util.star_coords import recenter
 
 def is_number(string):
     try:
@@ -37,44 +39,38 @@ def mult_by(x, mult_factor):
     #Multiplies input by a multiplication factor and returns string with a 2-digit precision
     return "%.2f" % (float(x)*mult_factor)
 
-def mult_coord(filename, mult_factor, fil_to_part):
+def mult_coord_star(filename, new_file, mult_factor, recentering=False, rounding=False, pixel_size=None):
+    'Multiplies _rlnCoordinateX/Y columns in all blocks of a star file (one array operation per column), re-centered first with recentering=True'
+    table=read_star(filename)
+    if recentering:
+        try:
+            recenter(table, rounding, pixel_size)
+        except ValueError as e:
+            print(" =>  ERROR! %s: %s" % (filename, e))
+            return
+    for block in table.blocks.values():
+        for label in ("_rlnCoordinateX", "_rlnCoordinateY"):
+            if label in block:
+                block[label]=block[label].astype(float)*mult_factor
+                block.formats[label]="%.2f"
+    table.write(new_file)
+
+def mult_coord(filename, mult_factor, fil_to_part, recentering=False, rounding=False, pixel_size=None):
     'Multiplies coordinates in star, box or cbox files'
     file_extension=pathlib.Path(filename).suffix
     file_stem=pathlib.Path(filename).stem
     new_file = file_stem + "_modified" + file_extension
     write_last_particle=False # for --fil_to_part option : once it detects the first empty line in the cbox file, it returns the last particle in the buffer of temp_tulip 
+    if file_extension == ".star":
+        mult_coord_star(filename, new_file, mult_factor, recentering, rounding, pixel_size)
+        return
+    if recentering:
+        print(" =>  WARNING: --recenter works only with .star files, %s is not re-centered" % filename)
     f1=open(filename, 'r')
     f2=open(new_file, 'w')
     lines=f1.readlines()
-    # multiplication of the coordinates of the STAR file:
-    if file_extension == ".star":
-        for line in lines:
-            line=line.strip()
-            if line.startswith('data_'): # ignore STAR structure
-                f2.write(line+'\n')
-            elif line.startswith('loop_'): # still ignore
-                f2.write(line+'\n')
-            elif line.startswith('_'):
-                if '_rlnCoordinateX' in line:
-                    _rlnCoordinateX_index=find_index(line)
-                    #print ("_rlnCoordinateX_index:", _rlnCoordinateX_index)
-                elif '_rlnCoordinateY' in line:
-                    _rlnCoordinateY_index=find_index(line)
-                f2.write(line+'\n')
-            elif len(line)==0: # ignore empty lines
-                f2.write(line+'\n')
-            elif not line.startswith("#"):
-                line=line.strip()
-                line=line.split()
-                for count, line_element in enumerate(line):
-                    if count == _rlnCoordinateX_index-1:
-                        line[count]= mult_by(line_element, mult_factor)
-                    elif count == _rlnCoordinateY_index-1:
-                        line[count]= mult_by(line_element, mult_factor)
-                temp=' '.join(line)
-                f2.write(temp+'\n')
     # multiplication of the coordinates of the CBOX file:     
-    elif file_extension == ".cbox" or file_extension == "cbox":
+    if file_extension == ".cbox" or file_extension == "cbox":
         #this section is for --fil_to_part option 
         write_line=True
         #define temp_tulip: (filamentid, line) for comparison filament_id and writing them as an output
@@ -190,10 +186,10 @@ def mult_coord(filename, mult_factor, fil_to_part):
     print("%s file created" %new_file)
 
 
-def main(mult_factor, path, label, fil_to_part):
+def main(mult_factor, path, label, fil_to_part, recentering=False, rounding=False, pixel_size=None):
     files = glob.glob(path+"*"+label)
     for file in files:
-        mult_coord(file, mult_factor, fil_to_part)
+        mult_coord(file, mult_factor, fil_to_part, recentering, rounding, pixel_size)
           
 if __name__== '__main__':
     output_text='''
@@ -206,7 +202,8 @@ Pavel Afanasyev
 https://github.com/afanasyevp/cryoem_tools
 ====================================================================================================
 
-Example: mult_coord.py --label star --path ./ --mult 0.25 --fil_to_part''' % (ver)
+Example: mult_coord.py --label star --path ./ --mult 0.25 --fil_to_part
+         mult_coord.py --label particles.star --path Refine3D/job040/ --recenter --round''' % (ver)
 
     parser = argparse.ArgumentParser(description="")
     add = parser.add_argument
@@ -216,6 +213,9 @@ Example: mult_coord.py --label star --path ./ --mult 0.25 --fil_to_part''' % (ve
     add('--mult', default=1,
         help="Multiplication factor")
     add('--fil_to_part', default=False, action='store_true', help='Converts filament coordinates to particles by removing the _filamentid and considering only beginning and the end of the filament. Works for .cbox files only')
+    add('--recenter', default=False, action='store_true', help='Star files: moves _rlnCoordinateX/Y by _rlnOriginXAngst/YAngst divided by the micrograph pixel size (_rlnMicrographPixelSize of the optics group or --pix) and sets the origins to 0 (before --mult)')
+    add('--round', default=False, action='store_true', help='With --recenter: rounds the new coordinates to whole pixels')
+    add('--pix', type=float, default=None, help='With --recenter: pixel size of the micrographs in A, for files without _rlnMicrographPixelSize')
     args = parser.parse_args()
     print(output_text)
     parser.print_help()
@@ -226,6 +226,6 @@ Example: mult_coord.py --label star --path ./ --mult 0.25 --fil_to_part''' % (ve
     #p=subprocess.Popen('rm *modified.cbox', stdout=subprocess.PIPE, shell=True)
     #(output, err) = p.communicate()  
     #p_status = p.wait()
-    main(mult_factor, path, label, args.fil_to_part)
+    main(mult_factor, path, label, args.fil_to_part, args.recenter, args.round, args.pix)
         
     print(" => Program completed")
@@ -6,6 +6,8 @@ import sys
 import os
 import argparse
 import re
+import numpy as np
+from util.star_table import StarBlock, StarTable, read_star
 
 def extract_moviename(path): 
     '''Extracts filename of a given path without extension:
@@ -19,206 +21,184 @@ output: FoilHole_14476491_Data_14478410_14478412_20191214_161005_fractions
     else: 
         return path 
 
-def star_analyze(star_filename):
+def movie_stems(block, label):
     '''
-    creates dicrionaries from the star files: 
-        OpticsHeader: everything starting with _rlnXXXX, corresponding to the data_optics section
-        "# version 30001
-        data_optics
-        loop_
-        _rlnOpticsGroupName #1" etc
-
-        OpticsGroupData:  all the data after the previous section like:  
-        "opticsGroup1           1     0.43   300     2.7     0.1"
-        
-        MainHeader:  everything starting with _rlnXXXX, corresponding to the data_movies or data_particles section
-        "# version 30001
-        data_particles
-        loop_
-        _rlnCoordinateX #1"
-        
-        StarData:  main data (alignments data for particles.star) after the previous section like:   
-        "mov1.tiff 25" (movies.star) or "3.43 6.2 0.1 10 8.2 000001@Extract/job044/Micro/mov1.mrcs MotionCorr/job034 /Micro/mov1.mrc 1 0.1 6.1 6.4 44.8 0.0 1.0 0.0 " (particles.star)
+    Stems (extract_moviename) of the values of a column: returns (stems, codes) with stems[codes[i]] the stem of row i;
+    the regular expression runs once per unique value (micrograph), not once per row
     '''
-    ## optics header dictionaries 
-    OpticsHeader={}    
-    OpticsGroupData={} 
-    ## main header dictionaries
-    MainHeader={}  
-    StarData={}    
-    with open(star_filename, 'r') as star_file: 
-        lines=star_file.readlines()
-    ## create OpticsHeader and OpticGroupData dictionary 
-    for line in lines[:]:
-        #print(line)
-        star_line=line.split()
-        #print("splitline:", star_line)
-        if len(star_line) > 0:
-            if line[:10] == "# version ":
-                OpticsHeader['# version']=star_line[2]
-                #print("version:", OpticsHeader['# version'])
-            elif line[:5] == "loop_": 
-                continue
-            elif line[:11]=="data_optics":
-                #print("Data_optics found!")
-                continue
-            elif line[:4] == "_rln":
-                OpticsHeader[star_line[0]]=int(star_line[1][1:])
-            elif line[:11]=="opticsGroup":
-                OpticsGroupData[star_line[0]]=line[:-1]
-                #print(OpticsGroupData)
-            elif line[:5] == "data_":
-                data_type=line[:-1].split("_")[1]
-                #print("Data_%s found!" %data_type)
-                lines.pop(0)
-                break
-            else:
-                continue
-        lines.pop(0)
-    if '# version' not in OpticsHeader.keys():
-        OpticsHeader['# version']="unknown"
-    ## create MainHeader dictionary with the main Header
-    for line in lines[:]:
-        star_line=line.split()
-        if len(star_line) > 0:
-            if line[:10] == "# version ":
-                MainHeader['# version']=star_line[2]
-            elif line[:5] == "data_":
-                data_type=line[:-1].split("_")[1]
-                #print("Data_%s found!" %data_type)
-                continue
-            elif line[:5] == "loop_": 
-                continue
-            elif line[:4] == "_rln":
-                MainHeader[star_line[0]]=int(star_line[1][1:])
-                if line[:24] == "_rlnMicrographMovieName ":
-                    _rlnMicrographMovieName_index=int(star_line[-1].split("#")[-1])
-                    #print("_rlnMicrographMovieName_index", star_line[-1].split("#")[-1])
-                elif line[:19] == "_rlnMicrographName ":
-                    _rlnMicrographName_index=int(star_line[-1].split("#")[-1])
-                    #print("_rlnMicrographName_index", star_line[-1].split("#")[-1])
-                elif line[:14] == "_rlnImageName ":
-                    _rlnImageName_index=int(star_line[-1].split("#")[-1])
-                    #print("_rlnImageName_index", star_line[-1].split("#")[-1])
-            else:
-                ## create main StarData dictionary, where the key is the main header
-                ## identifier is  micrograph/movie/particle name
-                if data_type == "micrographs":
-                    StarData[star_line[(_rlnMicrographName_index-1)]]=star_line
-                elif data_type == "movies":
-                    StarData[star_line[(_rlnMicrographMovieName_index-1)]]=star_line
-                elif data_type == "particles":
-                    StarData[star_line[(_rlnImageName_index-1)]]=star_line 
-                    continue
-                else:
-                    print("ERROR: no data type found!")
-                    sys.exit(2)
-                #print("break at:", line)
-                #break
-        lines.pop(0)
-    if '# version' not in MainHeader.keys():
-        MainHeader['# version']="unknown"
-    StarFileType=data_type     
-    #print("MainHeader: ", MainHeader, "\n")
-    #print("StarData dictionary: ", StarData, "\n")
-    #print("OpticsGroupData", OpticsGroupData, "\n")
-    #print("OpticsHeader: ", OpticsHeader, "\n") 
-    return MainHeader, OpticsGroupData, OpticsHeader, StarData, StarFileType
+    uniques, codes = block.factorize(label)
+    return [extract_moviename(value.decode()) for value in uniques.tolist()], codes
+
 
-def merge_optics_headers(header_1, header_2, data_1, data_2):
+def merge_optics(optics, main_optics):
     '''
-    Merges optics and data headers:
-    header_1: optics header from the movies (micrographs) file
-    header_2: particles optics-header from the particles file
-    data_1: optics group-data from the movies (micrographs) file
-    data_2: particles optics group-data (one line) from the particles file
+    Merges optics blocks:
+    optics: optics block of the movies (micrographs) file
+    main_optics: optics block of the particles file (a single optics group); its columns missing in the movies file
+    are added to every optics group
     '''
-    data_merged={}
-    header_merged=header_1  # the optics header is taken from particles.star file 
-    #checks if the optics header movies.star contains anything extra to be included
-    new_indexes_of_extra_values=[]
-    old_indexes_of_extra_values=[]
-    extra_values_to_add=" "
-    
-    for key in header_2:
-        if key not in header_1:
-            print("WARNING!!!!! Found an extra column in the particles-file, missing in micrographs-file: ", key, "\n This column and the corresponding values will be included in the output file" )
-            header_merged[key]=len(header_merged) #append the missing(extra) column, found in the movies file and missing in the particles file
-            new_indexes_of_extra_values.append(header_merged[key])
-            old_indexes_of_extra_values.append(header_2[key])
-    #print("new_indexes_of_extra_values", new_indexes_of_extra_values)
-    #print("old_indexes_of_extra_values", old_indexes_of_extra_values)
-    #print("header_merged", header_merged)
-    if len(data_2)==1: 
-        #convert data_2 dictionary with a sigle entry to a list and picking the right values to include into the new data_merged:
-        data_2_value=str(*data_2.values()).split()
-        for i in old_indexes_of_extra_values:
-            extra_values_to_add=extra_values_to_add+str(data_2_value[i-1])+"   "
-    else:
+    if len(main_optics) != 1:
         print("ERROR: particles.star file already contains multiple OpticsGroups or none. You might consider deleting them manually and leaving a single one")
-        sys.exit(2) 
-    #print("extra_values_to_add", extra_values_to_add)
-    
-    #actual merging of the optics data:
-    for k,v in data_1.items():
-        data_merged[k]=v+extra_values_to_add
-    return header_merged, data_merged
+        sys.exit(2)
+    merged = optics.take(np.arange(len(optics)))
+    added = []
+    for label in main_optics.ordered_labels():
+        if label in merged:
+            continue
+        added.append(label)
+        print("WARNING!!!!! Found an extra column in the particles-file, missing in micrographs-file: ", label, "\n This column and the corresponding values will be included in the output file" )
+        merged.labels[label] = len(merged.labels) + 1
+        merged.formats[label] = main_optics.formats[label]
+        if label in main_optics.categories:
+            merged.categories[label] = main_optics.categories[label]
+        merged.columns[label] = np.repeat(main_optics.columns[label][:1], len(merged))
+    if optics.unchanged():
+        # the optics rows of the movies file are written as they are, the values of the added columns appended
+        lines = optics.original[0].split(b"\n")[:-1]
+        if added:
+            values = [merged.text(label) for label in added]
+            lines = [b" ".join([line.rstrip()] + [text[i] for text in values]) + b" " for i, line in enumerate(lines)]
+        merged.keep_original(b"".join(line + b"\n" for line in lines))
+    return merged
+
+
+def group_rows(optics, groups):
+    "Rows of the optics block of the optics groups (numbers), through an array indexed by _rlnOpticsGroup; -1 if absent"
+    numbers = optics["_rlnOpticsGroup"].astype(np.int64)
+    lookup = np.full(max(numbers.max(), groups.max(initial=0)) + 1, -1, dtype=np.int64)
+    lookup[numbers] = np.arange(len(optics))
+    return np.where(groups >= 0, lookup[np.maximum(groups, 0)], -1)
+
+
+def copy_column(target, source, label, rows):
+    "Appends the values of the rows of a column of the source block to the target block (format and encoding kept)"
+    target.labels[label] = len(target.labels) + 1
+    target.formats[label] = source.formats[label]
+    if label in source.categories:
+        target.categories[label] = source.categories[label]
+    target.columns[label] = source.columns[label][rows]
+
+
+def optics_conflicts(movie_optics, movie_rows, main_optics, main_rows, label):
+    "New optics groups where a column of both optics blocks has different values"
+    movie_values, main_values = movie_optics[label][movie_rows], main_optics[label][main_rows]
+    if movie_values.dtype.kind in "iuf" and main_values.dtype.kind in "iuf":
+        return ~np.isclose(movie_values, main_values, rtol=1e-6, atol=0)
+    return movie_optics.text(label)[movie_rows] != main_optics.text(label)[main_rows]
 
 
-def micrographs_write_optics(OpticsFileName, MainFileName, Output):
+def regroup_optics(movie_optics, main_optics, old_groups, movie_groups):
     '''
-    reads in the a file with optics and without; writes out a new star-file.
-    requires star_analyze
+    New optics groups for particles already split into optics groups (e.g. after CTF refinement): one new group for every
+    pair (old group, optics group of the movie) present, numbered in this order.
+    The optics block takes the columns of both optics blocks; values of the columns present in both (pixel size...) and of
+    the refined ones (beam tilt, aberrations) come from the old group of the particles, differences are reported.
+    Rows of movies absent in the movies file (movie_groups -1) get the columns of the first movie optics group.
+    Returns (optics block, new group of every row (1...), old group and movie group of every new group)
     '''
+    old = old_groups.astype(np.int64)
+    movie = movie_groups.astype(np.int64) + 1
+    n = int(movie.max(initial=0)) + 1
+    pairs, new_groups = np.unique(old * n + movie, return_inverse=True)
+    pair_old, pair_movie = pairs // n, pairs % n - 1
+    main_rows = group_rows(main_optics, pair_old)
+    if (main_rows < 0).any():
+        raise ValueError("optics groups %s of the particles are not found in their data_optics"
+                         % ", ".join(map(str, pair_old[main_rows < 0])))
+    movie_rows = np.maximum(group_rows(movie_optics, pair_movie), 0)
+
+    optics = StarBlock("optics", movie_optics.version)
+    optics["_rlnOpticsGroupName"] = np.array([b"opticsGroup%d" % (i + 1) for i in range(len(pairs))])
+    optics["_rlnOpticsGroup"] = np.arange(1, len(pairs) + 1)
+    names = ("_rlnOpticsGroupName", "_rlnOpticsGroup")
+    for label in movie_optics.ordered_labels() + main_optics.ordered_labels():
+        if label in optics:
+            continue
+        if label in main_optics and label in movie_optics:
+            differ = optics_conflicts(movie_optics, movie_rows, main_optics, main_rows, label) & (pair_movie >= 0)
+            if differ.any():
+                i = np.flatnonzero(differ)[0]
+                print("WARNING!!!!! %s differs in %d of %d new optics groups (e.g. group %d: %s in the movies file, %s in the particles file); the values of the particles are used"
+                      % (label, differ.sum(), len(pairs), i + 1, movie_optics.text(label)[movie_rows[i]].decode(),
+                         main_optics.text(label)[main_rows[i]].decode()))
+        if label in main_optics:
+            copy_column(optics, main_optics, label, main_rows)
+        else:
+            copy_column(optics, movie_optics, label, movie_rows)
+    return optics, new_groups + 1, pair_old, pair_movie
+
+
+def write_group_map(filename, stems, codes, old_groups, new_groups):
+    "Writes the text file of the new optics group of every pair (old optics group, movie) present"
+    n = len(stems)
+    pairs, first = np.unique(new_groups.astype(np.int64) * n + codes, return_index=True)
+    with open(filename, "w") as map_file:
+        map_file.write("# old_group movie new_group\n")
+        for row, code in zip(first.tolist(), (pairs % n).tolist()):
+            map_file.write("%d %s %d\n" % (old_groups[row], stems[code], new_groups[row]))
+    print(" => %s created!" % filename)
 
-    print("working on %s file" % OpticsFileName, "\n") 
-    OpticsFile_MainHeader, OpticsGroupData, OpticsHeader, MoviesData, StarFileType = star_analyze(OpticsFileName)
+
+def micrographs_write_optics(OpticsFileName, MainFileName, Output, n_samples=5, workers=1):
+    '''
+    reads in the a file with optics and without; writes out a new star-file.
+    The optics groups are joined by movie stem: one stem -> group lookup array for the unique micrographs
+    of the main file, mapped to all rows with one array operation. Rows of movies absent in the optics file keep their group;
+    they are reported as counts with a few sample names. workers: processes parsing the main file
+    '''
+    print("working on %s file" % OpticsFileName, "\n")
+    movies = read_star(OpticsFileName)
     print("working on %s file" % MainFileName, "\n")
-    MainFile_MainHeader, Main_OpticsGroupData, Main_OpticsHeader, MainFile_Data, MainFile_StarFileType = star_analyze(MainFileName)
-    ##create a dictionary-helper to identify micrographs's group
-    _rlnOpticsGroupInMovies_index=OpticsFile_MainHeader['_rlnOpticsGroup']
-    _rlnOpticsGroupInMain_index=MainFile_MainHeader['_rlnOpticsGroup']
-    OpticsGroup={}
-    for k,v in MoviesData.items():
-        OpticsGroup[extract_moviename(k)]=v[_rlnOpticsGroupInMovies_index-1]
-    ## Modify MainFile_Data dictionary with modified Optics groups
-    #print(MainFile_StarFileType)
-    OpticsHeader_output=OpticsHeader
-    OpticsGroupData_output=OpticsGroupData
-    if MainFile_StarFileType=="particles":
-        OpticsHeader_output, OpticsGroupData_output = merge_optics_headers(OpticsHeader, Main_OpticsHeader, OpticsGroupData, Main_OpticsGroupData)
-    with open(Output, "w") as outputFile:
+    table = read_star(MainFileName, workers)
+    movies_block, main = movies.data_block, table.data_block
+    for star_table, block in ((movies, movies_block), (table, main)):
+        if star_table.optics is None or "_rlnOpticsGroup" not in block:
+            print("ERROR: no optics groups found in the %s file" % star_table.filename)
+            sys.exit(2)
+    ## movie stem -> optics group
+    stems, codes = movie_stems(movies_block, movies.key_label)
+    OpticsGroup = dict(zip((stems[code] for code in codes.tolist()), movies_block["_rlnOpticsGroup"].tolist()))
+    # micrograph names have far fewer unique values than the particle names and the same stems
+    label = "_rlnMicrographName" if "_rlnMicrographName" in main else table.key_label
+    stems, codes = movie_stems(main, label)
+    lookup = np.array([OpticsGroup.get(stem, -1) for stem in stems], dtype=np.int64)
+    groups = lookup[codes]
+    unmatched = groups < 0
+    if unmatched.any():
+        missing = np.unique(codes[unmatched])
+        regrouped = table.data_type == "particles" and len(table.optics) > 1
+        print("WARNING!!!! %d rows of %d movies are not found in the %s file; %s. For example:"
+              % (unmatched.sum(), len(missing), OpticsFileName,
+                 "they keep the optics columns of their old group" if regrouped else "their opticsGroup is not modified"))
+        for code in missing[:n_samples].tolist():
+            print("    %s" % stems[code])
+
+    if table.data_type == "particles" and len(table.optics) > 1:
+        # particles already in several optics groups: new groups for every (old group, movie group)
+        old_groups = main["_rlnOpticsGroup"]
+        try:
+            optics, new_groups, pair_old, pair_movie = regroup_optics(movies.optics, table.optics, old_groups, groups)
+        except ValueError as e:
+            print("ERROR: %s" % e)
+            sys.exit(2)
+        main["_rlnOpticsGroup"] = new_groups
+        print(" => %d rows of %d old optics groups assigned to %d new optics groups" % (len(main), len(table.optics), len(optics)))
+        if Output:
+            write_group_map(os.path.splitext(Output)[0] + "_optics_map.txt", stems, codes, old_groups, new_groups)
+    else:
+        main["_rlnOpticsGroup"] = np.where(unmatched, main["_rlnOpticsGroup"], groups)
+        print(" => %d of %d rows assigned to %d optics groups" % (len(main) - unmatched.sum(), len(main), len(movies.optics)))
+        optics = movies.optics
+        if table.data_type == "particles":
+            optics = merge_optics(optics, table.optics)
+    output = StarTable(Output)
+    output.add_block(optics)
+    output.add_block(main)
+    if Output:
+        output.write(Output)
+    return output
+
 
-        outputFile.write('''
-# version %s
-data_optics
-loop_ 
-''' %OpticsHeader['# version'])
-        OpticsHeader_output.pop("# version")
-        #print(OpticsHeader_output.items())
-        for k, v in sorted(OpticsHeader_output.items(), key=lambda item: item[1]):
-            outputFile.write("%s #%s \n" %(k, v))
-        for k, v in sorted(OpticsGroupData_output.items(), key=lambda item: item[1][1]):
-            outputFile.write("%s\n" %v) 
-        outputFile.write('''
-# version %s
-data_%s
-loop_ 
-''' %(Main_OpticsHeader['# version'],  MainFile_StarFileType))
-        MainFile_MainHeader.pop("# version")
-        for k, v in sorted(MainFile_MainHeader.items(), key=lambda item: item[1]):
-            outputFile.write("%s #%s \n" %(k, v))
-        for k,v in MainFile_Data.items():
-            try: 
-                MainFile_Data[k][_rlnOpticsGroupInMain_index-1]=OpticsGroup[extract_moviename(k)]
-            except KeyError:
-                print("WARNING!!!! %s movie is not found in the %s file and will be skipped! For this micrograph opticsGroup will not be modified! "%(extract_moviename(k), OpticsFileName)) 
-            for item in v: 
-                outputFile.write("%s " %item)
-            outputFile.write("\n")
-        outputFile.write("\n")
-        
-    
 def main():
     output_text='''
 ========================================= optics_add.py ==========================================
@@ -228,8 +208,9 @@ Note:
  - The input mmovies.star file must contain optics groups (please run optics_split)
  - The program works with files from Relion 3.1 version
  - Movie-names cannot contain more than one "." in filename (only in front of the file extension)
- - In case --part option is used, assumed only only one optics group in the particle.star file
- Only particles before CTF-refinement can be used.
+ - In case --part option is used with a particles.star file of several optics groups (e.g. after CTF-refinement),
+ every pair (old optics group, optics group of the movie) becomes a new optics group keeping the refined optics
+ parameters of the old group; the new group of every (old group, movie) is written to <output>_optics_map.txt
 How to install and run:   
  - Download and install the latest Anaconda with python 3.6 or later
  - Modify the first line of the script to change the location of the python execultable to 
@@ -247,6 +228,7 @@ https://github.com/afanasyevp/afis/
     add('--micro', help="micrographs_ctf.star file without optics groups")
     add('--part', help="particles.star file without optics groups")
     add('--o', default="", help="Output star file. If empty no file generated generated.")
+    add('--j', type=int, default=1, help="Number of processes used to parse a large particles file (default: 1)")
     args = parser.parse_args()
     print(output_text)
     parser.print_help()
@@ -273,7 +255,7 @@ https://github.com/afanasyevp/afis/
     if not args.o:
         print("No output file given. No star file will be saved.")
     
-    micrographs_write_optics(movies_filename, star_filename, str(args.o))
+    micrographs_write_optics(movies_filename, star_filename, str(args.o), workers=args.j)
         
     print("\nThe program finished successfully. Please critically check the results in the %s file." % args.o)
 if __name__ == '__main__':
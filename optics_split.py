@@ -9,9 +9,16 @@ import matplotlib.pyplot as plt
 import argparse
 import xml.etree.ElementTree as ET
 import glob
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as np
-from xml.dom import minidom
 from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score
+from threadpoolctl import threadpool_limits
+from util.epu_xml import THREADS, cached_beam_shifts, read_beam_shifts
+from util.star_cache import DEFAULT_CACHE_DIR
+
+SILHOUETTE_SAMPLE = 10000   # beam shifts used for the silhouette scores of --auto_k
 
 #### Parser of the FEI .xml file    
     
@@ -36,18 +43,18 @@ def get_files(directory, movietype):
     return xmlfiles, moviefiles
     
 
-def get_beamShiftArray(xmlfiles, xmlpath):
-    #print(xmlpath)
-    print("Reading beam shifts from the .xml files... ")
-    beamShifts = []
-    for index, xmlfile in enumerate(xmlfiles):
-        if index % 300 ==0:  print(" Working on %s file...     Progress: %d %% " %(xmlfile, 100*index/len(xmlfiles)))
-        xmldoc = minidom.parse("%s" %xmlfile)
-        beamshift_items = xmldoc.getElementsByTagName("BeamShift")[0]
-        shiftx = beamshift_items.getElementsByTagName("a:_x")
-        shifty = beamshift_items.getElementsByTagName("a:_y")
-        beamShifts.append([float(shiftx[0].childNodes[0].nodeValue),float(shifty[0].childNodes[0].nodeValue)])
-    beamShiftArray = np.array(beamShifts)
+def get_beamShiftArray(xmlfiles, xmlpath, threads=THREADS, cache_dir=None):
+    # BeamShift _x, _y of every .xml file, read only up to the BeamShift element by a pool of threads (util/epu_xml.py)
+    # with cache_dir: only the files new or changed since the last run are read
+    print("Reading beam shifts from %d .xml files with %d threads... " % (len(xmlfiles), threads))
+    try:
+        if cache_dir:
+            beamShiftArray = cached_beam_shifts(xmlfiles, xmlpath, cache_dir, threads)
+        else:
+            beamShiftArray = read_beam_shifts(xmlfiles, threads)
+    except ValueError as e:
+        print("ERROR: %s" % e)
+        sys.exit(2)
     return beamShiftArray
 
 def elbowMethod(maxClusters, inputArray, maxIter, nInit):
@@ -63,17 +70,87 @@ def elbowMethod(maxClusters, inputArray, maxIter, nInit):
     plt.plot(range(1, maxClusters), wcss)
     plt.show()
 
-def kmeansClustering(nClusters, inputArray, maxIter, nInit):
-    kmeans = KMeans(n_clusters=nClusters, init='k-means++', max_iter=maxIter, n_init=nInit, random_state=0)
-    #print("inputArray:",inputArray)
-    pred_y = kmeans.fit_predict(inputArray)
-    print("K-means clustering is running. Please check the popping-up window ")
+def fitClusters(nClusters, inputArray, maxIter, nInit, sampleSize=SILHOUETTE_SAMPLE, threads=None):
+    # k-means with nClusters clusters: returns (inertia, silhouette score of sampleSize points (None for 1 cluster), cluster numbers, centers)
+    with threadpool_limits(threads):
+        kmeans = KMeans(n_clusters=nClusters, init='k-means++', max_iter=maxIter, n_init=nInit, random_state=0)
+        pred_y = kmeans.fit_predict(inputArray)
+        score = None
+        if 1 < nClusters < len(inputArray):
+            try:
+                score = silhouette_score(inputArray, pred_y, sample_size=min(sampleSize, len(inputArray)), random_state=0)
+            except ValueError:
+                # fewer distinct beam shifts (in the sample) than clusters
+                score = None
+    return kmeans.inertia_, score, pred_y, kmeans.cluster_centers_
+
+def selectClusters(maxClusters, inputArray, maxIter, nInit, workers, plotFile):
+    '''
+    Headless elbow method: k-means for 1..maxClusters clusters, fitted in a pool of workers processes.
+    The number of clusters is the one with the highest silhouette score (computed on a random sample of
+    SILHOUETTE_SAMPLE beam shifts; the smaller number on ties). The WCSS (elbow) and silhouette curves are written to plotFile.
+    Returns (number of clusters, cluster numbers, centers)
+    '''
+    # the silhouette score needs at least one cluster fewer than beam shifts
+    ks = list(range(1, max(min(maxClusters, len(inputArray) - 1), 1) + 1))
+    print("Elbow method is running for 1-%d clusters with %d processes" % (ks[-1], workers))
+    if workers > 1:
+        # one BLAS/OpenMP thread per process
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(fitClusters, ks, repeat(inputArray), repeat(maxIter), repeat(nInit),
+                                    repeat(SILHOUETTE_SAMPLE), repeat(1)))
+    else:
+        results = [fitClusters(k, inputArray, maxIter, nInit) for k in ks]
+    inertias = [inertia for inertia, score, pred_y, centers in results]
+    scores = [score for inertia, score, pred_y, centers in results]
+    for k, inertia, score in zip(ks, inertias, scores):
+        print(" %3d clusters: WCSS %.6g, silhouette %s" % (k, inertia, "-" if score is None else "%.3f" % score))
+    # failed scores count as -inf; 1 cluster if no score is available
+    ranked = [-np.inf if score is None else score for score in scores[1:]]
+    best = 0
+    if ranked and max(ranked) > -np.inf:
+        best = 1 + int(np.argmax(ranked))
+        print(" => %d clusters: the highest silhouette score" % ks[best])
+    else:
+        print(" => 1 cluster: no silhouette score could be computed")
+    fig, ax = plt.subplots()
+    ax.set_title('Elbow Method')
+    ax.set_xlabel('Number of clusters')
+    ax.set_ylabel('WCSS')
+    ax.plot(ks, inertias, 'o-')
+    ax.axvline(ks[best], color='grey', linestyle='--')
+    scored = [(k, score) for k, score in zip(ks, scores) if score is not None]
+    if scored:
+        ax2 = ax.twinx()
+        ax2.set_ylabel('Silhouette score')
+        ax2.plot([k for k, score in scored], [score for k, score in scored], 's-', c='red')
+    fig.savefig(plotFile)
+    plt.close(fig)
+    print(" => %s created!" % plotFile)
+    inertia, score, pred_y, centers = results[best]
+    return ks[best], pred_y, centers
+
+def plotClusters(inputArray, centers, plotFile=None):
+    # scatter plot of the beam shifts and the cluster centers: shown, or written to plotFile
     plt.title('Beam-shifts distribution clustering')
     plt.xlabel('Beam-shift X')
     plt.ylabel('Beam-shift Y')
     plt.scatter(inputArray[:, 0], inputArray[:, 1], s=2)
-    plt.scatter(kmeans.cluster_centers_[:, 0], kmeans.cluster_centers_[:,1], s=30, c='red')
-    plt.show()
+    plt.scatter(centers[:, 0], centers[:,1], s=30, c='red')
+    if plotFile:
+        plt.savefig(plotFile)
+        plt.close()
+        print(" => %s created!" % plotFile)
+    else:
+        plt.show()
+
+def kmeansClustering(nClusters, inputArray, maxIter, nInit, plotFile=None):
+    kmeans = KMeans(n_clusters=nClusters, init='k-means++', max_iter=maxIter, n_init=nInit, random_state=0)
+    #print("inputArray:",inputArray)
+    pred_y = kmeans.fit_predict(inputArray)
+    if not plotFile:
+        print("K-means clustering is running. Please check the popping-up window ")
+    plotClusters(inputArray, kmeans.cluster_centers_, plotFile)
     return pred_y
 
 def saveClusteredShifts(fileName, inputArray, clusterIDs):
@@ -151,8 +228,12 @@ https://github.com/afanasyevp/afis
     add('--o_shifts', default="", help="Output file with extracted beam-shifts and cluster numbers. If empty no file generated generated.")
     add('--clusters', type=str, default="9", help="Number of clusters the beam-shifts should be divided in. (default: 1)")
     add('--elbow', type=str, default="0", help="Number of max clusters used in Elbow method optimal cluster number determination. (default: 0)")
+    add('--auto_k', type=str, default="0", help="Headless mode: tries 1 to this number of clusters (processes: --j), takes the number with the highest silhouette score and writes the output; the elbow and cluster plots are saved as png files next to --o. (default: 0)")
+    add('--j', type=int, default=1, help="Number of processes used by --auto_k (default: 1)")
     add('--max_iter', type=str, default="300", help="Expert option: Maximum number of iterations of the k-means algorithm for a single run. (default: 300)")
     add('--n_init', type=str, default="10", help="Expert option: Number of time the k-means algorithm will be run with different centroid seeds. (default: 10)")
+    add('--threads', type=int, default=THREADS, help="Number of threads reading the .xml files (default: %d)" % THREADS)
+    add('--cache', metavar="dir", nargs='?', const=DEFAULT_CACHE_DIR, help="Keep the beam shifts in a cache file in this folder (default: %s): a rerun reads only the new or changed .xml files" % DEFAULT_CACHE_DIR)
     add('--pix', default='1', help="Pixel size. Default value: 1 A/pix")
     add('--kev', type=str, default='300', help="keV. Default value: 300")
     add('--cs', type=str, default='2.7', help="Cs. Default value: 2.7")
@@ -161,6 +242,7 @@ https://github.com/afanasyevp/afis
     print(output_text)
     parser.print_help()
     print("Example: optics_split.py --i ./movies --o movies.star --f tiff --clusters 9 --pix 1.09")
+    print("         optics_split.py --i ./movies --o movies.star --f tiff --auto_k 25 --j 8 --pix 1.09")
     print(" ")
     #print("args: ", args)
     try:
@@ -168,8 +250,9 @@ https://github.com/afanasyevp/afis
         elbow = int(args.elbow)
         max_iter = int(args.max_iter)
         n_init = int(args.n_init)
+        auto_k = int(args.auto_k)
     except ValueError:
-        print("--clusters, --elbow, --max_iter and --n_init require integer values for comparison.")
+        print("--clusters, --elbow, --auto_k, --max_iter and --n_init require integer values for comparison.")
         sys.exit(2)
     if len(sys.argv) == 1:
         #parser.print_help()
@@ -199,11 +282,18 @@ https://github.com/afanasyevp/afis
     xml_files, movie_files=get_files(directory, movietype)
     #print(xml_files)
     #print(movie_files)
-    beamShiftArray=get_beamShiftArray(xml_files, args.i)
+    beamShiftArray=get_beamShiftArray(xml_files, args.i, args.threads, args.cache)
     #print (beam_shift_array[0])
     
 
-    if elbow > 0:
+    plotStem = os.path.splitext(args.o or args.o_shifts or "optics_split")[0]
+    if auto_k > 0:
+        # no window is opened: the plots are written to files
+        plt.switch_backend("Agg")
+        clusters, pred_y, centers = selectClusters(auto_k, beamShiftArray, max_iter, n_init, max(args.j, 1), plotStem + "_elbow.png")
+        plotClusters(beamShiftArray, centers, plotStem + "_clusters.png")
+        elbow = 0
+    elif elbow > 0:
         print("Running elbow....")
         elbowMethod(elbow, beamShiftArray, max_iter, n_init)
         print("Elbow done!")
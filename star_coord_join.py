@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import sys
+from pathlib import Path
+from util.star_spatial import join_star
+
+PROG = Path(__file__).name
+VER = 20261017
+UNDERLINE = ("=" * 70) + ("=" * (len(PROG) + 2))  # line for the output
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+star_coord_join.py matches the particles of two star files by micrograph and coordinates (e.g. a re-extraction
+with new image names and a binned extraction with class assignments) and carries columns of the reference
+file over to the matched particles of the input file.
+
+Note:
+ - Micrographs are compared by the stem of _rlnMicrographName; particles closer than --distance pixels are matched
+   one to one, the closest pairs first
+ - --scale multiplies the reference coordinates first (as mult_coord.py), e.g. 4 for a reference picked on
+   micrographs binned 4 times
+ - Only the matched particles are written; the numbers of unmatched particles of both files are reported
+
+{VER}
+
+Example: star_coord_join.py --i Extract/job030/particles.star --ref Class2D/job020/run_it025_data.star --o particles_classes.star --distance 5 --columns _rlnClassNumber
+         star_coord_join.py --i particles_bin1.star --ref particles_bin4.star --o particles_joined.star --scale 4
+
+Pavel Afanasyev
+https://github.com/afanasyevp/cryoem_tools/
+ {UNDERLINE}'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--i', required=True, metavar="file",
+        help="Input star file: its particles and columns are written")
+    add('--ref', required=True, metavar="file",
+        help="Reference star file: its columns are added to the matched particles")
+    add('--o', required=True, metavar="file",
+        help="Output star file")
+    add('--distance', metavar="pixels", type=float, default=5,
+        help="Largest distance of matched particles, in pixels of the input file (default: 5)")
+    add('--scale', metavar="factor", type=float, default=1.0,
+        help="Multiplication factor of the reference coordinates (default: 1)")
+    add('--columns', metavar="label", nargs='+',
+        help="Reference columns written (replaced if present in the input; default: the reference columns "
+             "absent in the input)")
+    args = parser.parse_args()
+
+    parser.print_help()
+    if not args.distance > 0 or not args.scale > 0:
+        print("\n => ERROR! Check your input: --distance and --scale should be positive")
+        sys.exit(2)
+    columns = None if args.columns is None else [c if c[:1] == "_" else "_" + c for c in args.columns]
+    try:
+        join_star(args.i, args.ref, args.o, args.distance, args.scale, columns)
+    except ValueError as e:
+        print("\n => ERROR! %s" % e)
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import sys
+from pathlib import Path
+from util.star_diff import diff_star
+from util.star_helper import KEY_COLUMNS
+from util.star_registry import star_header
+
+PROG = Path(__file__).name
+VER = 20261017
+UNDERLINE = ("=" * 70) + ("=" * (len(PROG) + 2))  # line for the output
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+star_diff.py compares two versions of a star file (e.g. particles.star before and after a Select or Subset job)
+row by row: rows are matched by their key (_rlnImageName for particles, _rlnMicrographName for micrographs)
+and reported as added, removed or changed (any compared value differs).
+
+Note:
+ - The files are streamed: about 16 bytes per row are kept in memory, so multi-million-row files can be compared
+ - Numbers are compared by value (1.0 and 1.000000 are equal)
+ - Repeated keys (symmetry-expanded particles) are matched in their order in the files
+
+{VER}
+
+Example: star_diff.py --i Select/job010/particles.star Select/job020/particles.star --o job010_vs_job020
+         star_diff.py --i old.star new.star --o diff --columns _rlnClassNumber _rlnDefocusU
+
+Pavel Afanasyev
+https://github.com/afanasyevp/cryoem_tools/
+ {UNDERLINE}'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--i', required=True, metavar="file", nargs=2,
+        help="Old and new star files")
+    add('--o', metavar="prefix",
+        help="Writes prefix_added.star (rows of the new file), prefix_removed.star (rows of the old file) "
+             "and prefix_changed.star (new versions of the changed rows); without --o only the counts are reported")
+    add('--key', metavar="label",
+        help="Column identifying a row, with or without the leading _ "
+             "(default: _rlnImageName for particles, _rlnMicrographName for micrographs)")
+    add('--columns', metavar="label", nargs='+',
+        help="Columns compared, with or without the leading _ (default: all columns present in both files)")
+    args = parser.parse_args()
+
+    parser.print_help()
+    old_file, new_file = args.i
+    key = args.key or KEY_COLUMNS.get(star_header(new_file)[0])
+    if key is None:
+        print("\n => ERROR! Unknown star-file type of %s: please indicate the key column (--key)" % new_file)
+        sys.exit(2)
+    # labels with or without the leading "_"
+    key = key if key[:1] == "_" else "_" + key
+    columns = None if args.columns is None else [c if c[:1] == "_" else "_" + c for c in args.columns]
+    try:
+        diff_star(old_file, new_file, key, columns, args.o)
+    except ValueError as e:
+        print("\n => ERROR! %s" % e)
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,33 +18,36 @@ from pathlib import Path, PurePath
 import sys
 import re
 import os
+import numpy as np
+from util.star_helper import KEY_COLUMNS, compression, open_star
+from util.star_registry import cached, star_header, load_star
+from util.star_join import path_stem, semi_join
+from util.star_cache import DEFAULT_CACHE_DIR
+from util.star_query import Query, filter_star
+from util.star_groups import GROUP_COLUMN, cap_groups, group_codes, min_count, top_groups, write_histogram
+from util.star_spatial import dedup_block
+from util.star_sets import KeySet, SetExpression, operand_name, select_block, select_star
 
 PROG = Path(__file__).name
 VER = 20240417
 UNDERLINE = ("=" * 70) + ("=" * (len(PROG) + 2))  # line for the output
 
-def input_analyse(filename):
+def sniff_input_type(filename):
     # for an input files retuns its type: "particles_star", "micrographs_star", "micrographs_coarsened_star", "micrographs_txt", "unknown"
+    # only the header (and the first row) of a star file is read
     inputType = 'unknown_inputType'
     if filename[-5:] == ".star":
-        MainHeader, OpticsGroupData, OpticsHeader, StarData, StarFileType = star_analyze(
-            filename, 10000)
-        #print("MainHeader:", MainHeader)
-        #print("OpticsGroupData:", OpticsGroupData)
-        #print("OpticsHeader:", OpticsHeader)
-        #print("StarData", StarData)
-        #print("StarFileType", StarFileType)
+        StarFileType, MainHeader, first_row = star_header(filename)
         if StarFileType == "particles":
             inputType = "particles_star"
         elif StarFileType == "micrographs":
             #print(len(MainHeader))
-            if len(MainHeader) == 3:
-                random_kv = StarData.popitem()  # randomly picks one key, value
-                # checks of k has a coarsening factor in the micrograph name
-                match = re.search(r'(.+)(_c\d+)', random_kv[0])
-                if match:
-                    # print(match.group(2))
-                    inputType = "micrographs_coarsened_star"
+            if len(MainHeader) == 2:
+                # checks if the micrograph name has a coarsening factor
+                if first_row is not None and "_rlnMicrographName" in MainHeader:
+                    match = re.search(r'(.+)(_c\d+)', first_row[MainHeader["_rlnMicrographName"] - 1])
+                    if match:
+                        inputType = "micrographs_coarsened_star"
             else:
                 inputType = "micrographs_star"
         else:
@@ -52,155 +55,152 @@ def input_analyse(filename):
     else:
         print("\n => WARNING: Unknown file-type of the %s file is used: will be considered as a list of micrographs" % filename)
         inputType = "micrographs_txt"
-    # print(inputType)
     return inputType
 
 
-def star_analyze(star_filename, lim=0):
-    '''
-    creates dicrionaries from the star files: 
-        OpticsHeader: everything starting with _rlnXXXX, corresponding to the data_optics section
-        "# version 30001
-        data_optics
-        loop_
-        _rlnOpticsGroupName #1" etc
-        OpticsGroupData:  all the data after the previous section like:  
-        "opticsGroup1           1     0.43   300     2.7     0.1"
-
-        MainHeader:  everything starting with _rlnXXXX, corresponding to the data_movies or data_particles section
-        "# version 30001
-        data_particles
-        loop_
-        _rlnCoordinateX #1"
-
-        StarData:  main data (alignments data for particles.star) after the previous section like:   
-        "mov1.tiff 25" (movies.star) or "3.43 6.2 0.1 10 8.2 000001@Extract/job044/Micro/mov1.mrcs MotionCorr/job034 /Micro/mov1.mrc 1 0.1 6.1 6.4 44.8 0.0 1.0 0.0 " (particles.star)
-
-    lim argument is used to limit the number of analysed lines (in bytes)
+def input_analyse(filename):
+    "Type of the input file (see sniff_input_type), analysed once per run"
+    return cached(filename, "inputType", sniff_input_type)
+
+
+def read_selection(filename):
+    "Returns the list of names (micrograph stems or particle names) to extract/exclude from a file of any input type"
+    inputType = input_analyse(filename)
+    if inputType == "micrographs_coarsened_star":
+        return export_from_coarsened_file(filename)
+    elif inputType == "micrographs_star":
+        return [path_stem(k) for k in selection_keys(filename)]
+    elif inputType == "particles_star":
+        return selection_keys(filename)
+    elif inputType == "micrographs_txt":
+        return export_from_txt_file(filename)
+    return None
+
+
+def selection_keys(filename):
+    "Unique values of the key column of a star file; only this column is read (projection)"
+    key_label = KEY_COLUMNS.get(star_header(filename)[0])
+    table = load_star(filename, columns=[key_label])
+    return table.data_block.unique(key_label).astype(str).tolist()
 
+
+def selection_names(filename):
+    "Names to extract/exclude from the file (see read_selection): the key column of each input is materialized once per run"
+    return cached(filename, "names", read_selection)
+
+
+def select_rows(table, selection, exclude=False, label=None, stem=False):
     '''
-    # optics header dictionaries
-    OpticsHeader = {}
-    OpticsGroupData = {}
-    # main header dictionaries
-    MainHeader = {}
-    StarData = {}
-    with open(star_filename, 'r') as star_file:
-        if lim == 0:
-            lines = star_file.readlines()
-        else:
-            # to limit the number of analysed lines in bytes
-            lines = star_file.readlines(lim)
-    # create OpticsHeader and OpticGroupData dictionary
-    for line in lines[:]:
-        # print(line)
-        star_line = line.split()
-        #print("splitline:", star_line)
-        if len(star_line) > 0:
-            if line[:10] == "# version ":
-                OpticsHeader['# version'] = star_line[2]
-                # print("version:", OpticsHeader['# version'])
-            elif line[:5] == "loop_":
-                continue
-            elif line[:11] == "data_optics":
-                #print("Data_optics found!")
-                continue
-            elif line[:4] == "_rln":
-                OpticsHeader[star_line[0]] = int(star_line[1][1:])
-            elif line[:11] == "opticsGroup":
-                OpticsGroupData[star_line[0]] = line[:-1]
-                # print(OpticsGroupData)
-            elif line[:5] == "data_":
-                data_type = line[:-1].split("_")[1]
-                #print("Data_%s found!" %data_type)
-                lines.pop(0)
-                break
-            else:
-                continue
-        lines.pop(0)
-    if '# version' not in OpticsHeader.keys():
-        OpticsHeader['# version'] = "unknown"
-    # create MainHeader dictionary with the main Header
-    for line in lines[:]:
-        star_line = line.split()
-        if len(star_line) > 0:
-            if line[:10] == "# version ":
-                MainHeader['# version'] = star_line[2]
-            elif line[:5] == "data_":
-                data_type = line[:-1].split("_")[1]
-                #print("Data_%s found!" %data_type)
-                continue
-            elif line[:5] == "loop_":
-                continue
-            elif line[:4] == "_rln":
-                MainHeader[star_line[0]] = int(star_line[1][1:])
-                if line[:24] == "_rlnMicrographMovieName ":
-                    _rlnMicrographMovieName_index = int(
-                        star_line[-1].split("#")[-1])
-                    # print("_rlnMicrographMovieName_index", star_line[-1].split("#")[-1])
-                elif line[:19] == "_rlnMicrographName ":
-                    _rlnMicrographName_index = int(
-                        star_line[-1].split("#")[-1])
-                    # print("_rlnMicrographName_index", star_line[-1].split("#")[-1])
-                elif line[:14] == "_rlnImageName ":
-                    _rlnImageName_index = int(star_line[-1].split("#")[-1])
-                    # print("_rlnImageName_index", star_line[-1].split("#")[-1])
-            else:
-                # create main StarData dictionary, where the key is the main header
-                # identifier is  micrograph/movie/particle name
-                if data_type == "micrographs":
-                    StarData[star_line[(
-                        _rlnMicrographName_index-1)]] = star_line
-                elif data_type == "movies":
-                    StarData[star_line[(
-                        _rlnMicrographMovieName_index-1)]] = star_line
-                elif data_type == "particles":
-                    StarData[star_line[(_rlnImageName_index-1)]] = star_line
-                    continue
-                else:
-                    print("\n => ERROR in %s file: no data type found in the %s file!" % (
-                        star_filename, star_filename))
-                    sys.exit(2)
-                #print("break at:", line)
-                # break
-        lines.pop(0)
-    if '# version' not in MainHeader.keys():
-        MainHeader['# version'] = "unknown"
-    StarFileType = data_type
-    #print("MainHeader: ", MainHeader, "\n")
-    #print("StarData dictionary: ", StarData, "\n")
-    #print("OpticsGroupData", OpticsGroupData, "\n")
-    #print("OpticsHeader: ", OpticsHeader, "\n")
-    return MainHeader, OpticsGroupData, OpticsHeader, StarData, StarFileType
-
-
-def extract_from_dict(StarData, list_to_extract):
-    # returns new dictionary with keys matching those in the list. Distinguishes particles from micrographs by "@"
-    if "@" in list_to_extract[0]:
-        return ({k: v for k, v in StarData.items() if k in list_to_extract})
+    Extracts (or excludes with exclude=True) the rows of the main block of the table whose names are in the selection.
+    Without label, distinguishes particles (full _rlnImageName) from micrographs (stem of _rlnMicrographName) by "@";
+    otherwise the names are compared with the values (stem=True: their stems) of the column label.
+    All rows with a selected name are kept, also duplicates (symmetry-expanded particles): see semi_join (util/star_join.py)
+    '''
+    block = table.data_block
+    selection = set(selection)
+    start_time = time.time()
+    if label is not None:
+        if label not in block:
+            print("\n => ERROR! Column %s is not found in data_%s of the %s file" % (label, block.name, table.filename))
+            sys.exit(2)
+        mask = semi_join(block, label, selection, stem=stem)
+    elif len(selection) > 0 and "@" in next(iter(selection)):
+        if "_rlnImageName" not in block:
+            print("\n => ERROR! Particle names are given, but %s has no _rlnImageName column" % table.filename)
+            sys.exit(2)
+        mask = semi_join(block, "_rlnImageName", selection)
     else:
-        return ({k: v for k, v in StarData.items() if Path(k).stem in list_to_extract})
+        label = "_rlnMicrographName" if "_rlnMicrographName" in block else table.key_label
+        mask = semi_join(block, label, selection, stem=True)
+    if exclude:
+        mask = ~mask
+    table.blocks[block.name] = block.take(mask)
+    seconds = max(time.time() - start_time, 1e-6)
+    print(" => %d of %d rows kept (%.2f s, %.0f rows/s)" % (mask.sum(), len(mask), seconds, len(mask) / seconds))
+
+
+def filter_rows(table, expression):
+    "Keeps the rows of the main block of the table passing the filter expression (util/star_query.py)"
+    block = table.data_block
+    start_time = time.time()
+    try:
+        mask = Query(expression).mask(block)
+    except ValueError as e:
+        print("\n => ERROR! %s" % e)
+        sys.exit(2)
+    table.blocks[block.name] = block.take(mask)
+    seconds = max(time.time() - start_time, 1e-6)
+    print(" => %d of %d rows kept (%.2f s, %.0f rows/s)" % (mask.sum(), len(mask), seconds, len(mask) / seconds))
 
 
-def exclude_from_dict(StarData, list_to_exclude):
-    # returns new dictionary without keys matching those in the list
-    # slower solution:
-    # for i in list_of_binned_micrographs:
-    #    for k,v in list(StarData.items()):
-    #            if i in k: del(StarData[k])§
-    if "@" in list_to_exclude[0]:
-        return ({k: v for k, v in StarData.items() if k not in list_to_exclude})
-    else:
-        return ({k: v for k, v in StarData.items() if Path(k).stem not in list_to_exclude})
+def group_rows(table, min_per_mic=None, top_mics=None, max_per_mic=None, sample_per_mic=None, seed=None,
+               dedup=None, dedup_score=None):
+    '''
+    Per-micrograph selection of the rows of the main block (util/star_groups.py), in this order: duplicates closer than
+    dedup pixels removed (util/star_spatial.py), micrographs with at least min_per_mic rows, the top_mics micrographs with most rows, at most max_per_mic (first) or sample_per_mic (random) rows each
+    '''
+    block = table.data_block
+    start_time = time.time()
+    if GROUP_COLUMN not in block:
+        print("\n => ERROR! Column %s is not found in data_%s of the %s file" % (GROUP_COLUMN, block.name, table.filename))
+        sys.exit(2)
+    codes = group_codes(block)[1]
+    rows = np.arange(len(block))
+    if dedup is not None:
+        try:
+            rows = rows[dedup_block(block, dedup, dedup_score)]
+        except ValueError as e:
+            print("\n => ERROR! %s of the %s file" % (e, table.filename))
+            sys.exit(2)
+        print(" => %d duplicates closer than %g pixels removed" % (len(block) - len(rows), dedup))
+    # every step works on the rows left by the previous one (the rows are grouped once)
+    if min_per_mic is not None:
+        rows = rows[min_count(codes[rows], min_per_mic)]
+    if top_mics is not None:
+        rows = rows[top_groups(codes[rows], top_mics)]
+    if max_per_mic is not None:
+        rows = rows[cap_groups(codes[rows], max_per_mic)]
+    if sample_per_mic is not None:
+        rows = rows[cap_groups(codes[rows], sample_per_mic, True if seed is None else seed)]
+    mask = np.zeros(len(block), dtype=bool)
+    mask[rows] = True
+    table.blocks[block.name] = block.take(mask)
+    seconds = max(time.time() - start_time, 1e-6)
+    print(" => %d of %d rows kept (%.2f s, %.0f rows/s)" % (mask.sum(), len(mask), seconds, len(mask) / seconds))
+
+
+def read_sets(arguments, key=None):
+    '''
+    KeySets of the --sets arguments "NAME=file" (or just "file": named A, B, C... by position).
+    Particle selections are compared with _rlnImageName, micrograph selections with the stem of _rlnMicrographName
+    (key: another column)
+    '''
+    sets = {}
+    for i, argument in enumerate(arguments):
+        match = re.match(r'([A-Za-z_][A-Za-z0-9_]*)=(.+)$', argument)
+        name, filename = (match.group(1), match.group(2)) if match else (operand_name(i), argument)
+        if name in sets:
+            print("\n => ERROR! Set %s is given twice in --sets" % name)
+            sys.exit(2)
+        if not os.path.exists(filename):
+            print("\n => ERROR! File %s of set %s is not found" % (filename, name))
+            sys.exit(2)
+        inputType = input_analyse(filename)
+        if inputType == "unknown_inputType":
+            print("\n => ERROR in the analysis of the --sets input %s! inputType is not detected" % filename)
+            sys.exit(2)
+        stem = inputType.startswith("micrographs")
+        label = key or ("_rlnMicrographName" if stem else "_rlnImageName")
+        sets[name] = KeySet(name, selection_names(filename), label, stem=stem, filename=filename)
+        print(" => Set %s: %d %s from %s" % (name, len(sets[name]), inputType.split("_")[0], filename))
+    return sets
 
 
 def export_from_coarsened_file(star_filename):
     # Operates on the output from Select jobs: extracts only basenames of the micrographs and returns a list of those without path or extension
     #print("\n => Analysing %s file"% star_filename)
     list_of_micrographs = []
-    MainHeader, OpticsGroupData, OpticsHeader, StarData, StarFileType = star_analyze(
-        star_filename)
-    for i in StarData.keys():
+    for i in selection_keys(star_filename):
         # returns the stem of the micrograph name (no path, with extension)
         temp = PurePath(i).name
         match = re.search(r'(.+)(_c\d+.mrc)', temp)
@@ -218,53 +218,21 @@ def export_from_txt_file(txt_micrographs_filename):
     # opens txt_micrographs file and returns a list with stem-names; no extensions
     print("\n => Analysing %s file" % txt_micrographs_filename)
     list_of_micrographs = []
-    with open(txt_micrographs_filename, 'r') as txt_file:
+    with open_star(txt_micrographs_filename) as txt_file:
         lines = txt_file.readlines()
     for line in lines[:]:
         if len(line) != 1:
             # returns the stem of the micrograph name (no path, no extension)
-            temp = Path(line).stem
+            temp = Path(line.strip()).stem
             list_of_micrographs.append(temp)
     return list_of_micrographs
 
 
-def write_out_star(MainHeader, OpticsGroupData, OpticsHeader, StarData, StarFileType, Output):
-    "Writes out the modified star file"
+def write_out_list(table, Output):
+    "Writes out the list of unique micrographs (movies, particles) from the key column of the main block of the table"
     with open(Output, "w") as outputFile:
-        outputFile.write('''
-# version %s
-data_optics
-loop_ 
-''' % OpticsHeader['# version'])
-        OpticsHeader_output = OpticsHeader
-        OpticsGroupData_output = OpticsGroupData
-        relionVersion = OpticsHeader_output.pop("# version")
-        for k, v in sorted(OpticsHeader_output.items(), key=lambda item: item[1]):
-            outputFile.write("%s #%s \n" % (k, v))
-        for k, v in sorted(OpticsGroupData_output.items(), key=lambda item: item[1][1]):
-            outputFile.write("%s\n" % v)
-        outputFile.write('''
-# version %s
-data_%s
-loop_ 
-''' % (relionVersion,  StarFileType))
-        MainHeader.pop("# version")
-        #print("MainHeader:", sorted(MainHeader.items()))
-        for k, v in sorted(MainHeader.items(), key=lambda item: item[1]):
-            outputFile.write("%s #%s \n" % (k, v))
-        for k, v in StarData.items():
-            for item in v:
-                outputFile.write("%s " % item)
-            outputFile.write("\n")
-        outputFile.write("\n")
-    print(" => %s created!" % Output)
-
-
-def write_out_list(StarData, Output):
-    "Writes out the list of micrographs from the input dictionary"
-    with open(Output, "w") as outputFile:
-        for k, v in StarData.items():
-            outputFile.write("%s\n" % Path(k).name)
+        for k in table.data_block.unique(table.key_label).tolist():
+            outputFile.write("%s\n" % Path(k.decode()).name)
         outputFile.write("\n")
     print(" => %s created!" % Output)
 
@@ -282,15 +250,18 @@ exctracting/excluding micrographs (for now micrographs only) by performing searc
 the micrograph name
 
 Note:
- - The script will not operate properly on symmetry-expanded particles 
-   (only unique particles will be considered)
+ - All rows with a selected name are kept/excluded, also duplicates (symmetry-expanded particles)
  - The script works with files from Relion 3.1 version
+ - gzip/xz/bz2-compressed star files are read directly; the output is compressed if its name ends with .gz, .xz or .bz2
  - Modify the first line of the script to change the location of the python execultable to 
 the installed Anaconda's python 
 
 {VER}
 
 Example: star_modif.py --i particles.star --o particles_new.star --exclude micrographs.star
+         star_modif.py --i particles.star --o particles_good.star --filter "rlnCtfMaxResolution < 4"
+         star_modif.py --i particles.star --o particles_nodup.star --dedup 40
+         star_modif.py --i particles.star --o particles_new.star --sets A=sel1.star B=sel2.star C=bad.txt --expr "(A | B) - C"
 
 Written and tested in python3.8.5
 Pavel Afanasyev
@@ -302,30 +273,122 @@ https://github.com/afanasyevp/cryoem_tools/
     add('--i', required=True, metavar="file", nargs=1,
         help="Input file: micrographs_ctf.star or particles.star")
     add('--o', metavar="file", required=True, nargs=1,
-        help="Output file: micrographs_new.star or particles_new.star")
+        help="Output file: micrographs_new.star or particles_new.star (.star.gz, .star.xz, .star.bz2: compressed)")
     add('--extract', metavar="file", nargs='+',
         help="File(s) with micrograph names to extract")
     add('--exclude', metavar="file", nargs='+',
         help="File(s) with micrograph names to exclude")
+    add('--filter', metavar="expression",
+        help="Keeps only the rows passing the filter, e.g. \"rlnCtfMaxResolution < 4 and rlnDefocusU between 8000 and 25000\" "
+             "or \"rlnClassNumber in {3, 7}\" (comparisons < <= > >= == != between in, combined with and/or/not)")
+    add('--key', metavar="label",
+        help="Column compared with the names to extract/exclude (default: _rlnImageName for particles, "
+             "otherwise the stem of _rlnMicrographName); stems are compared for lists of micrographs")
+    add('--sets', metavar="NAME=file", nargs='+',
+        help="Selection files used in --expr, e.g. A=job010/particles.star B=job011/micrographs.star "
+             "(without NAME= they are called A, B, C... in their order)")
+    add('--expr', metavar="expression",
+        help="Set expression over the --sets files, e.g. \"(A | B) - C & D\": | union, & intersection, - difference, "
+             "^ symmetric difference; the input file is read once")
+    add('--min_per_mic', metavar="N", type=int,
+        help="Keeps only the micrographs with at least N particles")
+    add('--top_mics', metavar="K", type=int,
+        help="Keeps only the K micrographs with most particles")
+    add('--max_per_mic', metavar="N", type=int,
+        help="Keeps at most N particles per micrograph (the first ones in the file)")
+    add('--sample_per_mic', metavar="N", type=int,
+        help="Keeps at most N particles per micrograph picked at random (see --seed)")
+    add('--seed', metavar="int", type=int,
+        help="Seed of the random generator of --sample_per_mic (default: random)")
+    add('--dedup', metavar="pixels", type=float,
+        help="Removes duplicate picks: of the particles of a micrograph closer than this distance (_rlnCoordinateX/Y) "
+             "only the one with the highest --dedup_score is kept")
+    add('--dedup_score', metavar="label",
+        help="Column with the score of the particles for --dedup (default: _rlnAutopickFigureOfMerit if present, "
+             "otherwise the first particle in the file is kept)")
+    add('--mic_histogram', action="store_true",
+        help="Returns a histogram of the number of particles per micrograph of the input star file or the resulting one")
     add('--list_of_micro', action="store_true",
         help="Returns just a list of unique micrographs from the input star file or the resulting one")
     add('--list_of_micro_unbinned', action="store_true",
         help="Returns just a list of unique unbinned micrographs from the input star file or the resulting one")
+    add('--cache', metavar="dir", nargs='?', const=DEFAULT_CACHE_DIR,
+        help="Keep a binary copy of the parsed input file in the cache folder (default: %s) to open it faster next time" % DEFAULT_CACHE_DIR)
+    add('--j', metavar="N", type=int, default=1,
+        help="Number of processes used to parse a large input file (default: 1)")
     args = parser.parse_args()
 
     parser.print_help()
+    grouping = any(value is not None for value in (args.min_per_mic, args.top_mics, args.max_per_mic, args.sample_per_mic,
+                                                   args.dedup))
+    if args.dedup is not None and not args.dedup > 0:
+        print("\n => ERROR!!! Check your input: --dedup should be a positive distance")
+        sys.exit(2)
+    if args.max_per_mic is not None and args.sample_per_mic is not None:
+        print("\n => ERROR!!! Check your input: only one option (--max_per_mic or --sample_per_mic) can be used")
+        sys.exit(2)
     if args.extract and args.exclude:
         print("\n => ERROR!!! Check your input: only one option (--extract or --exclude can be used)")
         sys.exit(2)
 
+    # set algebra over many selection files: the input file is streamed once
+    if args.sets or args.expr:
+        if not (args.sets and args.expr) or args.extract or args.exclude:
+            print("\n => ERROR!!! Check your input: --sets and --expr are used together, without --extract/--exclude")
+            sys.exit(2)
+        try:
+            expression = SetExpression(args.expr)
+            sets = read_sets(args.sets, args.key)
+            query = Query(args.filter) if args.filter else None
+            print("\n => Selecting: %s" % args.expr)
+            if compression(args.i[0]) is None and not args.list_of_micro and not grouping and not args.mic_histogram:
+                select_star(args.i[0], expression, sets, args.o[0], query)
+                return
+            table = load_star(args.i[0], args.cache, args.j)
+            mask, summary = select_block(table.data_block, expression, sets, query)
+        except ValueError as e:
+            print("\n => ERROR! %s" % e)
+            sys.exit(2)
+        summary.print()
+        table.blocks[table.data_block.name] = table.data_block.take(mask)
+        if grouping:
+            group_rows(table, args.min_per_mic, args.top_mics, args.max_per_mic, args.sample_per_mic, args.seed,
+                       args.dedup, args.dedup_score)
+        table.write(args.o[0])
+        if args.list_of_micro:
+            write_out_list(table, check_outputname(args.o[0])[0] + "_micrographs.txt")
+        if args.mic_histogram:
+            write_histogram(group_codes(table.data_block)[1], check_outputname(args.o[0])[0] + "_per_micrograph.txt")
+        return
+
+    # case 0: only a filter: the input file is streamed, the selected rows are copied verbatim
+    if args.filter and args.extract == None and args.exclude == None and not args.list_of_micro \
+            and not grouping and not args.mic_histogram and compression(args.i[0]) is None:
+        print("\n => Filtering: %s" % args.filter)
+        try:
+            filter_star(args.i[0], args.filter, args.o[0])
+        except ValueError as e:
+            print("\n => ERROR! %s" % e)
+            sys.exit(2)
+        return
+
     # case 1: simple modification of args.i only
-    if args.extract == None and args.exclude == None:
+    if args.extract == None and args.exclude == None and not args.filter and not grouping:
         # output: just micrograph names
         # MotionCorr/job005/frames/FoilHole_20196805_Data_20193268_20193270_20220620_172317_fractions.mrc  => FoilHole_20196805_Data_20193268_20193270_20220620_172317_fractions.mrc
         if args.list_of_micro:
             print("\n => Writing out the list of unique micrographs")
-            MainHeader, OpticsGroupData, OpticsHeader, StarData, StarFileType = star_analyze(args.i[0])
-            write_out_list(StarData, args.o[0])
+            write_out_list(load_star(args.i[0], args.cache, args.j), args.o[0])
+            sys.exit(2)
+        # output: number of particles per micrograph
+        elif args.mic_histogram:
+            print("\n => Writing out the histogram of the particles per micrograph")
+            table = load_star(args.i[0], args.cache, args.j)
+            try:
+                write_histogram(group_codes(table.data_block)[1], args.o[0])
+            except ValueError as e:
+                print("\n => ERROR! %s of the %s file" % (e, args.i[0]))
+                sys.exit(2)
             sys.exit(2)
         # output: unbinned micrograph names
         # MotionCorr/job005/frames/FoilHole_20196805_Data_20193268_20193270_20220620_172317_fractions_c8.mrc  =>
@@ -340,11 +403,9 @@ https://github.com/afanasyevp/cryoem_tools/
             sys.exit(2)
         else:
             print("\n => ERROR!!! Check your input: Please indicate an option (--extract or --exclude) and the file with locations to extract/exclude")
-            MainHeader, OpticsGroupData, OpticsHeader, StarData, StarFileType = star_analyze(
-                args.i[0])
             sys.exit(2)
 
-    MainHeader, OpticsGroupData, OpticsHeader, StarData, StarFileType = star_analyze(args.i[0])
+    table = load_star(args.i[0], args.cache, args.j)
 
     # check if the input types are the same: micrographs/particles
     list_of_inputTypes = []
@@ -381,78 +442,51 @@ https://github.com/afanasyevp/cryoem_tools/
                     sys.exit(2)
 
     if args.extract:
-        NewStarData = []
         list_to_extract = []
         for argExtr in args.extract:
             inputType = input_analyse(argExtr)
-            if inputType == "micrographs_coarsened_star":
-                list_to_extract = list_to_extract + \
-                    export_from_coarsened_file(argExtr)
-            elif inputType == "micrographs_star":
-                MainHeader_extr, OpticsGroupData_extr, OpticsHeader_extr, StarData_extr, StarFileType_extr = star_analyze(
-                    argExtr)
-                list_to_extract = list_to_extract + \
-                    [Path(k).stem for k, v in StarData_extr.items()]
-                # print(list_to_extract)
-            elif inputType == "particles_star":
-                MainHeader_extr, OpticsGroupData_extr, OpticsHeader_extr, StarData_extr, StarFileType_extr = star_analyze(
-                    argExtr)
-                list_to_extract = list_to_extract + \
-                    [k for k, v in StarData_extr.items()]
-                #print("list_to_extract:", list_to_extract)
-                #print("StarData_extr:", StarData_extr)
-            elif inputType == "micrographs_txt":
-                list_to_extract = list_to_extract + \
-                    export_from_txt_file(argExtr)
-            else:
+            if inputType == "unknown_inputType":
                 print(
                     "\n => ERROR in the analysis of the --extract input! inputType is not detected")
                 sys.exit(2)
+            list_to_extract = list_to_extract + selection_names(argExtr)
         print("\n => Extracting %d %s" %
               (len(list_to_extract), inputType.split("_")[0]))
-        NewStarData = extract_from_dict(StarData, list(set(list_to_extract)))
+        select_rows(table, list_to_extract, label=args.key, stem=inputType.startswith("micrographs"))
 
     if args.exclude:
-        NewStarData = []
         list_to_exclude = []
         for argExcl in args.exclude:
             inputType = input_analyse(argExcl)
-            #print(f"inputType: {inputType}")
-            if inputType == "micrographs_coarsened_star":
-                list_to_exclude = list_to_exclude + \
-                    export_from_coarsened_file(argExcl)
-            elif inputType == "micrographs_star":
-                MainHeader_excl, OpticsGroupData_excl, OpticsHeader_excl, StarData_excl, StarFileType_excl = star_analyze(
-                    argExcl)
-                list_to_exclude = list_to_exclude + \
-                    [Path(k).stem for k, v in StarData_excl.items()]
-                # print(list_to_exclude)
-            elif inputType == "particles_star":
-                MainHeader_excl, OpticsGroupData_excl, OpticsHeader_excl, StarData_excl, StarFileType_excl = star_analyze(
-                    argExcl)
-                list_to_exclude = list_to_exclude + \
-                    [k for k, v in StarData_excl.items()]
-            elif inputType == "micrographs_txt":
-                list_to_exclude = list_to_exclude + \
-                    export_from_txt_file(argExcl)
-            else:
+            if inputType == "unknown_inputType":
                 print(
                     "\n => ERROR in the analysis of the --exclude input! inputType is not detected")
                 sys.exit(2)
+            list_to_exclude = list_to_exclude + selection_names(argExcl)
         print("\n => Excluding %d %s" %
               (len(list_to_exclude), inputType.split("_")[0]))
-        NewStarData = exclude_from_dict(StarData, list(set(list_to_exclude)))
+        select_rows(table, list_to_exclude, exclude=True, label=args.key, stem=inputType.startswith("micrographs"))
 
-    write_out_star(MainHeader, OpticsGroupData, OpticsHeader,
-                   NewStarData, StarFileType, args.o[0])
+    if args.filter:
+        print("\n => Filtering: %s" % args.filter)
+        filter_rows(table, args.filter)
+
+    if grouping:
+        print("\n => Selecting per micrograph")
+        group_rows(table, args.min_per_mic, args.top_mics, args.max_per_mic, args.sample_per_mic, args.seed,
+                   args.dedup, args.dedup_score)
+
+    table.write(args.o[0])
 
     if args.list_of_micro:
         # create an additional file with micrograph filenames
         output_stem, output_suffix = check_outputname(args.o[0])
         list_of_micro_filename = output_stem+"_micrographs.txt"
         # print(list_of_micro_filename)
-        #print("NewStarData: ", NewStarData)
-        write_out_list(NewStarData, list_of_micro_filename)
+        write_out_list(table, list_of_micro_filename)
+
+    if args.mic_histogram:
+        write_histogram(group_codes(table.data_block)[1], check_outputname(args.o[0])[0] + "_per_micrograph.txt")
 
 
 if __name__ == '__main__':
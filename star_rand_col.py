@@ -13,44 +13,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # -*- coding: utf-8 -*-
 
-ver=230127
+ver=261017
 
-import random
 import argparse
 import sys
+import numpy as np
+from util.star_cache import DEFAULT_CACHE_DIR, load_cached
 
-def find_index(filename, column):
-    #For a given star file and index like "_CoordinateZ"  searches foe line "_CoordinateZ #3" and returns its index (=> 3 in this case)
-    with open(filename, "r") as f:
-	    lines=f.readlines(1024)
-    for line in lines:
-        line=line.strip()
-        if line.startswith("_"):
-            if column in line:
-                index=int(line.split()[-1].split("#")[-1])
-                break
-    return index
-
-def main(filename, column, range, output):
-    mainDataRead=False
-    ind_col=find_index(filename, column)
-    f2=open(output, "w")
-    with open(filename, "r") as f1:
-        lines=f1.readlines()
-    for line in lines:
-        line=line.strip()
-        if "data_particles" in line:
-            mainDataRead=True
-        if not line.startswith("_") and len(line.split()) > 4 and mainDataRead:
-            line=line.split()
-            #print("before", line)
-            line[ind_col-1]="%.2f" % (float(random.uniform(int(range[0]), int(range[1]))))
-            #print("after", line)
-            f2.write('  '.join(line) + "\n")
-        else:
-            f2.write(line+"\n")
-    f2.close()
-    print("File %s created" %output)
+def main(filename, column, range, output, cache=None, workers=1):
+    table=load_cached(filename, cache, workers=workers)
+    particles=table.data_block
+    if column not in particles:
+        print(" \n => ERROR! Column %s is not found in data_%s of the %s file" %(column, particles.name, filename))
+        sys.exit(2)
+    # one vectorized draw for the whole column, written with 2 decimals
+    particles[column]=np.random.uniform(int(range[0]), int(range[1]), len(particles))
+    particles.formats[column]="%.2f"
+    table.write(output)
             
 if __name__== '__main__':
     output_text='''
@@ -70,6 +49,8 @@ Example: ./star_rand_col.py  --i particles.star --o particles_rand_AngleRot.star
         help="Output particle_modified.star file ")
     add('--col', help="name of the column to modify, for example: _rlnAngleRot ")
     add('--range', nargs="+", default="-1 1", help="Range for random numbers space separated (integer numbers, for example: -1 1)")
+    add('--cache', metavar="dir", nargs='?', const=DEFAULT_CACHE_DIR, help="Keep a binary copy of the parsed input file in the cache folder (default: %s) to open it faster next time" % DEFAULT_CACHE_DIR)
+    add('--j', metavar="N", type=int, default=1, help="Number of processes used to parse a large input file (default: 1)")
     args = parser.parse_args()
     print(output_text)
     parser.print_help()
@@ -83,5 +64,5 @@ Example: ./star_rand_col.py  --i particles.star --o particles_rand_AngleRot.star
     if not args.range:
         print(" \n => ERROR! No input provided! Please find usage instruction above")
         sys.exit()
-    main(filename, column, range, output)
+    main(filename, column, range, output, args.cache, args.j)
     print(" => Program completed")
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import sys
+from pathlib import Path
+from util.star_validate import validate_files
+
+PROG = Path(__file__).name
+VER = 20261017
+UNDERLINE = ("=" * 70) + ("=" * (len(PROG) + 2))  # line for the output
+
+
+def main():
+    output_text = f'''
+{("=" * 35)} {PROG} {("=" * 35)}
+star_validate.py checks star files before they are given to Relion jobs: column numbers of the labels,
+number of fields of every row, truncated last lines and values of numeric Relion columns.
+The files are read once (gzip/xz/bz2-compressed files too); the line numbers of the first problems are reported.
+Exit status: 0 if all files are valid, 2 otherwise (e.g. star_validate.py --i particles.star && relion_refine ...)
+
+{VER}
+
+Example: star_validate.py --i Extract/job012/particles.star
+         star_validate.py --i */job*/particles.star --max 5
+
+Pavel Afanasyev
+https://github.com/afanasyevp/cryoem_tools/
+ {UNDERLINE}'''
+    print(output_text)
+    parser = argparse.ArgumentParser(description="")
+    add = parser.add_argument
+    add('--i', required=True, metavar="file", nargs='+',
+        help="Star file(s) to check")
+    add('--max', metavar="N", type=int, default=20,
+        help="Number of problems reported per file (default: 20)")
+    args = parser.parse_args()
+
+    if not validate_files(args.i, args.max):
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
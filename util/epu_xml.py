@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Beam shifts of the EPU .xml files of the movies (used by optics_split.py):
+
+    shifts = read_beam_shifts(xmlfiles, threads=16)    # (n, 2) array: BeamShift _x, _y of every file
+    shifts = cached_beam_shifts(xmlfiles, "./movies", "~/.cache/cryoem_tools")   # only new or changed files are read
+
+Every file is read in blocks only until the end of its first BeamShift element, which is found by a byte-level
+regular expression (no DOM is built); files are read by a pool of threads, so the latency of network storage
+overlaps. Files where the scan does not find the values are parsed with minidom as before.
+With a cache folder, the beam shifts of the files of a directory are kept in one .npz file
+(name, size, mtime and beam shift of every file): later runs read only the files which are new or changed.
+'''
+
+import hashlib
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xml.dom import minidom
+
+import numpy as np
+
+ver=20261017
+
+READ_BYTES = 1 << 14              # the files are read in blocks of this size until </BeamShift>
+THREADS = 16
+BEAM_SHIFT = re.compile(rb"<BeamShift[\s>/].*?</BeamShift\s*>", re.S)
+SHIFT_VALUE = {axis: re.compile(rb"<(?:[\w.-]+:)?%s>\s*([^<\s]+)\s*</" % axis) for axis in (b"_x", b"_y")}
+
+
+def dom_beam_shift(xmlfile):
+    "BeamShift (x, y) of an EPU .xml file through a minidom DOM of the whole file"
+    xmldoc = minidom.parse(xmlfile)
+    beamshift_items = xmldoc.getElementsByTagName("BeamShift")[0]
+    shiftx = beamshift_items.getElementsByTagName("a:_x")
+    shifty = beamshift_items.getElementsByTagName("a:_y")
+    return float(shiftx[0].childNodes[0].nodeValue), float(shifty[0].childNodes[0].nodeValue)
+
+
+def scan_beam_shift(xmlfile, read_bytes=READ_BYTES):
+    "BeamShift (x, y) of an EPU .xml file: the file is read only up to the end of the first BeamShift element"
+    text = b""
+    with open(xmlfile, "rb") as xml:
+        while True:
+            block = xml.read(read_bytes)
+            # the element may start in the previous block: search again from its possible start
+            start = text.rfind(b"<BeamShift")
+            if start < 0:
+                start = max(len(text) - len(b"<BeamShift"), 0)
+            text += block
+            element = BEAM_SHIFT.search(text, start)
+            if element or not block:
+                break
+    values = []
+    if element:
+        for axis in (b"_x", b"_y"):
+            value = SHIFT_VALUE[axis].search(element.group())
+            try:
+                values.append(float(value.group(1)))
+            except (AttributeError, ValueError):
+                break
+    if len(values) == 2:
+        return tuple(values)
+    try:
+        return dom_beam_shift(xmlfile)
+    except Exception as e:
+        raise ValueError("%s: no BeamShift found (%s)" % (xmlfile, e))
+
+
+def read_beam_shifts(xmlfiles, threads=THREADS, reader=scan_beam_shift, progress=True):
+    '''
+    Beam shifts of the .xml files as an (n, 2) array, in the order of the files; the files are read by threads threads
+    '''
+    shifts = np.empty((len(xmlfiles), 2))
+    start_time = time.time()
+
+    def read(index):
+        shifts[index] = reader(xmlfiles[index])
+
+    with ThreadPoolExecutor(max(threads, 1)) as pool:
+        for done, _ in enumerate(pool.map(read, range(len(xmlfiles))), 1):
+            if progress and done % 5000 == 0:
+                print(" %d of %d files read (%.0f files/s)" % (done, len(xmlfiles), done / (time.time() - start_time)))
+    return shifts
+
+
+def cache_file(cache_dir, directory):
+    "Cache file of the beam shifts of the .xml files of a directory"
+    name = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()[:20]
+    return os.path.join(os.path.expanduser(cache_dir), "beam_shifts_%s.npz" % name)
+
+
+def file_stats(files, threads=THREADS):
+    "(sizes, mtimes in ns) of the files, stat-ed by a pool of threads (slow on network storage)"
+    with ThreadPoolExecutor(max(threads, 1)) as pool:
+        stats = list(pool.map(os.stat, files))
+    return (np.array([stat.st_size for stat in stats], dtype=np.int64),
+            np.array([stat.st_mtime_ns for stat in stats], dtype=np.int64))
+
+
+def load_shift_cache(filename):
+    "Entries of a cache file: (names, sizes, mtimes, shifts); empty if there is no valid cache file"
+    try:
+        with np.load(filename) as cache:
+            if int(cache["version"]) == ver:
+                return cache["names"], cache["sizes"], cache["mtimes"], cache["shifts"]
+    except (OSError, KeyError, ValueError):
+        pass
+    return np.zeros(0, dtype="S1"), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 2))
+
+
+def save_shift_cache(filename, names, sizes, mtimes, shifts):
+    "Writes the cache file (to a temporary file first, renamed, so a half-written cache is never read)"
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = "%s.tmp%d.npz" % (filename[:-4], os.getpid())
+    np.savez(tmp, version=ver, names=names, sizes=sizes, mtimes=mtimes, shifts=shifts)
+    os.replace(tmp, filename)
+
+
+def cached_beam_shifts(xmlfiles, directory, cache_dir, threads=THREADS):
+    '''
+    read_beam_shifts() through the cache file of the directory: files with the name, size and mtime of a cache entry
+    are not read. The cache is rewritten with the current files if any file was read
+    '''
+    filename = cache_file(cache_dir, directory)
+    names = np.array([os.path.basename(xmlfile).encode() for xmlfile in xmlfiles])
+    sizes, mtimes = file_stats(xmlfiles, threads)
+    cached_names, cached_sizes, cached_mtimes, cached_shifts = load_shift_cache(filename)
+    shifts = np.empty((len(xmlfiles), 2))
+    found = np.zeros(len(xmlfiles), dtype=bool)
+    if len(cached_names) and len(names):
+        order = np.argsort(cached_names)
+        pos = np.minimum(np.searchsorted(cached_names[order], names), len(order) - 1)
+        entry = order[pos]
+        found = (cached_names[entry] == names) & (cached_sizes[entry] == sizes) & (cached_mtimes[entry] == mtimes)
+        shifts[found] = cached_shifts[entry[found]]
+    missing = np.flatnonzero(~found)
+    print(" %d of %d beam shifts taken from the cache %s" % (found.sum(), len(xmlfiles), filename))
+    if len(missing):
+        shifts[missing] = read_beam_shifts([xmlfiles[i] for i in missing], threads)
+        try:
+            save_shift_cache(filename, names, sizes, mtimes, shifts)
+        except OSError as e:
+            print(" => WARNING: the beam shifts are not cached: %s" % e)
+    return shifts
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Persistent binary cache of parsed star files (opt-in, see --cache of the scripts).
+
+Every cached star file gets a folder in the cache directory with one .npy file per column
+(dictionary-encoded string columns: int32 codes + unique values) and meta.json with the layout of the blocks.
+An entry is used only if the size, the mtime and the hash of the header of the star file are unchanged;
+its columns are memory-mapped (copy-on-write), so opening even a multi-GB star file takes milliseconds.
+The least recently used entries are deleted when the cache grows above max_bytes.
+
+    table = load_cached("particles.star", "~/.cache/cryoem_tools")
+'''
+
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+
+from util.star_table import StarBlock, StarTable, read_star
+
+ver=20261017
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cryoem_tools")
+CACHE_MAX_BYTES = 20 * 1024 ** 3     # the cache is trimmed to this size
+HEADER_BYTES = 1 << 16               # bytes of the star file hashed to validate an entry
+META = "meta.json"
+TMP_FOLDER = re.compile(r"\.tmp\d+$")  # entry being written by a run (see save_table)
+
+
+def header_hash(filename):
+    "sha1 of the first HEADER_BYTES of the file (optics block and labels of the main block)"
+    with open(filename, "rb") as star_file:
+        return hashlib.sha1(star_file.read(HEADER_BYTES)).hexdigest()
+
+
+def file_signature(filename):
+    "Identifies the version of a star file: absolute path, size, mtime and header hash"
+    stat = os.stat(filename)
+    return {"path": os.path.abspath(filename), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+            "header": header_hash(filename)}
+
+
+def entry_dir(cache_dir, filename):
+    "Folder of the cache entry of a star file"
+    name = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:20]
+    return os.path.join(os.path.expanduser(cache_dir), name)
+
+
+def save_table(table, folder, signature):
+    '''
+    Writes the columns of the table to the folder (written to a temporary folder first and renamed,
+    so a half-written entry is never read)
+    '''
+    tmp = "%s.tmp%d" % (folder, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    blocks = []
+    for i, block in enumerate(table.blocks.values()):
+        columns = []
+        for j, label in enumerate(block.ordered_labels()):
+            np.save(os.path.join(tmp, "%d_%d.npy" % (i, j)), block.columns[label])
+            categorical = label in block.categories
+            if categorical:
+                np.save(os.path.join(tmp, "%d_%d_cat.npy" % (i, j)), block.categories[label])
+            columns.append([label, block.labels[label], block.formats[label], categorical])
+        if block.original is not None:
+            with open(os.path.join(tmp, "%d_rows.bin" % i), "wb") as rows_file:
+                rows_file.write(block.original[0])
+        blocks.append({"name": block.name, "version": block.version, "loop": block.loop, "columns": columns,
+                       "original": block.original is not None})
+    with open(os.path.join(tmp, META), "w") as meta_file:
+        json.dump({"signature": signature, "blocks": blocks, "version": ver}, meta_file)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.rename(tmp, folder)
+
+
+def load_table(folder, filename):
+    "Builds the StarTable from a cache entry; the columns are memory-mapped"
+    with open(os.path.join(folder, META)) as meta_file:
+        meta = json.load(meta_file)
+    table = StarTable(filename)
+    for i, layout in enumerate(meta["blocks"]):
+        block = table.add_block(StarBlock(layout["name"], layout["version"], layout["loop"]))
+        for j, (label, number, fmt, categorical) in enumerate(layout["columns"]):
+            block.labels[label] = number
+            block.formats[label] = fmt
+            block.columns[label] = np.load(os.path.join(folder, "%d_%d.npy" % (i, j)), mmap_mode="c")
+            if categorical:
+                block.categories[label] = np.load(os.path.join(folder, "%d_%d_cat.npy" % (i, j)))
+        if layout.get("original"):
+            with open(os.path.join(folder, "%d_rows.bin" % i), "rb") as rows_file:
+                block.keep_original(rows_file.read())
+    return table
+
+
+def read_signature(folder):
+    "Signature stored in a cache entry, None if there is no valid entry"
+    try:
+        with open(os.path.join(folder, META)) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != ver:
+        return None
+    return meta.get("signature")
+
+
+def folder_size(folder):
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+
+def evict(cache_dir, max_bytes=CACHE_MAX_BYTES, keep=None):
+    '''
+    Deletes the least recently used entries (mtime of meta.json is updated at every use)
+    until the cache takes at most max_bytes. The entry "keep" is never deleted, nor the <entry>.tmpPID folders
+    of the runs still writing an entry
+    '''
+    cache_dir = os.path.expanduser(cache_dir)
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if not entry.is_dir() or TMP_FOLDER.search(entry.name):
+            continue
+        meta = os.path.join(entry.path, META)
+        used = os.stat(meta).st_mtime if os.path.exists(meta) else 0
+        entries.append((used, entry.path, folder_size(entry.path)))
+    total = sum(size for used, path, size in entries)
+    for used, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        print(" => cache: %s removed (%.0f MB)" % (path, size / 1024 ** 2))
+
+
+def load_cached(filename, cache_dir=None, max_bytes=CACHE_MAX_BYTES, workers=1, columns=None):
+    '''
+    read_star() through the cache: returns the cached table if the star file has not changed,
+    otherwise parses the file (with workers processes) and stores it in the cache. Without cache_dir it is just read_star().
+    columns: read only these columns (see read_star); a projected table is taken from the cache but never stored
+    '''
+    if not cache_dir:
+        return read_star(filename, workers, columns)
+    folder = entry_dir(cache_dir, filename)
+    signature = file_signature(filename)
+    if read_signature(folder) == signature:
+        os.utime(os.path.join(folder, META))
+        table = load_table(folder, filename)
+        return table if columns is None else table.select(columns)
+    if columns is not None:
+        return read_star(filename, workers, columns)
+    table = read_star(filename, workers)
+    try:
+        os.makedirs(os.path.expanduser(cache_dir), exist_ok=True)
+        save_table(table, folder, signature)
+        evict(cache_dir, max_bytes, keep=folder)
+    except OSError as e:
+        print(" => WARNING: %s is not cached: %s" % (filename, e))
+    return table
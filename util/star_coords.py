@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Particle coordinates of star files as array operations on a StarTable (util/star_table.py):
+
+    table = read_star("particles.star")
+    recenter(table)          # _rlnCoordinateX/Y moved by the origins, origins set to 0
+
+The pixel size of every row is looked up in data_optics through an array indexed by _rlnOpticsGroup.
+'''
+
+import numpy as np
+
+ver=20261017
+
+COORDINATES = ("_rlnCoordinateX", "_rlnCoordinateY")
+ORIGINS_ANGST = ("_rlnOriginXAngst", "_rlnOriginYAngst")
+ORIGINS = ("_rlnOriginX", "_rlnOriginY")              # Relion 3.0: pixels
+MICROGRAPH_PIXEL_SIZE = "_rlnMicrographPixelSize"   # coordinates are in pixels of the micrographs
+
+
+def optics_lookup(table, label, block=None):
+    '''
+    Value of a data_optics column for every row of block (default: the main block), through an array
+    indexed by _rlnOpticsGroup
+    '''
+    block = table.data_block if block is None else block
+    optics = table.optics
+    if optics is None or label not in optics or "_rlnOpticsGroup" not in optics:
+        raise ValueError("column %s is not found in data_optics" % label)
+    if "_rlnOpticsGroup" not in block:
+        raise ValueError("column _rlnOpticsGroup is not found in data_%s" % block.name)
+    groups = optics["_rlnOpticsGroup"].astype(np.int64)
+    rows = block["_rlnOpticsGroup"].astype(np.int64)
+    lookup = np.full(max(groups.max(), rows.max()) + 1, np.nan)
+    lookup[groups] = optics[label]
+    values = lookup[rows]
+    unknown = np.isnan(values)
+    if unknown.any():
+        raise ValueError("optics groups %s of data_%s are not found in data_optics"
+                         % (", ".join(map(str, np.unique(rows[unknown])[:10])), block.name))
+    return values
+
+
+def recenter(table, rounding=False, pixel_size=None):
+    '''
+    Moves the particle coordinates of the main block by their origins (as Relion does when re-extracting with
+    re-centering): X - _rlnOriginXAngst / micrograph pixel size, or X - _rlnOriginX for Relion 3.0 files.
+    The micrograph pixel size is pixel_size if given, otherwise _rlnMicrographPixelSize of the optics group
+    (_rlnImagePixelSize is the size of the extracted, possibly binned, pixels: it is not used).
+    The origins are set to 0; rounding=True rounds the new coordinates to whole pixels. Returns the block
+    '''
+    block = table.data_block
+    missing = [label for label in COORDINATES if label not in block]
+    if missing:
+        raise ValueError("columns %s are not found in data_%s" % (", ".join(missing), block.name))
+    if all(label in block for label in ORIGINS_ANGST):
+        origins = ORIGINS_ANGST
+        if pixel_size is not None and pixel_size <= 0:
+            raise ValueError("the pixel size of the micrographs must be positive, not %g" % pixel_size)
+        if pixel_size is None:
+            if table.optics is None or MICROGRAPH_PIXEL_SIZE not in table.optics:
+                raise ValueError("column %s is not found in data_optics: give the pixel size of the micrographs"
+                                 % MICROGRAPH_PIXEL_SIZE)
+            pixel_size = optics_lookup(table, MICROGRAPH_PIXEL_SIZE, block)
+    elif all(label in block for label in ORIGINS):
+        origins = ORIGINS
+        pixel_size = 1.0
+    else:
+        raise ValueError("columns %s are not found in data_%s" % (" and ".join(ORIGINS_ANGST), block.name))
+    for coordinate, origin in zip(COORDINATES, origins):
+        values = numbers(block, coordinate) - numbers(block, origin) / pixel_size
+        if rounding:
+            values = np.rint(values)
+            if block.formats[coordinate] == "%d":
+                values = values.astype(np.int64)
+        block[coordinate] = values
+        block[origin] = np.zeros(len(block))
+    return block
+
+
+def numbers(block, label):
+    "Column as float64 (columns with numbers written in different ways are read as text)"
+    try:
+        return block[label].astype(np.float64)
+    except ValueError:
+        raise ValueError("column %s of data_%s has values which are not numbers" % (label, block.name))
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Conversion of particle sets between Relion star files and cryoSPARC .cs files (NumPy structured arrays).
+
+    table = cs_to_star(load_cs("P12_J40_passthrough_particles.cs"))      # StarTable
+    particles = star_to_cs(read_star("particles.star"), mic_shape=(4096, 4096))
+
+All conversions are whole-column NumPy operations: .cs files are memory-mapped, names are built and split as byte
+matrices, poses are converted in chunks of CHUNK_ROWS rows. Units and conventions:
+    coordinates    location/center_{x,y}_frac * micrograph width/height = _rlnCoordinateX/Y (pixels)
+    image names    blob/idx (0-based) + blob/path = "%06d@path" (1-based); a leading ">" of cryoSPARC paths is dropped
+    CTF            ctf/df1_A, df2_A = _rlnDefocusU/V (A); ctf/df_angle_rad, phase_shift_rad = _rlnDefocusAngle, _rlnPhaseShift (deg)
+    poses          alignments3D/pose is the rotation vector of the transposed Relion matrix of (rot, tilt, psi);
+                   alignments2D/pose = _rlnAnglePsi (rad/deg)
+    shifts         alignments*/shift (pixels) * pixel size = _rlnOriginX/YAngst
+    classes        0-based class, split = _rlnClassNumber, _rlnRandomSubset (1-based)
+'''
+
+import numpy as np
+
+from util.star_table import CHUNK_ROWS, StarBlock, StarTable, field_matrix, matrix_text, number_matrix, text_matrix
+
+ver=20261017
+
+NUMPY_MAGIC = b"\x93NUMPY"
+STAR_VERSION = "30001"
+# cryoSPARC field => Relion column, factor (values of the field * factor = values of the column)
+PLAIN_FIELDS = (
+    ("ctf/df1_A", "_rlnDefocusU", 1.0),
+    ("ctf/df2_A", "_rlnDefocusV", 1.0),
+    ("ctf/df_angle_rad", "_rlnDefocusAngle", 180 / np.pi),
+    ("ctf/phase_shift_rad", "_rlnPhaseShift", 180 / np.pi),
+    ("ctf/bfactor", "_rlnCtfBfactor", 1.0),
+    ("ctf/scale", "_rlnCtfScalefactor", 1.0),
+)
+# fields of the optics groups (one value per exposure group)
+OPTICS_FIELDS = (
+    ("ctf/accel_kv", "_rlnVoltage"),
+    ("ctf/cs_mm", "_rlnSphericalAberration"),
+    ("ctf/amp_contrast", "_rlnAmplitudeContrast"),
+)
+
+
+def load_cs(filename):
+    "Memory-maps a .cs file (NumPy format); raises ValueError for other formats"
+    with open(filename, "rb") as cs_file:
+        if cs_file.read(len(NUMPY_MAGIC)) != NUMPY_MAGIC:
+            raise ValueError("%s is not a .cs file in NumPy format (compressed cryoSPARC datasets are not supported)"
+                             % filename)
+    particles = np.load(filename, mmap_mode="r")
+    if particles.dtype.names is None:
+        raise ValueError("%s is not a cryoSPARC dataset (no fields)" % filename)
+    return particles
+
+
+def save_cs(filename, particles):
+    "Writes a structured array as a .cs file (np.save without the .npy extension)"
+    with open(filename, "wb") as cs_file:
+        np.save(cs_file, particles)
+
+
+# text columns as byte matrices
+def concat_text(*columns):
+    "Element-wise concatenation of bytes (S) arrays: the padding of the parts is dropped, no Python object per row"
+    joined = np.concatenate([text_matrix(np.asarray(column, dtype="S")) for column in columns], axis=1)
+    filled = joined != 0
+    lengths = filled.sum(axis=1)
+    ends = np.cumsum(lengths)
+    return matrix_text(field_matrix(joined[filled], ends - lengths, ends)[0])
+
+
+def zero_padded(values, width=6):
+    "Integers as text padded with zeros to width digits (\"%06d\"), bytes array"
+    matrix = number_matrix(np.asarray(values, dtype=np.int64), 0)
+    if matrix.shape[1] < width:
+        matrix = np.concatenate((np.zeros((len(matrix), width - matrix.shape[1]), dtype=np.uint8), matrix), axis=1)
+    tail = matrix[:, -width:]
+    tail[tail == 0] = 48
+    return matrix_text(np.ascontiguousarray(matrix))
+
+
+def strip_marker(paths):
+    "Drops the leading \">\" (path relative to the cryoSPARC project) of the paths"
+    matrix = text_matrix(np.asarray(paths, dtype="S")).copy()
+    marked = matrix[:, 0] == 62
+    if marked.any():
+        matrix[marked, :-1] = matrix[marked, 1:]
+        matrix[marked, -1] = 0
+    return matrix_text(matrix)
+
+
+def split_image_names(names):
+    "_rlnImageName values (N@path) as (0-based index, path)"
+    matrix = text_matrix(np.asarray(names, dtype="S"))
+    n, width = matrix.shape
+    at = (matrix == 64).argmax(axis=1)
+    if n and not (matrix[np.arange(n), at] == 64).all():
+        raise ValueError("image names without \"@\" are found")
+    row = np.arange(n, dtype=np.int64) * width
+    data = matrix.ravel()
+    index = matrix_text(field_matrix(data, row, row + at)[0]).astype(np.int64) - 1
+    path = matrix_text(field_matrix(data, row + at + 1, row + (matrix != 0).sum(axis=1))[0])
+    return index, path
+
+
+def categorical(block, label, values):
+    "Stores a text column dictionary-encoded with np.unique (sorted uniques, int32 codes)"
+    uniques, codes = np.unique(values, return_inverse=True)
+    block.labels.setdefault(label, len(block.labels) + 1)
+    block.formats[label] = None
+    block.categories[label] = uniques
+    block.columns[label] = codes.astype(np.int32).ravel()
+
+
+# rotations: Relion Euler angles (ZYZ, degrees) <=> matrices <=> rotation vectors
+def euler_to_matrix(rot, tilt, psi):
+    "Relion rotation matrices (n, 3, 3) of the Euler angles in degrees (Euler_angles2matrix)"
+    a, b, g = np.radians(rot), np.radians(tilt), np.radians(psi)
+    ca, sa, cb, sb, cg, sg = np.cos(a), np.sin(a), np.cos(b), np.sin(b), np.cos(g), np.sin(g)
+    cc, cs, sc, ss = cb * ca, cb * sa, sb * ca, sb * sa
+    matrix = np.empty((len(a), 3, 3))
+    matrix[:, 0, 0] = cg * cc - sg * sa
+    matrix[:, 0, 1] = cg * cs + sg * ca
+    matrix[:, 0, 2] = -cg * sb
+    matrix[:, 1, 0] = -sg * cc - cg * sa
+    matrix[:, 1, 1] = -sg * cs + cg * ca
+    matrix[:, 1, 2] = sg * sb
+    matrix[:, 2, 0] = sc
+    matrix[:, 2, 1] = ss
+    matrix[:, 2, 2] = cb
+    return matrix
+
+
+def matrix_to_euler(matrix):
+    "Relion Euler angles (rot, tilt, psi) in degrees of rotation matrices (Euler_matrix2angles)"
+    abs_sb = np.hypot(matrix[:, 0, 2], matrix[:, 1, 2])
+    regular = abs_sb > 16 * np.finfo(np.float32).eps
+    psi = np.arctan2(matrix[:, 1, 2], -matrix[:, 0, 2])
+    rot = np.arctan2(matrix[:, 2, 1], matrix[:, 2, 0])
+    sin_psi = np.sin(psi)
+    sign_sb = np.where(np.abs(sin_psi) < np.finfo(np.float32).eps, np.sign(-matrix[:, 0, 2] / np.cos(psi)),
+                       np.where(sin_psi > 0, np.sign(matrix[:, 1, 2]), -np.sign(matrix[:, 1, 2])))
+    tilt = np.arctan2(sign_sb * abs_sb, matrix[:, 2, 2])
+    # tilt 0 or 180: only rot + psi is defined
+    up = matrix[:, 2, 2] > 0
+    rot = np.where(regular, rot, 0.0)
+    tilt = np.where(regular, tilt, np.where(up, 0.0, np.pi))
+    psi = np.where(regular, psi, np.where(up, np.arctan2(-matrix[:, 1, 0], matrix[:, 0, 0]),
+                                          np.arctan2(matrix[:, 1, 0], -matrix[:, 0, 0])))
+    return np.degrees(rot), np.degrees(tilt), np.degrees(psi)
+
+
+def rotvec_to_matrix(vectors):
+    "Rotation matrices (Rodrigues) of rotation vectors (n, 3) in radians"
+    theta = np.linalg.norm(vectors, axis=1)
+    axis = vectors / np.where(theta > 0, theta, 1.0)[:, None]
+    x, y, z = axis.T
+    k = np.zeros((len(vectors), 3, 3))
+    k[:, 0, 1], k[:, 0, 2], k[:, 1, 2] = -z, y, -x
+    k[:, 1, 0], k[:, 2, 0], k[:, 2, 1] = z, -y, x
+    s, c = np.sin(theta)[:, None, None], np.cos(theta)[:, None, None]
+    return np.eye(3) + s * k + (1 - c) * (k @ k)
+
+
+def matrix_to_rotvec(matrix):
+    "Rotation vectors of rotation matrices, through quaternions (stable for all angles)"
+    m = matrix
+    trace = m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2]
+    # largest of 4w^2, 4x^2, 4y^2, 4z^2 chooses the formula (Shepperd)
+    squares = np.stack((trace, m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]), axis=1)
+    squares[:, 1:] = 2 * squares[:, 1:] - trace[:, None]
+    choice = squares.argmax(axis=1)
+    quaternion = np.empty((len(m), 4))
+    q = 0.5 * np.sqrt(np.maximum(1 + squares.max(axis=1), 1e-300))
+    w = choice == 0
+    quaternion[w] = np.stack((q[w], (m[w, 2, 1] - m[w, 1, 2]) / (4 * q[w]), (m[w, 0, 2] - m[w, 2, 0]) / (4 * q[w]),
+                              (m[w, 1, 0] - m[w, 0, 1]) / (4 * q[w])), axis=1)
+    for i, (j, k) in ((1, (2, 3)), (2, (3, 1)), (3, (1, 2))):
+        r = choice == i
+        a, b, c = i - 1, j - 1, k - 1
+        values = np.empty((r.sum(), 4))
+        values[:, i] = q[r]
+        values[:, 0] = (m[r, c, b] - m[r, b, c]) / (4 * q[r])
+        values[:, j] = (m[r, b, a] + m[r, a, b]) / (4 * q[r])
+        values[:, k] = (m[r, c, a] + m[r, a, c]) / (4 * q[r])
+        quaternion[r] = values
+    quaternion *= np.where(quaternion[:, :1] < 0, -1.0, 1.0)
+    norm = np.linalg.norm(quaternion[:, 1:], axis=1)
+    angle = 2 * np.arctan2(norm, quaternion[:, 0])
+    return quaternion[:, 1:] * (angle / np.where(norm > 0, norm, 1.0))[:, None]
+
+
+def pose_to_euler(poses):
+    "Relion (rot, tilt, psi) in degrees of alignments3D/pose, in chunks of CHUNK_ROWS rows"
+    result = np.empty((len(poses), 3))
+    for start in range(0, len(poses), CHUNK_ROWS):
+        chunk = np.asarray(poses[start:start + CHUNK_ROWS], dtype=np.float64)
+        result[start:start + len(chunk)] = np.column_stack(matrix_to_euler(rotvec_to_matrix(chunk).transpose(0, 2, 1)))
+    return result.T
+
+
+def euler_to_pose(rot, tilt, psi):
+    "alignments3D/pose of Relion angles in degrees, in chunks of CHUNK_ROWS rows"
+    result = np.empty((len(rot), 3), dtype=np.float32)
+    for start in range(0, len(rot), CHUNK_ROWS):
+        part = slice(start, start + CHUNK_ROWS)
+        result[part] = matrix_to_rotvec(euler_to_matrix(rot[part], tilt[part], psi[part]).transpose(0, 2, 1))
+    return result
+
+
+def cs_to_star(particles):
+    '''
+    StarTable (data_optics + data_particles) of a cryoSPARC particle dataset (structured array, see load_cs).
+    Fields without a Relion column are not converted; returns (table, list of the fields not converted)
+    '''
+    fields = set(particles.dtype.names)
+    used = set()
+    n = len(particles)
+
+    def field(name):
+        used.add(name)
+        return particles[name]
+
+    table = StarTable()
+    optics = table.add_block(StarBlock("optics", STAR_VERSION))
+    block = table.add_block(StarBlock("particles", STAR_VERSION))
+    if "blob/path" in fields and "blob/idx" in fields:
+        block.set_column("_rlnImageName", concat_text(zero_padded(field("blob/idx") + 1), np.full(n, b"@"),
+                                                     strip_marker(field("blob/path"))), None)
+    if "location/micrograph_path" in fields:
+        categorical(block, "_rlnMicrographName", strip_marker(field("location/micrograph_path")))
+    if "location/center_x_frac" in fields and "location/micrograph_shape" in fields:
+        shape = field("location/micrograph_shape")
+        block["_rlnCoordinateX"] = field("location/center_x_frac") * shape[:, 1].astype(np.float64)
+        block["_rlnCoordinateY"] = field("location/center_y_frac") * shape[:, 0].astype(np.float64)
+    for name, label, factor in PLAIN_FIELDS:
+        if name in fields:
+            block[label] = field(name).astype(np.float64) * factor
+    groups = field("ctf/exp_group_id").astype(np.int64) if "ctf/exp_group_id" in fields else np.zeros(n, np.int64)
+    groups = groups + 1 - groups.min() if n and groups.min() < 1 else groups
+    block["_rlnOpticsGroup"] = groups
+    psize = field("blob/psize_A").astype(np.float64) if "blob/psize_A" in fields else None
+    for kind in ("alignments3D", "alignments2D"):
+        # shifts, classes and splits are converted also without poses (star_to_cs writes them so for star files
+        # without angles)
+        if not any(kind + part in fields for part in ("/pose", "/shift", "/class", "/split")):
+            continue
+        if kind + "/pose" in fields and kind == "alignments3D":
+            rot, tilt, psi = pose_to_euler(field(kind + "/pose"))
+            block["_rlnAngleRot"], block["_rlnAngleTilt"], block["_rlnAnglePsi"] = rot, tilt, psi
+        elif kind + "/pose" in fields:
+            block["_rlnAnglePsi"] = np.degrees(field(kind + "/pose").astype(np.float64))
+        if kind + "/shift" in fields:
+            scale = field(kind + "/psize_A").astype(np.float64) if kind + "/psize_A" in fields else psize
+            shift = field(kind + "/shift").astype(np.float64)
+            if scale is None:
+                block["_rlnOriginX"], block["_rlnOriginY"] = shift[:, 0], shift[:, 1]
+            else:
+                block["_rlnOriginXAngst"], block["_rlnOriginYAngst"] = shift[:, 0] * scale, shift[:, 1] * scale
+        if kind + "/class" in fields:
+            block["_rlnClassNumber"] = field(kind + "/class").astype(np.int64) + 1
+        if kind + "/split" in fields:
+            block["_rlnRandomSubset"] = field(kind + "/split").astype(np.int64) + 1
+        break
+    # one optics group per exposure group: its values are taken from its first particle
+    numbers, first = np.unique(groups, return_index=True)
+    optics.set_column("_rlnOpticsGroupName", np.array([b"opticsGroup%d" % number for number in numbers.tolist()]), None)
+    optics["_rlnOpticsGroup"] = numbers
+    for name, label in OPTICS_FIELDS:
+        if name in fields:
+            optics[label] = field(name)[first].astype(np.float64)
+    if psize is not None:
+        optics["_rlnImagePixelSize"] = psize[first]
+    if "blob/shape" in fields:
+        optics["_rlnImageSize"] = field("blob/shape")[first, 0].astype(np.int64)
+        optics["_rlnImageDimensionality"] = np.full(len(numbers), 2)
+    return table, sorted(fields - used)
+
+
+def optics_values(table, label, groups):
+    "Values of a column per particle: from the main block, or from data_optics through _rlnOpticsGroup; None if absent"
+    block = table.data_block
+    if label in block:
+        return block[label]
+    optics = table.optics
+    if optics is None or label not in optics or "_rlnOpticsGroup" not in optics:
+        return None
+    numbers = optics["_rlnOpticsGroup"].astype(np.int64)
+    order = np.argsort(numbers)
+    position = np.searchsorted(numbers[order], groups)
+    if (position >= len(numbers)).any() or (numbers[order][np.minimum(position, len(numbers) - 1)] != groups).any():
+        raise ValueError("particles of optics groups missing in data_optics are found")
+    return optics[label][order][position]
+
+
+def star_to_cs(table, mic_shape=None, seed=None):
+    '''
+    cryoSPARC particle dataset (structured array) of a StarTable of particles.
+        mic_shape   (height, width) of the micrographs in pixels: needed for the coordinates (location/center_*_frac)
+    Returns (particles, list of the columns not converted)
+    '''
+    block = table.data_block
+    n = len(block)
+    used = set()
+
+    def column(label, dtype=np.float64):
+        used.add(label)
+        return block[label].astype(dtype)
+
+    def have(*labels):
+        return all(label in block for label in labels)
+
+    groups = column("_rlnOpticsGroup", np.int64) if have("_rlnOpticsGroup") else np.ones(n, dtype=np.int64)
+    psize = optics_values(table, "_rlnImagePixelSize", groups)
+    used.add("_rlnImagePixelSize")
+    values = {"uid": np.random.default_rng(seed).integers(0, np.iinfo(np.int64).max, n, dtype=np.int64).astype(np.uint64)}
+    if have("_rlnImageName"):
+        used.add("_rlnImageName")
+        values["blob/idx"], values["blob/path"] = split_image_names(block["_rlnImageName"])
+        values["blob/idx"] = values["blob/idx"].astype(np.uint32)
+        size = optics_values(table, "_rlnImageSize", groups)
+        if size is not None:
+            values["blob/shape"] = np.repeat(size.astype(np.uint32)[:, None], 2, axis=1)
+        if psize is not None:
+            values["blob/psize_A"] = psize.astype(np.float32)
+    if have("_rlnMicrographName"):
+        used.add("_rlnMicrographName")
+        names = block["_rlnMicrographName"]
+        uniques, codes = np.unique(names, return_inverse=True)
+        # one uid per micrograph
+        uids = np.random.default_rng(None if seed is None else seed + 1).integers(
+            0, np.iinfo(np.int64).max, len(uniques), dtype=np.int64).astype(np.uint64)
+        values["location/micrograph_uid"] = uids[codes.ravel()]
+        values["location/micrograph_path"] = names
+        if mic_shape is not None and have("_rlnCoordinateX", "_rlnCoordinateY"):
+            height, width = mic_shape
+            values["location/micrograph_shape"] = np.tile(np.array([height, width], dtype=np.uint32), (n, 1))
+            values["location/center_x_frac"] = (column("_rlnCoordinateX") / width).astype(np.float32)
+            values["location/center_y_frac"] = (column("_rlnCoordinateY") / height).astype(np.float32)
+    for name, label in OPTICS_FIELDS:
+        per_particle = optics_values(table, label, groups)
+        used.add(label)
+        if per_particle is not None:
+            values[name] = per_particle.astype(np.float32)
+    for name, label, factor in PLAIN_FIELDS:
+        if have(label):
+            values[name] = (column(label) / factor).astype(np.float32)
+    values["ctf/exp_group_id"] = groups.astype(np.uint32)
+    kind = "alignments3D" if have("_rlnAngleRot", "_rlnAngleTilt") else "alignments2D"
+    if have("_rlnAngleRot", "_rlnAngleTilt", "_rlnAnglePsi"):
+        values[kind + "/pose"] = euler_to_pose(column("_rlnAngleRot"), column("_rlnAngleTilt"), column("_rlnAnglePsi"))
+    elif have("_rlnAnglePsi"):
+        values[kind + "/pose"] = np.radians(column("_rlnAnglePsi")).astype(np.float32)
+    if have("_rlnOriginXAngst", "_rlnOriginYAngst") and psize is not None:
+        values[kind + "/shift"] = np.column_stack((column("_rlnOriginXAngst") / psize,
+                                                   column("_rlnOriginYAngst") / psize)).astype(np.float32)
+        values[kind + "/psize_A"] = psize.astype(np.float32)
+    elif have("_rlnOriginX", "_rlnOriginY"):
+        values[kind + "/shift"] = np.column_stack((column("_rlnOriginX"), column("_rlnOriginY"))).astype(np.float32)
+    if have("_rlnClassNumber"):
+        values[kind + "/class"] = (column("_rlnClassNumber", np.int64) - 1).astype(np.uint32)
+    if have("_rlnRandomSubset"):
+        values[kind + "/split"] = (column("_rlnRandomSubset", np.int64) - 1).astype(np.uint32)
+    dtype = [(name, array.dtype, array.shape[1:]) for name, array in values.items()]
+    particles = np.empty(n, dtype=dtype)
+    for name, array in values.items():
+        particles[name] = array
+    return particles, sorted(set(block.ordered_labels()) - used)
+
+
+def round_trip_lost(table, particles, skipped=()):
+    '''
+    Round-trip check of star_to_cs: the columns of the main block converted into particles (i.e. not in skipped)
+    which cs_to_star does not give back, in the main block or in data_optics. Origins in pixels come back in A
+    '''
+    back, unused = cs_to_star(particles)
+    found = set(back.data_block.ordered_labels())
+    if back.optics is not None:
+        found |= set(back.optics.ordered_labels())
+    if "_rlnOriginXAngst" in found:
+        found |= {"_rlnOriginX", "_rlnOriginY"}
+    return sorted(set(table.data_block.ordered_labels()) - set(skipped) - found)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Row-level differences between two versions of a star file (e.g. particles.star before and after a Select job).
+
+Every row is reduced to two 64-bit hashes: its key (_rlnImageName; the n-th repeat of a key is hashed with n,
+so symmetry-expanded copies are paired in their order) and a digest of the compared value columns.
+The files are streamed chunk by chunk (only the key and value columns are parsed), so the memory use is
+about 16 bytes per row and file; added/removed/changed rows are found by a sorted merge of the key hashes.
+Numbers are compared by value (1.0 == 1.000000 == 1e0, also in columns read as text because their numbers are
+written in different ways), other text byte by byte.
+'''
+
+import time
+
+import numpy as np
+
+from util.star_helper import compression
+from util.star_join import KeyIndex, to_float
+from util.star_mmap import StarMap, write_selected
+from util.star_registry import star_header
+from util.star_table import CHUNK_ROWS, read_star
+
+ver=20261017
+
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+# bytes which can make up a number (0-padding of the arrays included)
+NUMBER_BYTES = np.zeros(256, dtype=bool)
+NUMBER_BYTES[np.frombuffer(b"0123456789+-.eE\0", dtype=np.uint8)] = True
+
+
+def mix(h):
+    "splitmix64 finalizer: spreads the bits of uint64 values"
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+
+def hash_bytes(values):
+    "64-bit FNV-1a hash of every value of a bytes array (one vectorized pass per character; padding is skipped)"
+    values = np.ascontiguousarray(values)
+    width = values.dtype.itemsize
+    h = np.full(len(values), FNV_OFFSET, dtype=np.uint64)
+    if not len(values):
+        return h
+    matrix = values.view(np.uint8).reshape(len(values), width)
+    for i in range(width):
+        byte = matrix[:, i].astype(np.uint64)
+        h = np.where(byte != 0, (h ^ byte) * FNV_PRIME, h)
+    return h
+
+
+def hash_numbers(values):
+    "uint64 hash of numbers: the bits of their float64 values (1 and 1.000 are equal; -0.0 is 0.0)"
+    return mix(np.ascontiguousarray(values.astype(np.float64) + 0.0).view(np.uint64))
+
+
+def text_numbers(values):
+    "(float64 values, mask) of the values of a bytes array which are numbers"
+    values = np.ascontiguousarray(values)
+    numbers = np.full(len(values), np.nan)
+    if not len(values):
+        return numbers, np.zeros(0, dtype=bool)
+    matrix = values.view(np.uint8).reshape(len(values), values.dtype.itemsize)
+    candidate = NUMBER_BYTES[matrix].all(axis=1) & (matrix[:, 0] != 0)
+    try:
+        numbers[candidate] = values[candidate].astype(np.float64)
+    except ValueError:
+        # e.g. "1-2": one by one
+        numbers[candidate] = [to_float(value) for value in values[candidate].tolist()]
+    return numbers, candidate & ~np.isnan(numbers)
+
+
+def hash_text(values):
+    "uint64 hash of every value of a bytes array: numbers as in numeric columns (3 == 3.0), other text byte by byte"
+    h = hash_bytes(values)
+    numbers, numeric = text_numbers(values)
+    h[numeric] = hash_numbers(numbers[numeric])
+    return h
+
+
+def hash_column(block, label):
+    '''
+    uint64 hash of every value of a column: numbers by their float64 value, also in text columns (a chunk is read
+    as text if its numbers are written in different ways, e.g. "3" and "3.0"), other text byte by byte
+    '''
+    if label in block.categories:
+        return hash_text(block.categories[label])[block.columns[label]]
+    values = block.columns[label]
+    if values.dtype.kind == "S":
+        return hash_text(values)
+    return hash_numbers(values)
+
+
+def chunk_hashes(block, key, columns):
+    "(key hashes, digests of the columns) of the rows of a StarBlock"
+    keys = hash_column(block, key)
+    digest = np.zeros(len(block), dtype=np.uint64)
+    for label in columns:
+        digest = mix(digest * GOLDEN + hash_column(block, label))
+    return keys, digest
+
+
+def iter_chunks(filename, columns, chunk_rows=CHUNK_ROWS):
+    "Yields the main block of a star file as StarBlocks with the given columns, chunk_rows rows at a time"
+    if compression(filename) is not None:
+        # compressed files cannot be memory-mapped: one projected read (util/star_table.py)
+        yield read_star(filename, columns=columns).data_block
+        return
+    with StarMap(filename) as star:
+        main = star.data_block
+        for start in range(0, len(main), chunk_rows):
+            yield star.rows(main.name, start, start + chunk_rows, columns=columns)
+
+
+def main_labels(filename):
+    "Columns of the main block of a star file, in their order (only the header is read)"
+    labels = star_header(filename)[1]
+    return sorted(labels, key=labels.get)
+
+
+def row_hashes(filename, key, columns, chunk_rows=CHUNK_ROWS):
+    '''
+    Hashes of the rows of the main block of a star file: returns (row keys, digests), uint64 arrays with one value per row.
+    The row key is the hash of the key and of the number of its previous repeats
+    '''
+    keys, digests = [], []
+    for block in iter_chunks(filename, [key] + list(columns), chunk_rows):
+        if key not in block:
+            raise ValueError("diff: column %s is not found in data_%s of %s" % (key, block.name, filename))
+        k, d = chunk_hashes(block, key, columns)
+        keys.append(k)
+        digests.append(d)
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.uint64)
+    digests = np.concatenate(digests) if digests else np.zeros(0, dtype=np.uint64)
+    repeat = KeyIndex(keys).ranks().astype(np.uint64)
+    return mix(keys + repeat * GOLDEN), digests
+
+
+def compare(old, new):
+    '''
+    Sorted merge of the row hashes of two files (see row_hashes).
+    Returns boolean masks (removed rows of old, added rows of new, changed rows of new)
+    '''
+    (old_keys, old_digests), (new_keys, new_digests) = old, new
+    common, in_old, in_new = np.intersect1d(old_keys, new_keys, assume_unique=True, return_indices=True)
+    removed = np.ones(len(old_keys), dtype=bool)
+    removed[in_old] = False
+    added = np.ones(len(new_keys), dtype=bool)
+    added[in_new] = False
+    differs = old_digests[in_old] != new_digests[in_new]
+    changed = np.zeros(len(new_keys), dtype=bool)
+    changed[in_new[differs]] = True
+    return removed, added, changed
+
+
+def write_rows(filename, mask, output, chunk_rows=CHUNK_ROWS):
+    "Writes the rows of the main block of a star file selected by mask (one value per row) and the other blocks"
+    if compression(filename) is not None:
+        table = read_star(filename)
+        table.blocks[table.data_block.name] = table.data_block.take(mask)
+        table.write(output)
+        return
+    position = [0]
+
+    def select(block):
+        start = position[0]
+        position[0] += len(block)
+        return mask[start:position[0]]
+    with StarMap(filename) as star:
+        write_selected(star, output, [star.data_block.ordered_labels()[0]], select, chunk_rows)
+
+
+def diff_star(old_file, new_file, key, columns=None, prefix=None, chunk_rows=CHUNK_ROWS):
+    '''
+    Compares the main blocks of two star files row by row (see the module description).
+        key       column identifying a row (e.g. _rlnImageName)
+        columns   value columns compared (default: all columns of both files except the key)
+        prefix    if given, writes <prefix>_added.star (rows of new_file), <prefix>_removed.star (rows of old_file)
+                  and <prefix>_changed.star (new versions of the changed rows)
+    Returns {"added": n, "removed": n, "changed": n, "unchanged": n}
+    '''
+    start_time = time.time()
+    old_labels, new_labels = main_labels(old_file), main_labels(new_file)
+    if columns is None:
+        columns = [label for label in old_labels if label in new_labels and label != key]
+        only = sorted(set(old_labels) ^ set(new_labels))
+        if only:
+            print(" => WARNING: columns %s are not in both files and are not compared" % ", ".join(only))
+    missing = [label for label in columns if label not in old_labels or label not in new_labels]
+    if missing:
+        raise ValueError("diff: columns %s are not found in both files" % ", ".join(missing))
+    removed, added, changed = compare(row_hashes(old_file, key, columns, chunk_rows),
+                                       row_hashes(new_file, key, columns, chunk_rows))
+    counts = {"added": int(added.sum()), "removed": int(removed.sum()), "changed": int(changed.sum())}
+    counts["unchanged"] = len(added) - counts["added"] - counts["changed"]
+    seconds = max(time.time() - start_time, 1e-6)
+    print(" => %d rows in %s, %d rows in %s; %d columns compared, rows matched by %s (%.2f s)"
+          % (len(removed), old_file, len(added), new_file, len(columns), key, seconds))
+    print(" => added %(added)d, removed %(removed)d, changed %(changed)d, unchanged %(unchanged)d" % counts)
+    if prefix is not None:
+        for name, filename, mask in (("added", new_file, added), ("removed", old_file, removed),
+                                     ("changed", new_file, changed)):
+            output = "%s_%s.star" % (prefix, name)
+            write_rows(filename, mask, output, chunk_rows)
+            print(" => %s created!" % output)
+    return counts
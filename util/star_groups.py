@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Per-micrograph (or any other group) selections of the rows of a star-file block:
+
+    names, codes = group_codes(block)         # _rlnMicrographName: sorted names + one group code per row
+    mask = min_count(codes, 20)               # micrographs with at least 20 particles
+    mask &= top_groups(codes, 500)            # the 500 micrographs with most particles
+    mask &= cap_groups(codes, 100, seed=0)    # at most 100 random particles per micrograph
+
+The rows are grouped once (np.unique with return_inverse; dictionary-encoded columns only sort their uniques).
+Every function returns a boolean mask of the rows; counts come from np.bincount of the codes, so the selections
+take O(rows) and work on any subset of the rows (codes[rows]) without grouping again.
+'''
+
+import numpy as np
+
+ver=20261017
+
+GROUP_COLUMN = "_rlnMicrographName"
+
+
+def group_codes(block, label=GROUP_COLUMN):
+    '''
+    Groups of the rows of a block (one per micrograph): returns (names, codes), names sorted and names[codes[i]]
+    the group of row i. Dictionary-encoded columns are grouped through their codes
+    '''
+    if label not in block:
+        raise ValueError("column %s is not found in data_%s" % (label, block.name))
+    if label not in block.categories:
+        names, codes = np.unique(block.columns[label], return_inverse=True)
+        return names, codes.reshape(-1)
+    names, rank = np.unique(block.categories[label], return_inverse=True)
+    codes = rank.reshape(-1)[block.columns[label]]
+    # uniques not used by any row are dropped
+    used = np.bincount(codes, minlength=len(names)) > 0
+    if not used.all():
+        codes = (np.cumsum(used) - 1)[codes]
+        names = names[used]
+    return names, codes
+
+
+def min_count(codes, n):
+    "Rows of the groups with at least n rows"
+    return (np.bincount(codes) >= n)[codes]
+
+
+def top_groups(codes, k):
+    "Rows of the k groups with most rows (ties: the group coming first in the sorted names)"
+    counts = np.bincount(codes)
+    if k >= len(counts):
+        return np.ones(len(codes), dtype=bool)
+    if k <= 0:
+        return np.zeros(len(codes), dtype=bool)
+    # count of the k-th group: all groups above it, then the ties in the order of the names
+    threshold = counts[np.argpartition(-counts, k - 1)[:k]].min()
+    selected = counts > threshold
+    selected[np.flatnonzero(counts == threshold)[:k - selected.sum()]] = True
+    return selected[codes]
+
+
+def cap_groups(codes, n, seed=None):
+    '''
+    At most n rows of every group: the first n rows in the file, or n rows picked at random
+    if a seed (int, or True for a random seed) is given
+    '''
+    order = np.arange(len(codes))
+    if seed is not None:
+        order = np.random.default_rng(None if seed is True else seed).permutation(len(codes))
+    # stable (radix) sort of the integer codes: rows grouped, in the file order or at random within a group
+    order = order[np.argsort(codes[order], kind="stable")]
+    counts = np.bincount(codes)
+    ranks = np.empty(len(codes), dtype=np.int64)
+    ranks[order] = np.arange(len(codes)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return ranks < n
+
+
+def count_histogram(codes):
+    "(particles per group, number of groups) for every count present"
+    counts = np.bincount(np.bincount(codes))
+    present = np.flatnonzero(counts)
+    return present, counts[present]
+
+
+def write_histogram(codes, filename, label=GROUP_COLUMN):
+    "Writes the histogram of the rows per group as a two-column text file and prints its summary"
+    counts = np.bincount(codes)
+    values, groups = count_histogram(codes)
+    low, median, mean, high = (counts.min(), np.median(counts), counts.mean(), counts.max()) if len(counts) else (0, 0, 0, 0)
+    with open(filename, "w") as output:
+        output.write("# %s: %d groups, %d rows; rows per group min %d, median %g, mean %.2f, max %d\n"
+                     % (label, len(counts), counts.sum(), low, median, mean, high))
+        output.write("# rows_per_group groups\n")
+        for value, number in zip(values.tolist(), groups.tolist()):
+            output.write("%d %d\n" % (value, number))
+    print(" => %d micrographs, %d-%d particles per micrograph (median %g)" % (len(counts), low, high, median))
+    print(" => %s created!" % filename)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+import bz2
+import gzip
+import lzma
+import sys
+
+ver=20261017
+
+# compressed star files are recognized by their first bytes and decompressed while they are read
+MAGIC = ((b"\x1f\x8b", gzip.open), (b"\xfd7zXZ\x00", lzma.open), (b"BZh", bz2.open))
+
+# Key column of the main data block for each Relion star-file type
+KEY_COLUMNS = {
+    "micrographs": "_rlnMicrographName",
+    "movies": "_rlnMicrographMovieName",
+    "particles": "_rlnImageName",
+}
+
+# Relion columns holding numbers (checked by util/star_validate.py)
+NUMERIC_COLUMNS = frozenset("_rln" + name for name in """
+    AmplitudeContrast AnglePsi AnglePsiPrior AngleRot AngleRotPrior AngleTilt AngleTiltPrior AutopickFigureOfMerit
+    AccumMotionEarly AccumMotionLate AccumMotionTotal BeamTiltX BeamTiltY ClassNumber CoordinateX CoordinateY CoordinateZ
+    CtfAstigmatism CtfBfactor CtfFigureOfMerit CtfMaxResolution CtfScalefactor CtfValue DefocusAngle DefocusU DefocusV
+    DetectorPixelSize GroupNumber HelicalTubeID HelicalTrackLength HelicalTrackLengthAngst ImageDimensionality ImagePixelSize
+    ImageSize LogLikeliContribution Magnification MaxValueProbDistribution MicrographBinning MicrographDoseRate
+    MicrographOriginalPixelSize MicrographPixelSize MicrographPreExposure MicrographStartFrame NormCorrection
+    NrOfFrames NrOfSignificantSamples OpticsGroup OriginX OriginXAngst OriginY OriginYAngst OriginZ
+    OriginZAngst PhaseShift RandomSubset SphericalAberration Voltage""".split())
+
+
+def compression(filename):
+    "Opening function of the compression format of the file (gzip.open, lzma.open, bz2.open) or None for plain text"
+    with open(filename, "rb") as f:
+        head = f.read(6)
+    for magic, opener in MAGIC:
+        if head.startswith(magic):
+            return opener
+    return None
+
+
+def open_star(filename, mode="r"):
+    '''
+    Opens a star (or any text) file for reading, "r" (text) or "rb" (bytes).
+    gzip, xz and bz2 files are detected by their magic bytes and decompressed as a stream, without a temporary file
+    '''
+    opener = compression(filename)
+    if opener is None:
+        return open(filename, mode)
+    return opener(filename, "rt" if mode == "r" else mode)
+
+
+def star_tokens(star_file, lim=0):
+    '''
+    Single-pass tokenizer of an opened star file. Reads the file line by line (no readlines()) and yields tuples (kind, value, line):
+        ("version", "30001", line)              for "# version 30001"
+        ("data", "particles", line)             for "data_particles"
+        ("loop", None, line)                    for "loop_"
+        ("label", ("_rlnImageName", 6), line)   for "_rlnImageName #6"
+        ("row", None, line)                     for any other non-empty line
+    Empty lines and other comments are skipped.
+    lim argument is used to limit the number of analysed lines (in characters), as in readlines(lim)
+    '''
+    total = 0
+    for line in star_file:
+        if lim:
+            if total >= lim:
+                break
+            total += len(line)
+        if line[:1] == "#":
+            if line[:10] == "# version ":
+                yield "version", line.split()[2], line
+            continue
+        if line[:5] == "data_":
+            yield "data", line.strip()[5:], line
+        elif line[:5] == "loop_":
+            yield "loop", None, line
+        elif line[:1] == "_":
+            star_line = line.split()
+            if len(star_line) > 1 and star_line[1][:1] == "#":
+                yield "label", (star_line[0], int(star_line[1][1:])), line
+            else:
+                # "_rlnLabel value" pairs outside of a loop
+                yield "label", (star_line[0], None), line
+        elif line.strip():
+            yield "row", None, line
+
+
+def star_analyze(star_filename, lim=0):
+    '''
+    creates dicrionaries from the star files:
+        OpticsHeader: everything starting with _rlnXXXX, corresponding to the data_optics section
+        "# version 30001
+        data_optics
+        loop_
+        _rlnOpticsGroupName #1" etc
+        OpticsGroupData:  all the data after the previous section like:
+        "opticsGroup1           1     0.43   300     2.7     0.1"
+
+        MainHeader:  everything starting with _rlnXXXX, corresponding to the data_movies or data_particles section
+        "# version 30001
+        data_particles
+        loop_
+        _rlnCoordinateX #1"
+
+        StarData:  main data (alignments data for particles.star) after the previous section like:
+        "mov1.tiff 25" (movies.star) or "3.43 6.2 0.1 10 8.2 000001@Extract/job044/Micro/mov1.mrcs MotionCorr/job034 /Micro/mov1.mrc 1 0.1 6.1 6.4 44.8 0.0 1.0 0.0 " (particles.star)
+
+    lim argument is used to limit the number of analysed lines (in bytes)
+
+    The file is read in a single pass through star_tokens(), so the run time is linear in the number of lines.
+    StarData keeps one row per name: for duplicated names (symmetry-expanded particles) use read_star (util/star_table.py)
+    with KeyIndex (util/star_join.py)
+    '''
+    # optics header dictionaries
+    OpticsHeader = {}
+    OpticsGroupData = {}
+    # main header dictionaries
+    MainHeader = {}
+    StarData = {}
+    data_type = None
+    key_index = None
+    with open_star(star_filename) as star_file:
+        tokens = star_tokens(star_file, lim)
+        # create OpticsHeader and OpticGroupData dictionary
+        for kind, value, line in tokens:
+            if kind == "version":
+                OpticsHeader['# version'] = value
+            elif kind == "data":
+                if value == "optics":
+                    continue
+                data_type = value
+                break
+            elif kind == "label":
+                if line[:4] == "_rln":
+                    OpticsHeader[value[0]] = value[1]
+            elif kind == "row":
+                if line[:11] == "opticsGroup":
+                    OpticsGroupData[line.split(None, 1)[0]] = line.rstrip("\n")
+        # create MainHeader and StarData dictionaries
+        for kind, value, line in tokens:
+            if kind == "row":
+                # the key of StarData is the micrograph/movie/particle name
+                star_line = line.split()
+                if key_index is None:
+                    print("\n => ERROR in %s file: no data type found in the %s file!" % (
+                        star_filename, star_filename))
+                    sys.exit(2)
+                StarData[star_line[key_index]] = star_line
+            elif kind == "label":
+                if line[:4] == "_rln":
+                    MainHeader[value[0]] = value[1]
+                    if value[0] == KEY_COLUMNS.get(data_type):
+                        key_index = value[1] - 1
+            elif kind == "version":
+                MainHeader['# version'] = value
+            elif kind == "data":
+                data_type = value
+    if '# version' not in OpticsHeader.keys():
+        OpticsHeader['# version'] = "unknown"
+    if '# version' not in MainHeader.keys():
+        MainHeader['# version'] = "unknown"
+    StarFileType = data_type
+    return MainHeader, OpticsGroupData, OpticsHeader, StarData, StarFileType
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Joins of star-file blocks (util/star_table.py) with selections of names.
+semi_join matches every row with one lookup in a Python set of the selection (micrograph names once per unique value).
+KeyIndex maps every key of a column (image name, micrograph stem, any other column) to all rows with this key,
+so duplicated keys (symmetry-expanded particles) keep all their rows; it is built once for repeated lookups.
+'''
+
+import os
+
+import numpy as np
+
+from util.star_table import CHUNK_ROWS, format_column
+
+
+ver=20261017
+
+
+def path_stem(path):
+    "Path(path).stem without creating a Path object: no folder, no extension"
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def stem_codes(block, label):
+    '''
+    Micrograph-stem key column: returns (stems, codes) where stems[codes[i]] is the stem of the value in row i.
+    Stems are computed once per unique value (one vectorized pass over the rows for the codes)
+    '''
+    uniques, codes = block.factorize(label)
+    if uniques.dtype.kind != "S":
+        # numeric column: the stems of the values as written
+        uniques = format_column(uniques, block.formats[label])
+    stems = [path_stem(value.decode()) for value in uniques.tolist()]
+    return stems, codes
+
+
+def text_to_float(values):
+    "float64 of a text array; NaN for the values which are not numbers"
+    try:
+        return values.astype(np.float64)
+    except ValueError:
+        return np.array([to_float(value) for value in values.tolist()], dtype=np.float64)
+
+
+def to_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+class KeyIndex:
+    '''
+    Multi-row index of a key column: sorted unique keys and, for each key, the positions of all its rows.
+        keys      sorted unique keys (NumPy array)
+        offsets   rows of keys[i] are rows[offsets[i]:offsets[i + 1]] (int64, len(keys) + 1)
+        rows      row positions grouped by key, in their order in the block within a key
+    Memory: the unique keys + 8 bytes per row; lookups are vectorized binary searches
+    '''
+    def __init__(self, values):
+        "values: the key of every row (NumPy array)"
+        order = np.argsort(values, kind="stable")
+        self.init_sorted(values[order], order)
+
+    def init_sorted(self, sorted_values, order):
+        first = np.ones(len(sorted_values), dtype=bool)
+        first[1:] = sorted_values[1:] != sorted_values[:-1]
+        starts = np.flatnonzero(first)
+        self.keys = sorted_values[starts]
+        self.offsets = np.append(starts, len(sorted_values)).astype(np.int64)
+        self.rows = order
+
+    @classmethod
+    def from_codes(cls, uniques, codes):
+        "Index of a dictionary-encoded column (uniques[codes] are the keys): only the int32 codes are sorted"
+        index = cls.__new__(cls)
+        rank = np.empty(len(uniques), dtype=np.int64)
+        by_value = np.argsort(uniques, kind="stable")
+        # equal uniques (e.g. two paths with the same stem) get the same rank
+        same = np.zeros(len(uniques), dtype=bool)
+        same[1:] = uniques[by_value][1:] == uniques[by_value][:-1]
+        rank[by_value] = np.cumsum(~same) - 1
+        row_rank = rank[codes]
+        order = np.argsort(row_rank, kind="stable")
+        index.init_sorted(row_rank[order], order)
+        index.keys = uniques[by_value][~same]
+        return index
+
+    @classmethod
+    def from_block(cls, block, label, stem=False):
+        '''
+        Index of a column of a StarBlock. stem=True: the keys are the stems of the paths (no folder, no extension).
+        Dictionary-encoded columns are indexed through their codes
+        '''
+        if stem:
+            stems, codes = stem_codes(block, label)
+            return cls.from_codes(np.array(stems), codes)
+        if label in block.categories:
+            return cls.from_codes(block.categories[label], block.columns[label])
+        return cls(block.columns[label])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def counts(self):
+        "Number of rows of every key"
+        return np.diff(self.offsets)
+
+    def find(self, keys):
+        "Positions of the keys (array or list) in self.keys, -1 for absent keys"
+        keys = np.asarray(keys)
+        if not len(keys):
+            return np.zeros(0, dtype=np.int64)
+        if keys.dtype.kind == "U" and self.keys.dtype.kind == "S":
+            keys = np.char.encode(keys)
+        elif keys.dtype.kind == "S" and self.keys.dtype.kind == "U":
+            keys = np.char.decode(keys)
+        elif keys.dtype.kind in "SU" and self.keys.dtype.kind not in "SU":
+            # text keys of a numeric column are compared by value ("3.0" and "1e3" match 3 and 1000);
+            # text which is not a number matches no key
+            keys = text_to_float(keys)
+        if not len(self.keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        found = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[found] == keys, found, -1)
+
+    def __contains__(self, key):
+        return self.find([key])[0] >= 0
+
+    def positions(self, key):
+        "All rows with this key (empty array if absent)"
+        i = self.find([key])[0]
+        if i < 0:
+            return self.rows[:0]
+        return self.rows[self.offsets[i]:self.offsets[i + 1]]
+
+    def mask(self, keys):
+        "Boolean mask of the rows whose key is one of the keys (all duplicates included)"
+        selected = np.zeros(len(self.keys), dtype=bool)
+        found = self.find(keys)
+        selected[found[found >= 0]] = True
+        return self.spread(selected)
+
+    def spread(self, values):
+        "Array with one value per key (e.g. a boolean mask of the keys) expanded to one value per row"
+        result = np.empty(len(self.rows), dtype=np.asarray(values).dtype)
+        result[self.rows] = np.repeat(values, self.counts())
+        return result
+
+    def ranks(self, order=None):
+        '''
+        Position of every row within its key (0 for the first row of a key, 1 for the second...): in the order of the rows
+        in the block, or in the order of the values "order" (one per row, e.g. random numbers)
+        '''
+        rows = self.rows
+        if order is not None:
+            group = self.spread(np.arange(len(self.keys)))
+            rows = np.lexsort((order, group))
+        ranks = np.empty(len(rows), dtype=np.int64)
+        ranks[rows] = np.arange(len(rows)) - np.repeat(self.offsets[:-1], self.counts())
+        return ranks
+
+
+def semi_join(block, label, selection, stem=False):
+    '''
+    Boolean mask of the rows of the block whose key is in the selection (a set of str): a hash semi-join in O(rows).
+    Every row with a selected key is kept, also duplicates (symmetry-expanded particles). The anti-join (exclusion)
+    is the negated mask. For repeated lookups in the same block build a KeyIndex once instead.
+        label   column with the keys (e.g. _rlnImageName, _rlnMicrographName)
+        stem    compare the stems of the paths (no folder, no extension) instead of the full values
+    '''
+    selection = selection if isinstance(selection, (set, frozenset)) else set(selection)
+    values = block.columns[label]
+    if not stem and label not in block.categories and values.dtype.kind != "S":
+        # numeric keys are compared by value
+        return KeyIndex(values).mask(list(selection))
+    if stem or label in block.categories:
+        # repeated keys (micrograph names) are looked up once per unique value
+        if stem:
+            keys, codes = stem_codes(block, label)
+        else:
+            uniques, codes = block.factorize(label)
+            keys = [value.decode() for value in uniques.tolist()]
+        keep = np.fromiter((key in selection for key in keys), dtype=bool, count=len(keys))
+        return keep[codes]
+    selection = set(key.encode() for key in selection)
+    mask = np.empty(len(values), dtype=bool)
+    for start in range(0, len(values), CHUNK_ROWS):
+        part = values[start:start + CHUNK_ROWS].tolist()
+        mask[start:start + len(part)] = [key in selection for key in part]
+    return mask
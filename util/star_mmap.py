@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Random access to the rows of large star files.
+
+The file is memory-mapped and indexed once: for every loop the byte offset of each data row is kept
+in one int64 array (8 bytes per row, nothing else is parsed). Rows are parsed only when asked for:
+
+    star = StarMap("particles.star", index_file="particles.star.idx.npz")   # index saved/reused
+    star.rows("particles", 1000, 1010)          # StarBlock with 10 rows
+    star.sample("particles", 100)               # StarBlock with 100 random rows
+    for x in star.iter_column("particles", "_rlnCoordinateX"):
+        ...                                     # one column, CHUNK_ROWS rows at a time
+'''
+
+import json
+import mmap
+import os
+
+import numpy as np
+
+from util.star_cache import file_signature
+from util.star_helper import compression
+from util.star_table import (CHUNK_ROWS, READ_BYTES, ROW_END, StarBlock, StarWriter, field_matrix, infer_column,
+                             parse_column, tokenize)
+
+ver=20261017
+
+
+class MappedBlock:
+    '''
+    Layout of one data_ block of a memory-mapped star file.
+        name, version, loop, labels   as in StarBlock
+        starts    byte offset of every data row (int64)
+        start     byte offset of the first row
+        stop      byte offset of the end of the last row
+        sections  [start, stop) byte ranges of the runs of rows: a "#" comment line inside a loop starts a new run
+        breaks    rows starting the runs after the first one (int64)
+        pairs     StarBlock with the "_rlnLabel value" pairs of a block without loop_ (None for loops)
+    '''
+    def __init__(self, name, version=None):
+        self.name = name
+        self.version = version
+        self.loop = False
+        self.labels = {}
+        self.starts = np.zeros(0, dtype=np.int64)
+        self.start = 0
+        self.stop = 0
+        self.sections = []
+        self.breaks = np.zeros(0, dtype=np.int64)
+        self.pairs = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def ordered_labels(self):
+        return sorted(self.labels, key=self.labels.get)
+
+    def ends(self, rows=None):
+        "Byte offset of the end of every row or of the rows (the start of the next one, or the end of its run of rows)"
+        after = np.arange(1, len(self) + 1) if rows is None else np.asarray(rows, dtype=np.int64) + 1
+        ends = np.where(after < len(self), self.starts[np.minimum(after, len(self) - 1)], self.stop)
+        if len(self.breaks):
+            run = np.searchsorted(self.breaks, after)
+            last = (run < len(self.breaks)) & (self.breaks[np.minimum(run, len(self.breaks) - 1)] == after)
+            ends[last] = np.array([stop for start, stop in self.sections], dtype=np.int64)[run[last]]
+        return ends
+
+    def add_section(self, start, stop, starts=None):
+        "Appends a run of rows [start, stop) with the byte offsets starts of its rows (None: rows not indexed)"
+        if starts is not None:
+            if self.sections:
+                self.breaks = np.append(self.breaks, len(self.starts))
+            self.starts = np.concatenate((self.starts, starts))
+        self.sections.append((start, stop))
+        self.start, self.stop = self.sections[0][0], stop
+
+
+def row_offsets(mm, start, stop, window=READ_BYTES):
+    '''
+    Byte offsets of the non-blank lines between start and stop of a memory-mapped file.
+    The file is scanned in windows of a few MB ending at a line end, so the memory use does not depend on the file size
+    '''
+    parts = []
+    pos = start
+    while pos < stop:
+        end = min(pos + window, stop)
+        if end < stop:
+            newline = mm.rfind(b"\n", pos, end)
+            if newline < 0:
+                newline = mm.find(b"\n", end, stop)
+            end = stop if newline < 0 else newline + 1
+        data = np.frombuffer(mm, dtype=np.uint8, count=end - pos, offset=pos)
+        lines = np.concatenate(([0], np.flatnonzero(data[:-1] == 10) + 1))
+        filled = np.maximum.reduceat((data > 32).view(np.uint8), lines) > 0
+        parts.append(lines[filled] + pos)
+        del data
+        pos = end
+    if not parts:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(parts).astype(np.int64)
+
+
+def scan_blocks(mm, index=True):
+    '''
+    Reads the header lines of a memory-mapped star file and indexes the data rows of its loops
+    (index=False: only the start and the end of the rows of every loop are found).
+    Returns {block name: MappedBlock}
+    '''
+    blocks = {}
+    block = None
+    version = None
+    pos = 0
+    size = len(mm)
+    while pos < size:
+        newline = mm.find(b"\n", pos)
+        if newline < 0:
+            newline = size
+        line = mm[pos:newline]
+        stripped = line.strip()
+        if not stripped or line[:1] == b"#":
+            if line[:10] == b"# version ":
+                version = line.split()[2].decode()
+        elif line[:5] == b"data_":
+            block = MappedBlock(stripped[5:].decode(), version)
+            blocks[block.name] = block
+            version = None
+        elif line[:5] == b"loop_":
+            block.loop = True
+        elif line[:1] == b"_":
+            fields = line.split()
+            if len(fields) > 1 and fields[1][:1] == b"#":
+                block.labels[fields[0].decode()] = int(fields[1][1:])
+            else:
+                # "_rlnLabel value" pairs: small, parsed right away
+                if block.pairs is None:
+                    block.pairs = StarBlock(block.name, block.version, loop=False)
+                label, text = fields[0].decode(), fields[1] if len(fields) > 1 else b""
+                block.pairs.labels[label] = len(block.pairs.labels) + 1
+                block.pairs.set_column(label, *infer_column(np.array([text], dtype="S")))
+        else:
+            # data rows up to the next header line
+            ends = ROW_END.search(mm, pos)
+            stop = ends.start() + 1 if ends else size
+            if block is not None and block.labels:
+                # rows after a comment line add to the rows before it
+                block.add_section(pos, stop, row_offsets(mm, pos, stop) if index else None)
+            pos = stop
+            continue
+        pos = newline + 1
+    return blocks
+
+
+class StarMap:
+    '''
+    Memory-mapped star file with a row index (see the module description).
+        index_file   optional .npz file with the row offsets: used if it matches the star file
+                     (size, mtime, header hash), otherwise (re)created
+    '''
+    def __init__(self, filename, index_file=None):
+        if compression(filename) is not None:
+            raise ValueError("%s is compressed and cannot be memory-mapped: decompress it or use read_star()" % filename)
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self.mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(filename) else b""
+        signature = file_signature(filename)
+        self.blocks = None
+        if index_file and os.path.exists(index_file):
+            self.blocks = load_index(index_file, signature)
+        if self.blocks is None:
+            self.blocks = scan_blocks(self.mm)
+            if index_file:
+                save_index(index_file, self.blocks, signature)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self._file.close()
+
+    def __contains__(self, name):
+        return name in self.blocks
+
+    def __getitem__(self, name):
+        return self.blocks[name]
+
+    @property
+    def data_block(self):
+        "The main block (last block which is not data_optics)"
+        main = None
+        for name, block in self.blocks.items():
+            if name != "optics":
+                main = block
+        return main
+
+    def row_count(self, name):
+        return len(self.blocks[name])
+
+    def text(self, name, start=0, stop=None):
+        "Data rows from start to stop exactly as in the file (bytes); comment lines inside the loop are left out"
+        block = self.blocks[name]
+        stop = len(block) if stop is None else min(stop, len(block))
+        if stop <= start:
+            return b""
+        if len(block.breaks):
+            return self.take_text(name, np.arange(start, stop))
+        end = block.starts[stop] if stop < len(block) else block.stop
+        return self.mm[block.starts[start]:end]
+
+    def take_text(self, name, rows):
+        "Data rows with the given (sorted) numbers as bytes; runs of consecutive rows are copied at once"
+        block = self.blocks[name]
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return b""
+        # runs of consecutive rows, split where a comment line lies between two rows
+        split = np.diff(rows) != 1
+        if len(block.breaks):
+            split |= np.isin(rows[1:], block.breaks)
+        breaks = np.flatnonzero(split) + 1
+        first = rows[np.concatenate(([0], breaks))]
+        last = rows[np.concatenate((breaks - 1, [len(rows) - 1]))]
+        begin = block.starts[first]
+        end = block.ends(last)
+        return b"".join(self.mm[a:b] for a, b in zip(begin.tolist(), end.tolist()))
+
+    def parse(self, name, buf, columns=None, offset=None):
+        '''
+        Parses data rows of the block (bytes) into a StarBlock.
+        columns: names of the columns to keep (default: all), renumbered in their order in the file
+        offset:  byte offset of buf in the file, for the error messages (default: start of the block)
+        '''
+        block = self.blocks[name]
+        if block.pairs is not None:
+            return block.pairs
+        result = StarBlock(name, block.version, loop=True)
+        labels = block.ordered_labels()
+        keep = labels if columns is None else [label for label in labels if label in columns]
+        if not buf:
+            for label in keep:
+                result.set_column(label, np.array([], dtype="S1"), None)
+            return result
+        if buf[-1:] != b"\n":
+            buf += b"\n"
+        try:
+            data, starts, ends = tokenize(buf, len(labels))
+        except ValueError as e:
+            offset = block.start if offset is None else offset
+            raise ValueError("%s, data_%s, rows read from byte %d: %s" % (self.filename, name, offset, e))
+        for label in keep:
+            i = block.labels[label] - 1
+            result.set_column(label, *parse_column(*field_matrix(data, starts[:, i], ends[:, i])))
+        return result
+
+    def rows(self, name, start, stop, columns=None):
+        "StarBlock with the rows from start to stop"
+        offset = int(self.blocks[name].starts[start]) if start < len(self.blocks[name]) else None
+        return self.parse(name, self.text(name, start, stop), columns, offset)
+
+    def take(self, name, rows, columns=None):
+        "StarBlock with the given rows (in increasing order)"
+        rows = np.sort(rows)
+        offset = int(self.blocks[name].starts[rows[0]]) if len(rows) else None
+        return self.parse(name, self.take_text(name, rows), columns, offset)
+
+    def sample(self, name, n, seed=None, columns=None):
+        "StarBlock with n rows picked at random without replacement (in their order in the file)"
+        rng = np.random.default_rng(seed)
+        rows = rng.choice(len(self.blocks[name]), size=min(n, len(self.blocks[name])), replace=False)
+        return self.take(name, rows, columns)
+
+    def iter_column(self, name, label, chunk_rows=CHUNK_ROWS):
+        "Yields one column of the block as NumPy arrays of chunk_rows rows; the other columns are not parsed"
+        for start in range(0, len(self.blocks[name]), chunk_rows):
+            yield self.rows(name, start, start + chunk_rows, columns=[label])[label]
+
+
+def write_selected(star, output, columns, select, chunk_rows=CHUNK_ROWS):
+    '''
+    Streams the main block of a StarMap into output, chunk_rows rows at a time: select(block) gets a StarBlock
+    with the given columns of a chunk and returns a boolean mask of the rows to keep. The kept rows and the other
+    blocks are copied verbatim. Returns the number of rows kept
+    '''
+    main = star.data_block
+    kept = 0
+    with StarWriter(output) as writer:
+        for name, layout in star.blocks.items():
+            header = star.rows(name, 0, 0)
+            header.loop = layout.loop
+            writer.write(header.header_text())
+            if layout.pairs is not None:
+                writer.write(header.rows_text())
+            elif layout is not main:
+                writer.write(star.text(name))
+            else:
+                for start in range(0, len(main), chunk_rows):
+                    rows = np.flatnonzero(select(star.rows(name, start, start + chunk_rows, columns=columns))) + start
+                    kept += len(rows)
+                    writer.write(star.take_text(name, rows))
+        writer.write(b"\n")
+    return kept
+
+
+def save_index(index_file, blocks, signature):
+    "Writes the row offsets of all blocks and the signature of the star file into an .npz file"
+    layout = []
+    arrays = {}
+    for i, block in enumerate(blocks.values()):
+        layout.append({"name": block.name, "version": block.version, "loop": block.loop, "labels": block.labels,
+                       "sections": [[int(start), int(stop)] for start, stop in block.sections],
+                       "pairs": block.pairs is not None})
+        arrays["starts_%d" % i] = block.starts
+        arrays["breaks_%d" % i] = block.breaks
+    meta = json.dumps({"signature": signature, "blocks": layout, "version": ver})
+    try:
+        with open(index_file, "wb") as index:
+            np.savez(index, meta=np.array(meta), **arrays)
+    except OSError as e:
+        print(" => WARNING: index %s is not saved: %s" % (index_file, e))
+
+
+def load_index(index_file, signature):
+    "Reads the blocks saved by save_index; None if the index belongs to another version of the star file"
+    try:
+        with np.load(index_file) as index:
+            meta = json.loads(str(index["meta"]))
+            if meta.get("signature") != signature or meta.get("version") != ver:
+                return None
+            if any(layout["pairs"] for layout in meta["blocks"]):
+                # pairs are parsed from the header: rescan (small blocks without loop_ are rare)
+                return None
+            blocks = {}
+            for i, layout in enumerate(meta["blocks"]):
+                block = MappedBlock(layout["name"], layout["version"])
+                block.loop = layout["loop"]
+                block.labels = layout["labels"]
+                block.starts = index["starts_%d" % i]
+                block.breaks = index["breaks_%d" % i]
+                block.sections = [tuple(section) for section in layout["sections"]]
+                if block.sections:
+                    block.start, block.stop = block.sections[0][0], block.sections[-1][1]
+                blocks[block.name] = block
+            return blocks
+    except (OSError, ValueError, KeyError):
+        return None
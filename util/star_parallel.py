@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Multi-core parsing of large star files: read_star(filename, workers=16).
+
+The data rows of every large loop (each run of rows, if comment lines lie between them) are split into byte ranges
+ending at line ends. Each range is read, tokenized and converted to typed columns by a process of a pool; the columns
+are handed back through one shared-memory segment per range (only their layout is pickled) and concatenated into
+the StarTable.
+Loops smaller than PARALLEL_MIN_BYTES (data_optics) are parsed in the main process.
+'''
+
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from util.star_mmap import scan_blocks
+from util.star_table import (PARALLEL_MIN_BYTES, StarBlock, StarTable, _finish_block, field_matrix, parse_column,
+                             projection, tokenize)
+
+ver=20261017
+
+CHUNK_BYTES = 1 << 24            # smallest byte range given to a worker
+
+
+def byte_ranges(mm, start, stop, workers):
+    "Splits [start, stop) of the file into about 4 ranges per worker (at least CHUNK_BYTES each) ending at line ends"
+    step = max(CHUNK_BYTES, (stop - start) // (4 * workers) + 1)
+    ranges = []
+    while start < stop:
+        end = mm.find(b"\n", min(start + step, stop) - 1, stop)
+        end = stop if end < 0 else end + 1
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def parse_range(filename, n_cols, start, stop, kept):
+    '''
+    Worker: parses the columns kept (positions) of the rows between the byte offsets start and stop
+    into typed columns (see parse_column),
+    stores them one after another in a new shared-memory segment and returns (segment name, layout);
+    layout has one (dtype, length, offset, format) per column
+    '''
+    with open(filename, "rb") as star_file:
+        star_file.seek(start)
+        buf = star_file.read(stop - start)
+    if buf[-1:] != b"\n":
+        buf += b"\n"
+    try:
+        data, starts, ends = tokenize(buf, n_cols)
+    except ValueError as e:
+        raise ValueError("%s, rows from byte %d: %s" % (filename, start, e))
+    parts = [parse_column(*field_matrix(data, starts[:, i], ends[:, i])) for i in kept]
+    del data, starts, ends, buf
+    segment = shared_memory.SharedMemory(create=True, size=max(sum(values.nbytes for values, fmt in parts), 1))
+    layout = []
+    offset = 0
+    for values, fmt in parts:
+        np.ndarray(values.shape, values.dtype, buffer=segment.buf, offset=offset)[:] = values
+        layout.append((values.dtype.str, len(values), offset, fmt))
+        offset += values.nbytes
+    name = segment.name
+    segment.close()
+    return name, layout
+
+
+def attach(name, layout):
+    "Opens the shared-memory segment of a worker: returns (segment, [(values, format) per column]) without copying"
+    segment = shared_memory.SharedMemory(name=name)
+    parts = [(np.ndarray((length,), np.dtype(dtype), buffer=segment.buf, offset=offset), fmt)
+             for dtype, length, offset, fmt in layout]
+    return segment, parts
+
+
+def release(segments):
+    "Frees the shared-memory segments of the workers (no array may still use them)"
+    for segment in segments:
+        segment.close()
+        segment.unlink()
+
+
+def gather(futures, n_cols):
+    "Collects the results of parse_range: returns (segments, [[(values, format) per range] per column])"
+    segments = []
+    chunks = [[] for i in range(n_cols)]
+    try:
+        for future in futures:
+            segment, parts = attach(*future.result())
+            segments.append(segment)
+            for chunk, part in zip(chunks, parts):
+                chunk.append(part)
+    except Exception:
+        for segment in segments:
+            segment.unlink()
+        raise
+    return segments, chunks
+
+
+def parse_rows(rows, n_cols, kept):
+    "Parses the kept columns of the rows (bytes) of a small loop in the main process: [[(values, format)] per column]"
+    if not rows.strip():
+        return [[] for i in kept]
+    if rows[-1:] != b"\n":
+        rows += b"\n"
+    data, starts, ends = tokenize(rows, n_cols)
+    return [[parse_column(*field_matrix(data, starts[:, i], ends[:, i]))] for i in kept]
+
+
+def read_star_parallel(filename, workers, columns=None):
+    '''
+    read_star() on several cores (plain-text star files). Returns the same StarTable as read_star()
+    '''
+    table = StarTable(filename)
+    # one resource tracker shared with the workers: the segments they create are unlinked here
+    resource_tracker.ensure_running()
+    with open(filename, "rb") as star_file, \
+            mmap.mmap(star_file.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            ProcessPoolExecutor(workers) as pool:
+        for layout in scan_blocks(mm, index=False).values():
+            if layout.pairs is not None:
+                pairs = layout.pairs
+                if columns is not None:
+                    pairs = pairs.select([label for label in pairs.ordered_labels() if label in columns])
+                table.add_block(pairs)
+                continue
+            block = table.add_block(StarBlock(layout.name, layout.version, layout.loop))
+            all_labels = layout.ordered_labels()
+            kept = projection(block.name, all_labels, columns)
+            labels = [all_labels[i] for i in kept]
+            block.labels = {label: i + 1 for i, label in enumerate(labels)}
+            # runs of rows separated by comment lines are parsed one after another
+            if sum(stop - start for start, stop in layout.sections) < PARALLEL_MIN_BYTES:
+                rows = b"".join(mm[start:stop] for start, stop in layout.sections)
+                _finish_block(block, labels, parse_rows(rows, len(all_labels), kept),
+                              [rows] if block.name == "optics" else ())
+                continue
+            futures = [pool.submit(parse_range, filename, len(all_labels), start, stop, kept)
+                       for section in layout.sections for start, stop in byte_ranges(mm, *section, workers)]
+            segments, chunks = gather(futures, len(labels))
+            try:
+                _finish_block(block, labels, chunks)
+            finally:
+                chunks = None
+                release(segments)
+    return table
+
+
+def default_workers():
+    "Number of the cores available to this process"
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Row filters for star files, written as boolean expressions over the columns:
+
+    rlnCtfMaxResolution < 4 and rlnDefocusU between 8000 and 25000
+    rlnClassNumber in {3, 7} or not (_rlnAutopickFigureOfMerit >= 0.5)
+    rlnMicrographName == "MotionCorr/job002/Movies/FoilHole_1_fractions.mrc"
+
+Columns are written with or without the leading "_". Comparisons: < <= > >= == (or =) !=,
+"between a and b" (both ends included), "in {...}" and "not in {...}"; combined with and, or, not and brackets.
+An expression is compiled once (Query) and evaluated on a StarBlock as NumPy array operations: one boolean mask.
+filter_star() streams a memory-mapped star file chunk by chunk, so the file does not need to fit into memory.
+'''
+
+import re
+import time
+
+import numpy as np
+
+from util.star_mmap import StarMap, write_selected
+from util.star_table import CHUNK_ROWS
+
+ver=20261017
+
+TOKEN = re.compile(r'''\s*(?:(?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+                           |(?P<string>"[^"]*"|'[^']*')
+                           |(?P<op><=|>=|==|!=|<|>|=|\(|\)|\{|\}|,)
+                           |(?P<name>[A-Za-z_][A-Za-z0-9_]*))''', re.VERBOSE)
+COMPARE = {"<": np.less, "<=": np.less_equal, ">": np.greater, ">=": np.greater_equal,
+           "==": np.equal, "=": np.equal, "!=": np.not_equal}
+KEYWORDS = ("and", "or", "not", "between", "in")
+
+
+def tokens(expression):
+    "Splits an expression into (kind, text, position) tuples"
+    result = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = TOKEN.match(expression, pos)
+        if not match or match.end() == pos:
+            raise ValueError("filter: cannot read '%s' at position %d" % (expression[pos:].strip(), pos + 1))
+        kind = match.lastgroup
+        text = match.group(kind)
+        position = match.start(kind) + 1
+        if kind == "name" and text.lower() in KEYWORDS:
+            kind, text = "keyword", text.lower()
+        result.append((kind, text, position))
+        pos = match.end()
+    result.append(("end", "", len(expression) + 1))
+    return result
+
+
+class Query:
+    '''
+    Compiled filter expression (see the module description).
+        columns   names of the columns used by the expression ("_rln..." labels)
+        mask(block) -> boolean NumPy array, True for the rows passing the filter
+    '''
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokens(expression)
+        self.pos = 0
+        self.columns = []
+        self.tree = self.parse_or()
+        if self.peek()[0] != "end":
+            self.error("unexpected '%s'" % self.peek()[1])
+        del self.tokens
+
+    # recursive-descent parser: or > and > not > comparison
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def take(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def error(self, message):
+        raise ValueError("filter, position %d: %s" % (self.peek()[2], message))
+
+    def expect(self, text):
+        if self.peek()[1] != text:
+            self.error("'%s' expected" % text)
+        self.take()
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.peek()[1] == "or":
+            self.take()
+            node = ("or", node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.peek()[1] == "and":
+            self.take()
+            node = ("and", node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.peek()[1] == "not":
+            self.take()
+            return ("not", self.parse_not())
+        if self.peek()[1] == "(":
+            self.take()
+            node = self.parse_or()
+            self.expect(")")
+            return node
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_operand()
+        kind, text, position = self.peek()
+        if text in COMPARE:
+            self.take()
+            return ("compare", text, left, self.parse_operand())
+        if text == "between":
+            self.take()
+            low = self.parse_operand()
+            self.expect("and")
+            return ("between", left, low, self.parse_operand())
+        negate = text == "not"
+        if negate:
+            self.take()
+            if self.peek()[1] != "in":
+                self.error("'in' expected after 'not'")
+        if self.peek()[1] == "in":
+            self.take()
+            node = ("in", left, self.parse_set())
+            return ("not", node) if negate else node
+        self.error("comparison expected after '%s'" % left[1])
+
+    def parse_set(self):
+        self.expect("{")
+        values = [self.parse_operand()]
+        while self.peek()[1] == ",":
+            self.take()
+            values.append(self.parse_operand())
+        self.expect("}")
+        if any(kind == "column" for kind, value in values):
+            self.error("only values can be listed in {...}")
+        return [value for kind, value in values]
+
+    def parse_operand(self):
+        kind, text, position = self.take()
+        if kind == "number":
+            return ("value", float(text))
+        if kind == "string":
+            return ("value", text[1:-1])
+        if kind == "name":
+            label = text if text[:1] == "_" else "_" + text
+            if label not in self.columns:
+                self.columns.append(label)
+            return ("column", label)
+        self.pos -= 1
+        self.error("column name or value expected")
+
+    # evaluation on a StarBlock
+    def mask(self, block):
+        "Boolean mask of the rows of the block passing the filter"
+        missing = [label for label in self.columns if label not in block]
+        if missing:
+            raise ValueError("filter: columns %s are not found in data_%s" % (", ".join(missing), block.name))
+        return np.broadcast_to(self.evaluate(self.tree, block), (len(block),)).copy()
+
+    def evaluate(self, node, block):
+        kind = node[0]
+        if kind == "and":
+            return self.evaluate(node[1], block) & self.evaluate(node[2], block)
+        if kind == "or":
+            return self.evaluate(node[1], block) | self.evaluate(node[2], block)
+        if kind == "not":
+            return ~self.evaluate(node[1], block)
+        if kind == "compare":
+            left, right = self.operands(block, node[2], node[3])
+            return COMPARE[node[1]](left, right)
+        if kind == "between":
+            values, low, high = self.operands(block, node[1], node[2], node[3])
+            return (values >= low) & (values <= high)
+        if kind == "in":
+            values = self.operands(block, node[1], *[("value", value) for value in node[2]])[0]
+            return np.isin(values, [self.value(value, values) for value in node[2]])
+        raise ValueError("filter: unknown node %s" % kind)
+
+    def operands(self, block, *operands):
+        '''
+        Arrays of the columns and values of a comparison. The comparison is numeric if a literal is a number or a column
+        is numeric: text columns are then converted to float64 (a column may be read as text if its numbers are written
+        in different ways, e.g. "3" and "3.0" or "1e-05"). Text columns are compared with text literals as bytes, and
+        with each other as numbers if they hold only numbers
+        '''
+        numeric = any(kind == "value" and isinstance(value, float) for kind, value in operands) or \
+            any(kind == "column" and block[value].dtype.kind != "S" for kind, value in operands)
+        labels = [value for kind, value in operands if kind == "column"]
+        if not numeric and len(labels) == len(operands):
+            # only text columns: compared as numbers if they all hold numbers
+            try:
+                return [self.numeric(block, label) for label in labels]
+            except ValueError:
+                pass
+        columns = {label: self.numeric(block, label) if numeric else block[label] for label in labels}
+        like = next(iter(columns.values()), None)
+        result = []
+        for kind, value in operands:
+            result.append(columns[value] if kind == "column" else self.value(value, like))
+        return result
+
+    @staticmethod
+    def numeric(block, label):
+        "Column as numbers: text columns are converted to float64 (once per unique value for dictionary-encoded ones)"
+        values = block.columns[label]
+        uniques = block.categories.get(label)
+        text = values if uniques is None else uniques
+        if text.dtype.kind != "S":
+            return values if uniques is None else uniques[values]
+        try:
+            numbers = text.astype(np.float64)
+        except ValueError:
+            bad = next(value for value in text.tolist() if not is_number(value))
+            raise ValueError("filter: column %s is compared with a number but has the value '%s'"
+                             % (label, bad.decode(errors="replace")))
+        return numbers if uniques is None else numbers[values]
+
+    @staticmethod
+    def value(value, like):
+        "A literal compared with a column: numbers stay numbers, text is compared as bytes with text columns"
+        if like is not None and like.dtype.kind == "S" and isinstance(value, str):
+            return value.encode()
+        if isinstance(value, str):
+            try:
+                return float(value)
+            except ValueError:
+                raise ValueError("filter: '%s' is compared with a numeric column" % value)
+        return value
+
+
+def is_number(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+
+def filter_star(filename, expression, output, chunk_rows=CHUNK_ROWS):
+    '''
+    Writes the rows of the main block of a star file passing the filter into output; the other blocks are copied.
+    The file is memory-mapped (util/star_mmap.py): only the columns of the filter are parsed, chunk_rows rows at a time,
+    and the selected rows are copied verbatim, so the memory use does not depend on the file size.
+    Returns (rows kept, rows in total)
+    '''
+    query = Query(expression)
+    start_time = time.time()
+    with StarMap(filename) as star:
+        main = star.data_block
+        missing = [label for label in query.columns if label not in main.labels]
+        if missing:
+            raise ValueError("filter: columns %s are not found in data_%s" % (", ".join(missing), main.name))
+        total = len(main)
+        kept = write_selected(star, output, query.columns, query.mask, chunk_rows)
+    seconds = max(time.time() - start_time, 1e-6)
+    print(" => %d of %d rows kept (%.2f s, %.0f rows/s)" % (kept, total, seconds, total / seconds))
+    print(" => %s created!" % output)
+    return kept, total
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+In-process registry of parsed files: every file is parsed once per run, whoever asks for it.
+Entries are keyed by (path, size, mtime), so a file modified during the run is parsed again.
+
+    data_type, labels, first_row = star_header("micrographs.star")   # header only
+    table = load_star("particles.star")                              # full StarTable
+    keys = load_star("particles.star", columns={"_rlnImageName"})    # one column only
+    names = cached("select.star", "names", my_loader)                 # any derived result
+'''
+
+import os
+
+from util.star_helper import open_star, star_tokens
+from util.star_cache import load_cached
+
+ver=20261017
+
+# absolute path => ((size, mtime), {what: result})
+_registry = {}
+
+
+def file_key(filename):
+    "(absolute path, size, mtime) of a file: a changed size or mtime invalidates the parsed results"
+    stat = os.stat(filename)
+    return os.path.abspath(filename), stat.st_size, stat.st_mtime_ns
+
+
+def cached(filename, what, loader):
+    '''
+    Returns loader(filename), calling the loader only the first time the result "what" is asked for this version of the file.
+    '''
+    path, size, mtime = file_key(filename)
+    entry = _registry.get(path)
+    if entry is None or entry[0] != (size, mtime):
+        entry = ((size, mtime), {})
+        _registry[path] = entry
+    results = entry[1]
+    if what not in results:
+        results[what] = loader(filename)
+    return results[what]
+
+
+def sniff_header(filename):
+    '''
+    Reads a star file up to the first data row of its main (non-optics) block and returns (data_type, labels, first_row):
+        data_type   name of the last data_ block before the first row ("particles", "micrographs", ...), None if not found
+        labels      {"_rlnLabel": column number} of that block
+        first_row   list of the fields of its first row, None for an empty block
+    The data rows are not read
+    '''
+    data_type = None
+    labels = {}
+    first_row = None
+    with open_star(filename) as star_file:
+        for kind, value, line in star_tokens(star_file):
+            if kind == "data":
+                data_type = value
+                labels = {}
+            elif kind == "label":
+                if value[1] is not None:
+                    labels[value[0]] = value[1]
+            elif kind == "row" and data_type is not None and data_type != "optics":
+                first_row = line.split()
+                break
+    return data_type, labels, first_row
+
+
+def star_header(filename):
+    "sniff_header() result of the file, read once per run"
+    return cached(filename, "header", sniff_header)
+
+
+def load_star(filename, cache_dir=None, workers=1, columns=None):
+    '''
+    read_star() result of the file (util/star_table.py), parsed once per run.
+    cache_dir: see util/star_cache.py, workers: number of processes parsing a large file (util/star_parallel.py),
+    columns: read only these columns (projection); taken from the full table if it was already read
+    '''
+    if columns is None:
+        return cached(filename, "table", lambda filename: load_cached(filename, cache_dir, workers=workers))
+    columns = frozenset(columns)
+
+    def project(filename):
+        full = _registry[file_key(filename)[0]][1].get("table")
+        if full is not None:
+            return full.select(columns)
+        return load_cached(filename, cache_dir, workers=workers, columns=columns)
+    return cached(filename, ("columns", columns), project)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Set algebra over selection files (outputs of Select jobs, lists of micrographs):
+
+    (A | B) - C & D
+
+| union, & intersection, - difference, ^ symmetric difference, with brackets; the operators bind
+as in Python: - before &, & before ^, ^ before |. Every operand is a KeySet: the keys of one selection
+file (particle names or micrograph stems) built once into a hashed-and-sorted index (KeyIndex).
+The expression is evaluated on the rows of the main block of a base star file as boolean masks,
+so select_star() streams the base file once, whatever the number of operands.
+'''
+
+import re
+import string
+import time
+
+import numpy as np
+
+from util.star_join import KeyIndex, stem_codes
+from util.star_mmap import StarMap, write_selected
+from util.star_table import CHUNK_ROWS, format_column
+
+ver=20261017
+
+TOKEN = re.compile(r'\s*(?:(?P<op>[|&^()-])|(?P<name>[A-Za-z_][A-Za-z0-9_]*))')
+PRECEDENCE = (("|", "union"), ("^", "symmetric difference"), ("&", "intersection"), ("-", "difference"))
+
+
+def operand_name(i):
+    "Default name of the i-th operand: A, B, ..., Z, A1, B1, ..."
+    letter = string.ascii_uppercase[i % 26]
+    return letter if i < 26 else "%s%d" % (letter, i // 26)
+
+
+def key_codes(block, label, stem=False):
+    "(keys, codes) of a column of a block: keys[codes[i]] is the key of row i (stem=True: stems of the paths)"
+    if stem:
+        stems, codes = stem_codes(block, label)
+        return np.array(stems, dtype="U"), codes
+    uniques, codes = block.factorize(label)
+    if uniques.dtype.kind != "S":
+        uniques = format_column(uniques, block.formats[label])
+    return uniques, codes
+
+
+class KeySet:
+    '''
+    Keys of one operand of a set expression.
+        name      name in the expression (A, B, ...)
+        label     column of the base file compared with the keys (_rlnImageName, _rlnMicrographName, ...)
+        stem      compare the stems of the values of label (micrograph selections)
+        filename  file the keys were read from (for the summary)
+    '''
+    def __init__(self, name, keys, label, stem=False, filename=None):
+        self.name = name
+        self.label = label
+        self.stem = stem
+        self.filename = filename
+        self.index = KeyIndex(np.array([key.encode() for key in keys], dtype="S"))
+
+    def __len__(self):
+        return len(self.index)
+
+    def mask(self, block, views=None):
+        '''
+        Boolean mask of the rows of the block whose key is in the set.
+        views: {(label, stem): key_codes()} shared by the operands of one block, filled on demand
+        '''
+        views = {} if views is None else views
+        view = (self.label, self.stem)
+        if view not in views:
+            views[view] = key_codes(block, self.label, self.stem)
+        keys, codes = views[view]
+        return (self.index.find(keys) >= 0)[codes]
+
+
+class SetExpression:
+    '''
+    Compiled set expression (see the module description).
+        names     operand names used by the expression
+        mask(block, sets) -> boolean mask of the rows of the block in the result; sets: {name: KeySet}
+    '''
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = self.tokenize(expression)
+        self.pos = 0
+        self.names = []
+        self.tree = self.parse(0)
+        if self.tokens[self.pos][0] != "end":
+            self.error("unexpected '%s'" % self.tokens[self.pos][1])
+        del self.tokens
+
+    @staticmethod
+    def tokenize(expression):
+        "(kind, text, position) of every operator and name"
+        result = []
+        pos = 0
+        expression = expression.rstrip()
+        while pos < len(expression):
+            match = TOKEN.match(expression, pos)
+            if not match:
+                raise ValueError("sets: cannot read '%s' at position %d" % (expression[pos:].strip(), pos + 1))
+            result.append((match.lastgroup, match.group(match.lastgroup), match.start(match.lastgroup) + 1))
+            pos = match.end()
+        result.append(("end", "", len(expression) + 1))
+        return result
+
+    def error(self, message):
+        raise ValueError("sets, position %d: %s" % (self.tokens[self.pos][2], message))
+
+    def parse(self, level):
+        "Operators of the given precedence level and above (left-associative)"
+        if level == len(PRECEDENCE):
+            return self.parse_operand()
+        operator = PRECEDENCE[level][0]
+        node = self.parse(level + 1)
+        while self.tokens[self.pos][1] == operator:
+            self.pos += 1
+            node = (operator, node, self.parse(level + 1))
+        return node
+
+    def parse_operand(self):
+        kind, text, position = self.tokens[self.pos]
+        self.pos += 1
+        if text == "(":
+            node = self.parse(0)
+            if self.tokens[self.pos][1] != ")":
+                self.error("')' expected")
+            self.pos += 1
+            return node
+        if kind == "name":
+            if text not in self.names:
+                self.names.append(text)
+            return ("set", text)
+        self.pos -= 1
+        self.error("set name expected")
+
+    def mask(self, block, sets):
+        "Boolean mask of the rows of the block in the result of the expression"
+        missing = [name for name in self.names if name not in sets]
+        if missing:
+            raise ValueError("sets: %s not defined" % ", ".join(missing))
+        views = {}
+        masks = {name: sets[name].mask(block, views) for name in self.names}
+        return self.evaluate(self.tree, masks), masks
+
+    def evaluate(self, node, masks):
+        operator = node[0]
+        if operator == "set":
+            return masks[node[1]]
+        left, right = self.evaluate(node[1], masks), self.evaluate(node[2], masks)
+        if operator == "|":
+            return left | right
+        if operator == "&":
+            return left & right
+        if operator == "-":
+            return left & ~right
+        return left ^ right
+
+
+class SetSummary:
+    "Rows of the base file matched by every operand, and how many of them end up in the result"
+    def __init__(self, expression, sets):
+        self.expression = expression
+        self.sets = sets
+        self.matched = dict.fromkeys(expression.names, 0)
+        self.kept = dict.fromkeys(expression.names, 0)
+        self.rows = 0
+        self.result = 0
+
+    def add(self, result, masks):
+        self.rows += len(result)
+        self.result += int(result.sum())
+        for name, mask in masks.items():
+            self.matched[name] += int(mask.sum())
+            self.kept[name] += int((mask & result).sum())
+
+    def print(self):
+        print("\n %-6s %-40s %10s %14s %10s %10s" % ("set", "file", "keys", "rows matched", "kept", "dropped"))
+        for name in self.expression.names:
+            keys = self.sets[name]
+            print(" %-6s %-40s %10d %14d %10d %10d" % (name, keys.filename or "", len(keys), self.matched[name],
+                                                      self.kept[name], self.matched[name] - self.kept[name]))
+        print(" => %s: %d of %d rows kept" % (self.expression.expression, self.result, self.rows))
+
+
+def check_columns(labels, sets, name):
+    "Stops with a ValueError if a column compared by the operands is not in the block"
+    missing = sorted(set(keys.label for keys in sets.values()) - set(labels))
+    if missing:
+        raise ValueError("sets: columns %s are not found in data_%s" % (", ".join(missing), name))
+
+
+def select_block(block, expression, sets, query=None):
+    '''
+    Rows of a StarBlock in the result of the expression (and passing the filter query, util/star_query.py):
+    returns (boolean mask, SetSummary)
+    '''
+    check_columns(block.labels, sets, block.name)
+    summary = SetSummary(expression, sets)
+    result, masks = expression.mask(block, sets)
+    if query is not None:
+        result = result & query.mask(block)
+    summary.add(result, masks)
+    return result, summary
+
+
+def select_star(filename, expression, sets, output, query=None, chunk_rows=CHUNK_ROWS):
+    '''
+    Writes the rows of the main block of a star file in the result of the expression (and passing the filter query)
+    into output; the other blocks are copied. The file is memory-mapped and read once: only the key columns
+    (and the columns of the filter) are parsed, chunk_rows rows at a time, and the selected rows are copied verbatim.
+    Returns the SetSummary
+    '''
+    start_time = time.time()
+    summary = SetSummary(expression, sets)
+    columns = sorted(set(keys.label for keys in sets.values()) | set(query.columns if query is not None else ()))
+    with StarMap(filename) as star:
+        main = star.data_block
+        check_columns(main.labels, sets, main.name)
+        if query is not None:
+            missing = [label for label in query.columns if label not in main.labels]
+            if missing:
+                raise ValueError("filter: columns %s are not found in data_%s" % (", ".join(missing), main.name))
+
+        def select(block):
+            result, masks = expression.mask(block, sets)
+            if query is not None:
+                result = result & query.mask(block)
+            summary.add(result, masks)
+            return result
+        write_selected(star, output, columns, select, chunk_rows)
+    seconds = max(time.time() - start_time, 1e-6)
+    summary.print()
+    print(" => %.2f s, %.0f rows/s" % (seconds, summary.rows / seconds))
+    print(" => %s created!" % output)
+    return summary
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Neighbours of particles on the same micrograph with a uniform grid (spatial hash):
+
+    grid = PointGrid(groups, x, y, cell=10)        # groups: micrograph code of every particle
+    probe, point = grid.candidates(groups, x, y)   # pairs in the same or a neighbouring cell
+    keep = dedup_mask(groups, x, y, 10, score)     # no two kept particles closer than 10 pixels
+    keep = dedup_block(block, 10, "_rlnAutopickFigureOfMerit")
+    rows, ref_rows = match_blocks(block, reference, 5, scale=4)   # same particles in two extractions
+
+Points are sorted once by (group, cell row, cell column); a cell is found by binary search and its points are
+a slice of the sorted order, so with a cell size equal to the distance only the 3x3 neighbouring cells are compared.
+Used by star_modif.py --dedup and star_coord_join.py.
+'''
+
+import time
+
+import numpy as np
+
+from util.star_groups import GROUP_COLUMN
+from util.star_join import stem_codes
+from util.star_table import read_star
+
+ver=20261017
+
+COORDINATES = ("_rlnCoordinateX", "_rlnCoordinateY")
+DEFAULT_SCORE = "_rlnAutopickFigureOfMerit"
+
+NEIGHBOURS = tuple((dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1))
+
+
+class PointGrid:
+    '''
+    Uniform grid of the points (x, y) of every group, cells of size "cell".
+        order   point numbers sorted by cell
+        keys    cell key of the sorted points
+    '''
+    def __init__(self, groups, x, y, cell):
+        if not cell > 0:
+            raise ValueError("the cell size must be positive")
+        self.cell = float(cell)
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        if len(x):
+            # one empty cell of margin around the points: neighbours of a cell never wrap to another row or group
+            self.x0 = int(np.floor(x.min() / self.cell)) - 1
+            self.y0 = int(np.floor(y.min() / self.cell)) - 1
+            self.nx = int(np.floor(x.max() / self.cell)) - self.x0 + 2
+            self.ny = int(np.floor(y.max() / self.cell)) - self.y0 + 2
+        else:
+            self.x0 = self.y0 = 0
+            self.nx = self.ny = 1
+        keys = self.key(np.asarray(groups), *self.cells(x, y))
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+        # end of the run of the points of the same cell, for every sorted point
+        last = np.flatnonzero(np.diff(self.keys)) + 1
+        self.ends = np.repeat(np.append(last, len(keys)), np.diff(np.concatenate(([0], last, [len(keys)]))))
+
+    def cells(self, x, y):
+        "Column and row of the cells of the points (may be outside the grid for other points)"
+        cx = np.floor(np.asarray(x, dtype=np.float64) / self.cell).astype(np.int64) - self.x0
+        cy = np.floor(np.asarray(y, dtype=np.float64) / self.cell).astype(np.int64) - self.y0
+        return cx, cy
+
+    def key(self, groups, cx, cy):
+        return (groups.astype(np.int64) * self.ny + cy) * self.nx + cx
+
+    def candidates(self, groups, x, y, offsets=NEIGHBOURS):
+        '''
+        Pairs (probe, point) of the probe points (groups, x, y) and the points of the grid lying in the same
+        or a neighbouring cell of the same group: candidates of the pairs closer than the cell size
+        '''
+        if not len(self.keys):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        groups = np.asarray(groups)
+        cx, cy = self.cells(x, y)
+        base = self.key(groups, cx, cy)
+        # probes in the order of their cells: the keys of a neighbouring cell (base + constant) stay sorted,
+        # which makes the binary searches many times faster than with random keys
+        sorted_probes = np.argsort(base, kind="stable")
+        base, cx, cy = base[sorted_probes], cx[sorted_probes], cy[sorted_probes]
+        probes, points = [], []
+        for dx, dy in offsets:
+            nx, ny = cx + dx, cy + dy
+            keys = base + (dy * self.nx + dx)
+            start = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            found = (self.keys[start] == keys) & (nx >= 0) & (nx < self.nx) & (ny >= 0) & (ny < self.ny)
+            counts = np.where(found, self.ends[start] - start, 0)
+            total = int(counts.sum())
+            if not total:
+                continue
+            probe = np.repeat(np.arange(len(counts)), counts)
+            within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            probes.append(sorted_probes[probe])
+            points.append(self.order[start[probe] + within])
+        if not probes:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(probes), np.concatenate(points)
+
+
+def close_pairs(groups, x, y, distance):
+    "Pairs (i, j), i < j, of the points of the same group closer than distance"
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    grid = PointGrid(groups, x, y, distance)
+    i, j = grid.candidates(groups, x, y)
+    keep = i < j
+    i, j = i[keep], j[keep]
+    close = (x[i] - x[j]) ** 2 + (y[i] - y[j]) ** 2 < distance ** 2
+    return i[close], j[close]
+
+
+def dedup_mask(groups, x, y, distance, score=None):
+    '''
+    Keeps the best particle of every cluster of particles closer than distance on the same micrograph
+    (greedy non-maximum suppression: a particle is dropped if a kept one with a higher score, or the same score
+    and an earlier row, is closer than distance). Returns the boolean mask of the particles kept.
+    The greedy order is resolved in rounds over the close pairs: in every round the undecided particles without
+    a better undecided neighbour are kept and their neighbours dropped
+    '''
+    n = len(x)
+    i, j = close_pairs(groups, x, y, distance)
+    # rank 0 is the best particle
+    order = np.lexsort((np.arange(n), -np.asarray(score, dtype=np.float64))) if score is not None else np.arange(n)
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    better, worse = np.where(rank[i] < rank[j], i, j), np.where(rank[i] < rank[j], j, i)
+    state = np.zeros(n, dtype=np.int8)           # 0 undecided, 1 kept, 2 dropped
+    while len(better):
+        dominated = np.zeros(n, dtype=bool)
+        dominated[worse] = True
+        kept = (state == 0) & ~dominated
+        state[kept] = 1
+        state[worse[kept[better]]] = 2
+        # pairs between undecided particles are left for the next round
+        open_pairs = (state[better] == 0) & (state[worse] == 0)
+        better, worse = better[open_pairs], worse[open_pairs]
+    state[state == 0] = 1
+    return state == 1
+
+
+def dedup_block(block, distance, score=None, label=GROUP_COLUMN):
+    '''
+    dedup_mask() of the rows of a StarBlock: particles of the same micrograph (label) closer than distance pixels,
+    the one with the highest score column is kept (default: _rlnAutopickFigureOfMerit if present, otherwise the first row)
+    '''
+    if score is None and DEFAULT_SCORE in block:
+        score = DEFAULT_SCORE
+    elif score and score[:1] != "_":
+        score = "_" + score
+    missing = [column for column in (label,) + COORDINATES + ((score,) if score else ()) if column not in block]
+    if missing:
+        raise ValueError("columns %s are not found in data_%s" % (", ".join(missing), block.name))
+    if score and block[score].dtype.kind not in "iuf":
+        raise ValueError("column %s is not numeric" % score)
+    uniques, codes = block.factorize(label)
+    x, y = (block[column] for column in COORDINATES)
+    return dedup_mask(codes, x, y, distance, block[score] if score else None)
+
+
+def first_of(keys):
+    "Boolean mask of the first occurrence of every key"
+    first = np.zeros(len(keys), dtype=bool)
+    first[np.unique(keys, return_index=True)[1]] = True
+    return first
+
+
+def match_points(groups, x, y, ref_groups, ref_x, ref_y, distance):
+    '''
+    One-to-one matching of the points (groups, x, y) with the reference points of the same group closer than distance:
+    returns (points, reference points) matched. The closest pairs are matched first (greedy by distance; ties by point
+    number); every round matches the remaining pairs which are the closest one of both their points
+    '''
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    ref_x, ref_y = np.asarray(ref_x, dtype=np.float64), np.asarray(ref_y, dtype=np.float64)
+    grid = PointGrid(ref_groups, ref_x, ref_y, distance)
+    a, b = grid.candidates(groups, x, y)
+    d2 = (x[a] - ref_x[b]) ** 2 + (y[a] - ref_y[b]) ** 2
+    close = d2 < distance ** 2
+    order = np.lexsort((b[close], a[close], d2[close]))
+    a, b = a[close][order], b[close][order]
+    matched_a, matched_b = [], []
+    while len(a):
+        # pairs are sorted by distance: the first pair of a point is its closest one
+        matched = first_of(a) & first_of(b)
+        matched_a.append(a[matched])
+        matched_b.append(b[matched])
+        left = ~np.isin(a, a[matched]) & ~np.isin(b, b[matched])
+        a, b = a[left], b[left]
+    if not matched_a:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    a, b = np.concatenate(matched_a), np.concatenate(matched_b)
+    order = np.argsort(a, kind="stable")
+    return a[order], b[order]
+
+
+def shared_codes(block, reference, label=GROUP_COLUMN):
+    "Micrograph codes of the rows of both blocks, compared by stem; -1 for micrographs absent in the other block"
+    stems, codes = stem_codes(block, label)
+    ref_stems, ref_codes = stem_codes(reference, label)
+    numbers = {stem: i for i, stem in enumerate(stems)}
+    ref_numbers = np.array([numbers.get(stem, -1) for stem in ref_stems], dtype=np.int64)
+    return np.asarray(codes, dtype=np.int64), ref_numbers[ref_codes]
+
+
+def match_blocks(block, reference, distance, scale=1.0, label=GROUP_COLUMN):
+    '''
+    match_points() of the particles of two StarBlocks on the same micrographs (label, compared by stem), e.g. two
+    extractions of the same picks. The reference coordinates are multiplied by scale first (binned extraction: see
+    mult_coord.py), distance is in pixels of block. Returns (rows of block, rows of reference) matched
+    '''
+    for data in (block, reference):
+        missing = [column for column in (label,) + COORDINATES if column not in data]
+        if missing:
+            raise ValueError("columns %s are not found in data_%s" % (", ".join(missing), data.name))
+    codes, ref_codes = shared_codes(block, reference, label)
+    present = np.flatnonzero(ref_codes >= 0)
+    x, y = (block[column] for column in COORDINATES)
+    ref_x, ref_y = (reference[column][present] * scale for column in COORDINATES)
+    rows, ref_rows = match_points(codes, x, y, ref_codes[present], ref_x, ref_y, distance)
+    return rows, present[ref_rows]
+
+
+def merge_columns(block, reference, rows, ref_rows, columns=None):
+    '''
+    New block with the rows of block and the columns of the reference rows matched to them: the given columns
+    (replaced if present in block) or, by default, the reference columns absent in block
+    '''
+    if columns is None:
+        columns = [column for column in reference.ordered_labels() if column not in block]
+    missing = [column for column in columns if column not in reference]
+    if missing:
+        raise ValueError("columns %s are not found in data_%s of the reference" % (", ".join(missing), reference.name))
+    merged = block.take(rows)
+    for column in columns:
+        merged.labels.setdefault(column, len(merged.labels) + 1)
+        merged.formats[column] = reference.formats[column]
+        merged.categories.pop(column, None)
+        if column in reference.categories:
+            merged.categories[column] = reference.categories[column]
+        merged.columns[column] = reference.columns[column][ref_rows]
+    return merged
+
+
+def join_star(filename, reference, output, distance, scale=1.0, columns=None):
+    '''
+    Writes the particles of a star file matched by coordinates to the particles of a reference star file
+    (match_blocks), with the columns of the reference merged in (merge_columns). Returns the counts of the matches
+    '''
+    start_time = time.time()
+    table = read_star(filename)
+    ref_block = read_star(reference).data_block
+    block = table.data_block
+    rows, ref_rows = match_blocks(block, ref_block, distance, scale)
+    if columns is None:
+        columns = [column for column in ref_block.ordered_labels() if column not in block]
+    merged = merge_columns(block, ref_block, rows, ref_rows, columns)
+    table.blocks[block.name] = merged
+    codes, ref_codes = shared_codes(block, ref_block)
+    counts = {"matched": len(rows), "rows": len(block), "ref_rows": len(ref_block),
+              "unmatched": len(block) - len(rows), "ref_unmatched": len(ref_block) - len(rows),
+              "ref_absent": int((ref_codes < 0).sum())}
+    print(" => %(matched)d particles matched: %(unmatched)d of %(rows)d particles and %(ref_unmatched)d of %(ref_rows)d "
+          "reference particles unmatched (%(ref_absent)d of them on micrographs absent in the input)" % counts)
+    print(" => columns merged: %s (%.2f s)" % (", ".join(columns) or "none", time.time() - start_time))
+    table.write(output)
+    return counts
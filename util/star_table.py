@@ -0,0 +1,766 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Columnar star-file tables: every column of a loop is kept as one NumPy array.
+
+    table = read_star("particles.star")
+    particles = table.data_block
+    particles["_rlnCoordinateX"] *= 2          # vectorized
+    table.write("particles_bin2.star")
+
+Column types are chosen so that writing the table back is lossless:
+    int32/int64   integer columns (e.g. "1", "-3")
+    float64       columns with a fixed number of decimals (e.g. "1.090000"), written back with the same "%.Nf"
+    bytes (S)     everything else; repeated strings (micrograph names) are dictionary-encoded
+'''
+
+import bz2
+import collections
+import functools
+import gzip
+import lzma
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from util.star_helper import KEY_COLUMNS, compression, open_star
+
+ver=20261017
+
+CHUNK_ROWS = 100000          # rows tokenized at once
+CATEGORY_SAMPLE = 1000       # rows used to decide if a string column is worth dictionary-encoding
+MAX_EXACT = 2 ** 53          # largest integer exactly represented in float64
+MAX_DIGITS = 15              # significant digits which survive a float64 round trip
+READ_BYTES = 1 << 23         # size of the blocks of data rows read at once
+WRITE_BYTES = 1 << 23        # output is written to the disk in blocks of this size
+PARALLEL_MIN_BYTES = 1 << 26  # smaller files are parsed in one process even if more workers are allowed
+# compression of the output by the file extension; every block is compressed separately (a multi-stream file)
+COMPRESSORS = {".gz": functools.partial(gzip.compress, compresslevel=6), ".xz": lzma.compress, ".bz2": bz2.compress}
+# a line starting with one of these ends the data rows of a loop
+ROW_END = re.compile(rb"\n(?:data_|loop_|_|#)")
+ROW_END_AT_START = (b"data_", b"loop_", b"_", b"#")
+POW10 = 10 ** np.arange(19, dtype=np.int64)
+
+
+def tokenize(buf, n_cols, first_line=1):
+    '''
+    Splits a buffer of data rows (bytes) into fields without creating Python objects per field.
+    Returns (data, starts, ends): the buffer as a uint8 array and the field boundaries as (n_rows, n_cols) arrays.
+    Raises ValueError with the line number (counted from first_line) of the first row with a wrong number of fields
+    '''
+    data = np.frombuffer(buf, dtype=np.uint8)
+    space = data <= 32
+    start_flag = ~space
+    end_flag = start_flag.copy()
+    start_flag[1:] &= space[:-1]
+    end_flag[:-1] &= space[1:]
+    starts = np.flatnonzero(start_flag)
+    ends = np.flatnonzero(end_flag) + 1
+    # number of fields in each line (blank lines have none)
+    newlines = np.flatnonzero(data == 10)
+    per_line = np.diff(np.concatenate(([0], np.searchsorted(starts, newlines), [starts.size])))
+    bad = np.flatnonzero((per_line != 0) & (per_line != n_cols))
+    if bad.size:
+        raise ValueError("line %d: %d fields found, %d expected" % (first_line + bad[0], per_line[bad[0]], n_cols))
+    return data, starts.reshape(-1, n_cols), ends.reshape(-1, n_cols)
+
+
+def field_matrix(data, starts, ends):
+    '''
+    Gathers fields given by their boundaries into a (n, width) uint8 matrix, left-aligned and padded with zeros,
+    i.e. the memory layout of a NumPy bytes array of dtype S<width>. Returns (matrix, lengths)
+    '''
+    lengths = ends - starts
+    width = max(int(lengths.max()), 1) if lengths.size else 1
+    dtype = np.int32 if data.size + width < np.iinfo(np.int32).max else np.int64
+    offsets = np.arange(width, dtype=dtype)
+    index = starts.astype(dtype)[:, None] + offsets
+    matrix = np.take(data, index, mode="clip")
+    matrix *= offsets < lengths[:, None]
+    return matrix, lengths
+
+
+def matrix_text(matrix):
+    "Fields gathered by field_matrix as a bytes (S) array"
+    n, width = matrix.shape
+    return np.ascontiguousarray(matrix).view("S%d" % width).reshape(n)
+
+
+def parse_column(matrix, lengths):
+    '''
+    Chooses the lossless type of one column given as gathered fields (see field_matrix). Returns (values, fmt):
+        int32/int64 and "%d"      for integers written without leading zeros or "+"
+        float64 and "%.Nf"        for numbers with exactly N decimals and at most 15 significant digits
+        bytes (S) and None        for everything else
+    '''
+    n, width = matrix.shape
+    if n == 0 or not ((matrix[:, 0] - np.uint8(48) < 10) | (matrix[:, 0] == 45)).all():
+        return matrix_text(matrix), None
+    # one row per character position; character classes after subtracting "0": digits 0..9, "." 254, "-" 253, padding 208
+    shifted = np.ascontiguousarray(matrix.T) - np.uint8(48)
+    digit = shifted < 10
+    dot = shifted == 254
+    negative = shifted[0] == 253
+    allowed = digit | dot | (shifted == 208)
+    allowed[0] |= negative
+    if not allowed.all():
+        return matrix_text(matrix), None
+    n_dots = dot.sum(axis=0)
+    first = negative.astype(np.int64)
+    if n_dots.max() == 0:
+        n_digits = lengths - first
+        decimals = 0
+    elif n_dots.min() == 1 and n_dots.max() == 1:
+        dot_position = dot.argmax(axis=0)
+        decimals = lengths - dot_position - 1
+        if decimals.min() != decimals.max() or decimals[0] < 1:
+            return matrix_text(matrix), None
+        decimals = int(decimals[0])
+        n_digits = lengths - first - 1
+        if (dot_position - first).min() < 1:
+            return matrix_text(matrix), None
+    else:
+        return matrix_text(matrix), None
+    if n_digits.min() < 1 or n_digits.max() > MAX_DIGITS:
+        return matrix_text(matrix), None
+    first_digit = shifted[first, np.arange(n)]
+    if ((first_digit == 0) & (n_digits - decimals > 1)).any():
+        return matrix_text(matrix), None
+    value = np.zeros(n, dtype=np.int64)
+    for j in range(width):
+        value = np.where(digit[j], value * 10 + shifted[j], value)
+    if decimals == 0:
+        if (negative & (value == 0)).any():
+            return matrix_text(matrix), None
+        value = np.where(negative, -value, value)
+        if value.min() >= np.iinfo(np.int32).min and value.max() <= np.iinfo(np.int32).max:
+            value = value.astype(np.int32)
+        return value, "%d"
+    # value / 10**decimals is correctly rounded, i.e. the same float64 as float(text)
+    result = value / float(POW10[decimals])
+    return np.where(negative, -result, result), "%%.%df" % decimals
+
+
+def number_matrix(values, decimals):
+    '''
+    Vectorized "%.<decimals>f" (or "%d" for decimals=0) of a numeric array as a (n, width) uint8 matrix.
+    Numbers are right-aligned and padded with zeros, which are dropped when the rows are joined (see join_rows).
+    Returns None if the values are not finite or too large for exact integer arithmetic
+    '''
+    values = np.asarray(values)
+    n = values.size
+    negative = np.signbit(values) if values.dtype.kind == "f" else values < 0
+    if values.dtype.kind == "f":
+        scaled = np.rint(np.abs(values) * float(POW10[decimals]))
+        if n and (not np.isfinite(scaled).all() or scaled.max() >= MAX_EXACT):
+            return None
+        scaled = scaled.astype(np.int64)
+    else:
+        scaled = np.abs(values.astype(np.int64))
+    n_digits = np.maximum(np.searchsorted(POW10, scaled, side="right"), decimals + 1)
+    max_digits = int(n_digits.max()) if n else 1
+    has_dot = 1 if decimals else 0
+    width = max_digits + has_dot + (1 if negative.any() else 0)
+    columns = np.zeros((width, n), dtype=np.uint8)
+    position = width - 1
+    for i in range(max_digits):
+        if decimals and i == decimals:
+            columns[position] = 46
+            position -= 1
+        columns[position] = np.where(i < n_digits, scaled % 10 + 48, 0)
+        scaled //= 10
+        position -= 1
+    rows = np.flatnonzero(negative)
+    columns[width - 1 - n_digits[rows] - has_dot, rows] = 45
+    return columns.T
+
+
+def text_matrix(text):
+    "Bytes (S) array as a (n, width) uint8 matrix"
+    text = np.ascontiguousarray(text)
+    width = max(text.dtype.itemsize, 1)
+    if text.dtype.itemsize == 0:
+        text = text.astype("S1")
+    return text.view(np.uint8).reshape(len(text), width)
+
+
+def format_column(values, fmt):
+    "Converts a column to text (bytes array, left-aligned) with its format: None (text), '%d' or '%.Nf'"
+    if fmt is None:
+        return values
+    return np.array([fmt % value for value in values.tolist()], dtype="S")
+
+
+def column_matrix(values, fmt):
+    "Converts a column to a uint8 matrix (see number_matrix, text_matrix) with its format"
+    if fmt is None:
+        return text_matrix(values)
+    if fmt == "%d" and values.dtype.kind in "iu":
+        return number_matrix(values, 0)
+    if fmt[:2] == "%." and fmt[-1] == "f" and values.dtype.kind in "fiu":
+        matrix = number_matrix(values.astype(np.float64), int(fmt[2:-1]))
+        if matrix is not None:
+            return matrix
+    return text_matrix(format_column(values, fmt))
+
+
+def join_rows(matrices, separator=b" ", end=b" \n"):
+    '''
+    Joins column matrices into the text of the rows: fields separated by one space, rows ending with " \n"
+    (the layout of write_out_star). Zero bytes (padding) are dropped. Returns bytes
+    '''
+    if not matrices:
+        return b""
+    n = matrices[0].shape[0]
+    width = sum(matrix.shape[1] for matrix in matrices) + len(separator) * (len(matrices) - 1) + len(end)
+    out = np.zeros((n, width), dtype=np.uint8)
+    position = 0
+    for i, matrix in enumerate(matrices):
+        out[:, position:position + matrix.shape[1]] = matrix
+        position += matrix.shape[1]
+        if i < len(matrices) - 1:
+            out[:, position:position + len(separator)] = np.frombuffer(separator, dtype=np.uint8)
+            position += len(separator)
+    out[:, position:] = np.frombuffer(end, dtype=np.uint8)
+    return out[out != 0].tobytes()
+
+
+def infer_column(raw):
+    '''
+    For a bytes (S) array of the tokens of one column returns (values, fmt):
+    the typed array and the format which reproduces the original text exactly (see parse_column)
+    '''
+    return parse_column(text_matrix(raw), np.char.str_len(raw) if raw.size else np.zeros(0, dtype=np.int64))
+
+
+def factorize(values):
+    '''
+    Hash-based dictionary encoding: returns (uniques, codes) with uniques[codes] == values,
+    uniques in the order of their first appearance
+    '''
+    seen = {}
+    codes = np.empty(len(values), dtype=np.int32)
+    for start in range(0, len(values), CHUNK_ROWS):
+        part = values[start:start + CHUNK_ROWS].tolist()
+        codes[start:start + len(part)] = [seen.setdefault(value, len(seen)) for value in part]
+    return np.array(list(seen), dtype=values.dtype), codes
+
+
+class StarBlock:
+    '''
+    One data_ block of a star file.
+        name      block name without "data_" (e.g. "optics", "particles")
+        version   "# version" line in front of the block (None if absent)
+        loop      True for "loop_" blocks, False for "_rlnLabel value" pairs
+        labels    column name -> column number (1-based, as "#N" in the header)
+        columns   column name -> NumPy array (for dictionary-encoded columns: int32 codes)
+        formats   column name -> "%d", "%.Nf" or None (text) used to write the column back
+        categories column name -> unique values of a dictionary-encoded string column
+        original  (rows, texts): data rows as they were in the file and the text of every column at that time;
+                  the rows are written back unchanged as long as the columns are unchanged (kept for data_optics only)
+    '''
+    def __init__(self, name, version=None, loop=True):
+        self.name = name
+        self.version = version
+        self.loop = loop
+        self.labels = {}
+        self.columns = {}
+        self.formats = {}
+        self.categories = {}
+        self.original = None
+
+    def __len__(self):
+        for values in self.columns.values():
+            return len(values)
+        return 0
+
+    def __contains__(self, label):
+        return label in self.columns
+
+    def __getitem__(self, label):
+        "Returns the column as a NumPy array (string columns are decoded to bytes)"
+        if label in self.categories:
+            return self.categories[label][self.columns[label]]
+        return self.columns[label]
+
+    def __setitem__(self, label, values):
+        '''
+        Replaces or appends a column. The format is kept for existing numeric columns;
+        new float columns are written as "%.6f" (Relion default), integers as "%d"
+        '''
+        values = np.asarray(values)
+        if len(self.columns) and len(values) != len(self):
+            raise ValueError("Column %s has %d rows, the block %s has %d" % (label, len(values), self.name, len(self)))
+        if values.dtype.kind == "U":
+            values = values.astype("S")
+        if values.dtype.kind == "f":
+            fmt = self.formats.get(label)
+            if fmt is None or fmt == "%d":
+                fmt = "%.6f"
+        elif values.dtype.kind in "iu":
+            fmt = "%d"
+        elif values.dtype.kind == "b":
+            values, fmt = values.astype(np.int32), "%d"
+        else:
+            fmt = None
+        if label not in self.labels:
+            self.labels[label] = len(self.labels) + 1
+        self.categories.pop(label, None)
+        self.columns[label] = values
+        self.formats[label] = fmt
+
+    def ordered_labels(self):
+        "Column names in the order of their #N numbers"
+        return sorted(self.labels, key=self.labels.get)
+
+    def index(self, label):
+        "0-based position of a column in a data row"
+        return self.labels[label] - 1
+
+    def set_column(self, label, values, fmt):
+        '''
+        Stores a parsed column (see parse_column) with its format.
+        Text columns with many repeated values (micrograph names) are dictionary-encoded
+        '''
+        self.labels.setdefault(label, len(self.labels) + 1)
+        self.formats[label] = fmt
+        self.categories.pop(label, None)
+        if fmt is None and len(values) > 1:
+            sample = values[:CATEGORY_SAMPLE]
+            if len(set(sample.tolist())) * 2 <= len(sample):
+                self.categories[label], values = factorize(values)
+        self.columns[label] = values
+
+    def factorize(self, label):
+        '''
+        Dictionary encoding of a column: returns (uniques, codes) with uniques[codes] == column.
+        Free for dictionary-encoded columns
+        '''
+        if label in self.categories:
+            return self.categories[label], self.columns[label]
+        return factorize(self.columns[label])
+
+    def unique(self, label):
+        "Unique values of a column present in the rows, in the order of their first appearance"
+        uniques, codes = self.factorize(label)
+        used, first = np.unique(codes, return_index=True)
+        return uniques[used[np.argsort(first)]]
+
+    def text(self, label):
+        "Column as bytes exactly as it will be written"
+        if label in self.categories:
+            return self.categories[label][self.columns[label]]
+        return format_column(self.columns[label], self.formats[label])
+
+    def take(self, rows):
+        "Returns a new block with a subset of the rows (index array or boolean mask)"
+        new = StarBlock(self.name, self.version, self.loop)
+        new.labels = dict(self.labels)
+        new.formats = dict(self.formats)
+        new.categories = dict(self.categories)
+        new.columns = {label: values[rows] for label, values in self.columns.items()}
+        return new
+
+    def select(self, labels):
+        "Returns a new block with the given columns only, numbered in the given order (the arrays are shared)"
+        missing = [label for label in labels if label not in self.columns]
+        if missing:
+            raise KeyError("Columns %s are not found in data_%s" % (", ".join(missing), self.name))
+        new = StarBlock(self.name, self.version, self.loop)
+        for i, label in enumerate(labels):
+            new.labels[label] = i + 1
+            new.formats[label] = self.formats[label]
+            new.columns[label] = self.columns[label]
+            if label in self.categories:
+                new.categories[label] = self.categories[label]
+        return new
+
+    def keep_original(self, rows):
+        "Remembers the data rows as they are in the file (bytes) to write them back verbatim while the block is unchanged"
+        lines = [line for line in rows.split(b"\n") if line.strip()]
+        if len(lines) == len(self):
+            texts = {label: self.text(label) for label in self.ordered_labels()}
+            self.original = (b"".join(line + b"\n" for line in lines), texts)
+
+    def unchanged(self):
+        "True if the rows are the same as in the file (see keep_original)"
+        if self.original is None:
+            return False
+        rows, texts = self.original
+        return self.ordered_labels() == list(texts) and all(
+            np.array_equal(self.text(label), text) for label, text in texts.items())
+
+    def row(self, i):
+        "One data row as a list of strings"
+        return [self.text_value(label, i) for label in self.ordered_labels()]
+
+    def text_value(self, label, i):
+        return format_column(self[label][i:i + 1], self.formats[label])[0].decode()
+
+    def header_text(self):
+        "data_ / loop_ header of the block"
+        text = "\n"
+        if self.version is not None:
+            text += "# version %s\n" % self.version
+        text += "data_%s\n" % self.name
+        if self.loop:
+            text += "loop_ \n"
+            text += "".join("%s #%d \n" % (label, self.labels[label]) for label in self.ordered_labels())
+        return text
+
+    def rows_text(self, start=0, stop=None):
+        "Data rows from start to stop as bytes: fields separated by spaces, each row ends with ' \\n'"
+        stop = len(self) if stop is None else min(stop, len(self))
+        if not self.loop:
+            return "".join("%s %s\n" % (label, self.text(label)[0].decode()) for label in self.ordered_labels()).encode()
+        if stop <= start or not self.labels:
+            return b""
+        if start == 0 and stop == len(self) and self.unchanged():
+            return self.original[0]
+        matrices = []
+        for label in self.ordered_labels():
+            values = self.columns[label][start:stop]
+            if label in self.categories:
+                matrices.append(text_matrix(self.categories[label][values]))
+            else:
+                matrices.append(column_matrix(values, self.formats[label]))
+        return join_rows(matrices)
+
+
+class StarWriter:
+    '''
+    Buffered star-file writer: text is collected in memory and written to the disk in blocks of buffer_bytes.
+    With atomic=True the file is written as <filename>.tmp<pid> and renamed to filename when complete,
+    so an interrupted run never leaves a truncated star file:
+        with StarWriter("particles_new.star") as writer:
+            writer.write(block.header_text())
+            writer.write_rows(rows)
+    Files ending with .gz, .xz or .bz2 are compressed: the blocks are compressed in parallel by a pool of threads
+    and written in their order as concatenated streams, which gzip, xz, bzip2 and open_star() read as one file
+    '''
+    def __init__(self, filename, buffer_bytes=WRITE_BYTES, atomic=True, threads=None):
+        self.filename = filename
+        self.buffer_bytes = buffer_bytes
+        self.path = "%s.tmp%d" % (filename, os.getpid()) if atomic else filename
+        self.file = open(self.path, "wb")
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+        self.compress = COMPRESSORS.get(os.path.splitext(filename)[1])
+        self.threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(self.threads) if self.compress else None
+        self.pending = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error, *args):
+        if error is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, text):
+        "Adds text (str or bytes) to the buffer; writes the buffer out when it is full"
+        if isinstance(text, str):
+            text = text.encode()
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_bytes:
+            self.flush()
+
+    def write_rows(self, rows):
+        "Adds data rows given as lists of strings, written as 'field1 field2 ... fieldN \\n'"
+        for row in rows:
+            self.write(" ".join(row) + " \n")
+
+    def flush(self):
+        if self.buffer:
+            data = b"".join(self.buffer)
+            self.written += self.buffered
+            self.buffer, self.buffered = [], 0
+            if self.compress is None:
+                self.file.write(data)
+                return
+            # the compressors release the GIL: up to 2 blocks per thread are compressed at once
+            self.pending.append(self.pool.submit(self.compress, data))
+            while len(self.pending) > 2 * self.threads:
+                self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        "Writes the rest of the buffer and moves the temporary file to its place"
+        self.flush()
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.file.close()
+        if self.path != self.filename:
+            os.replace(self.path, self.filename)
+
+    def abort(self):
+        "Closes and deletes an incomplete temporary file"
+        for future in self.pending:
+            future.cancel()
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.file.close()
+        if self.path != self.filename:
+            os.remove(self.path)
+
+
+class StarTable:
+    '''
+    All data_ blocks of a star file in their order:
+        table.blocks["optics"], table.blocks["particles"]
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.blocks = {}
+
+    def __contains__(self, name):
+        return name in self.blocks
+
+    def __getitem__(self, name):
+        return self.blocks[name]
+
+    def add_block(self, block):
+        self.blocks[block.name] = block
+        return block
+
+    @property
+    def optics(self):
+        return self.blocks.get("optics")
+
+    def select(self, columns):
+        "New table with the given columns only (data_optics is kept in full); the arrays are shared"
+        table = StarTable(self.filename)
+        for name, block in self.blocks.items():
+            if name != "optics":
+                block = block.select([label for label in block.ordered_labels() if label in columns])
+            table.add_block(block)
+        return table
+
+    @property
+    def data_block(self):
+        "The main block: the last block which is not data_optics (data_particles, data_micrographs, data_movies)"
+        main = None
+        for name, block in self.blocks.items():
+            if name != "optics":
+                main = block
+        return main
+
+    @property
+    def data_type(self):
+        "Star-file type as in star_analyze: particles, micrographs, movies"
+        block = self.data_block
+        return block.name if block is not None else None
+
+    @property
+    def key_label(self):
+        "Name of the column identifying each row (_rlnImageName for particles etc.)"
+        return KEY_COLUMNS.get(self.data_type)
+
+    def write(self, filename, columns=None, buffer_bytes=WRITE_BYTES, atomic=True):
+        '''
+        Writes out the table as a star file (see StarWriter), whole column chunks formatted at once.
+            columns   list of columns of the main block to write out, in this order (default: all);
+                      or a dictionary {block name: list of columns}
+        '''
+        if columns is not None and not isinstance(columns, dict):
+            columns = {self.data_block.name: columns}
+        with StarWriter(filename, buffer_bytes, atomic) as writer:
+            for block in self.blocks.values():
+                if columns and block.name in columns:
+                    block = block.select(columns[block.name])
+                writer.write(block.header_text())
+                for start in range(0, max(len(block), 1), CHUNK_ROWS):
+                    writer.write(block.rows_text(start, start + CHUNK_ROWS))
+            writer.write(b"\n")
+        print(" => %s created!" % filename)
+
+
+def star_sections(star_file, chunk_bytes=READ_BYTES, lines=False):
+    '''
+    Reads a star file opened in binary mode and yields tuples (kind, value):
+        ("version", "30001"), ("data", "particles"), ("loop", None),
+        ("label", ("_rlnImageName", 6)), ("pair", ("_rlnLabel", "value")) for labels outside of a loop,
+        ("rows", (buffer, first_line))  data rows of a loop as large bytes buffers ending at a line end;
+                                        first_line is the line number of the first row in the file
+    Header lines are read one by one, data rows in blocks of chunk_bytes.
+    lines=True: yields (kind, value, line number) and ("truncated", None, line number) if the last line has no line end
+    '''
+    def section(kind, value):
+        return (kind, value, line_no + 1) if lines else (kind, value)
+    buf = b""
+    pos = 0
+    line_no = 0
+    eof = False
+    while True:
+        newline = buf.find(b"\n", pos)
+        if newline < 0:
+            if not eof:
+                more = star_file.read(chunk_bytes)
+                eof = not more
+                buf, pos = buf[pos:] + more, 0
+                continue
+            if pos >= len(buf):
+                return
+            buf, newline = buf + b"\n", len(buf)
+            if lines:
+                yield "truncated", None, line_no + 1
+        line = buf[pos:newline + 1]
+        stripped = line.strip()
+        if not stripped or line[:1] == b"#":
+            if line[:10] == b"# version ":
+                yield section("version", line.split()[2].decode())
+        elif line[:5] == b"data_":
+            yield section("data", stripped[5:].decode())
+        elif line[:5] == b"loop_":
+            yield section("loop", None)
+        elif line[:1] == b"_":
+            fields = line.split()
+            if len(fields) > 1 and fields[1][:1] == b"#":
+                yield section("label", (fields[0].decode(), int(fields[1][1:])))
+            else:
+                yield section("pair", (fields[0].decode(), fields[1].decode() if len(fields) > 1 else ""))
+        else:
+            # first data row of a loop: read the rows in large blocks up to the next header line
+            while True:
+                ends = ROW_END.search(buf, pos)
+                if ends:
+                    end = ends.start() + 1
+                elif eof:
+                    end = len(buf)
+                else:
+                    end = buf.rfind(b"\n", pos) + 1
+                if end > pos:
+                    rows = buf[pos:end]
+                    if rows[-1:] != b"\n":
+                        if lines:
+                            yield "truncated", None, line_no + rows.count(b"\n") + 1
+                        rows += b"\n"
+                    yield section("rows", (rows, line_no + 1))
+                    line_no += rows.count(b"\n")
+                    pos = end
+                if ends or eof:
+                    break
+                more = star_file.read(chunk_bytes)
+                eof = not more
+                buf, pos = buf[pos:] + more, 0
+                if buf.startswith(ROW_END_AT_START):
+                    break
+            continue
+        line_no += 1
+        pos = newline + 1
+
+
+def _finish_block(block, labels, chunks, rows=()):
+    "Merges the parsed chunks of every column of a loop into the block; rows: original data rows to keep (data_optics)"
+    for i, label in enumerate(labels):
+        parts, chunks[i] = chunks[i], None
+        formats = set(fmt for values, fmt in parts)
+        if not parts:
+            block.set_column(label, np.array([], dtype="S1"), None)
+        elif len(formats) == 1:
+            block.set_column(label, np.concatenate([values for values, fmt in parts]), formats.pop())
+        else:
+            # the chunks were typed differently (e.g. "1" and "1.5"): back to text and decide for the whole column
+            text = np.concatenate([format_column(values, fmt) for values, fmt in parts])
+            block.set_column(label, *infer_column(text))
+    if rows:
+        block.keep_original(b"".join(rows))
+
+
+def projection(name, labels, columns):
+    "Positions of the columns to read from a loop: all for data_optics or columns=None, otherwise those in columns"
+    if columns is None or name == "optics":
+        return list(range(len(labels)))
+    return [i for i, label in enumerate(labels) if label in columns]
+
+
+def _finish_projection(block, labels, chunks, rows, kept):
+    "_finish_block for the kept columns only, numbered in their order in the file"
+    block.labels = {labels[i]: n + 1 for n, i in enumerate(kept)}
+    _finish_block(block, [labels[i] for i in kept], [chunks[i] for i in kept], rows)
+
+
+def read_star(filename, workers=1, columns=None):
+    '''
+    Reads a star file (plain or gzip/xz/bz2-compressed) into a StarTable (all blocks, all columns).
+    Data rows are read in large blocks and tokenized with NumPy, so no Python objects are created per row or field.
+    workers > 1: large plain-text files are parsed by a pool of processes (util/star_parallel.py)
+    columns: names of the columns to read (e.g. {"_rlnImageName"}); the other fields of the loops are only
+             delimited, never gathered or converted, and are not in the table. data_optics is always read in full
+    '''
+    if workers > 1 and compression(filename) is None and os.path.getsize(filename) >= PARALLEL_MIN_BYTES:
+        from util.star_parallel import read_star_parallel
+        return read_star_parallel(filename, workers, columns)
+    table = StarTable(filename)
+    block = None
+    version = None
+    labels, chunks, rows, kept = [], [], [], []
+    with open_star(filename, "rb") as star_file:
+        for kind, value in star_sections(star_file):
+            if kind == "rows":
+                if block is None or not labels:
+                    continue
+                if not chunks:
+                    kept = projection(block.name, labels, columns)
+                    chunks = [[] for label in labels]
+                buffer, first_line = value
+                try:
+                    data, starts, ends = tokenize(buffer, len(labels), first_line)
+                except ValueError as e:
+                    raise ValueError("%s, data_%s, %s" % (filename, block.name, e))
+                for i in kept:
+                    chunks[i].append(parse_column(*field_matrix(data, starts[:, i], ends[:, i])))
+                if block.name == "optics":
+                    rows.append(buffer)
+            elif kind == "label":
+                # the position in the header defines the position in the rows
+                labels.append(value[0])
+                block.labels[value[0]] = len(labels)
+            elif kind == "pair":
+                label, text = value
+                if columns is None or label in columns:
+                    block.labels[label] = len(block.labels) + 1
+                    block.set_column(label, *infer_column(np.array([text.encode()], dtype="S")))
+            elif kind == "loop":
+                block.loop = True
+            elif kind == "data":
+                if block is not None and block.loop:
+                    _finish_loop(block, labels, chunks, rows, columns)
+                block = table.add_block(StarBlock(value, version, loop=False))
+                version = None
+                labels, chunks, rows, kept = [], [], [], []
+            elif kind == "version":
+                version = value
+    if block is not None and block.loop:
+        _finish_loop(block, labels, chunks, rows, columns)
+    return table
+
+
+def _finish_loop(block, labels, chunks, rows, columns):
+    if not chunks:
+        # a loop without rows
+        chunks = [[] for label in labels]
+    _finish_projection(block, labels, chunks, rows, projection(block.name, labels, columns))
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Written by Pavel Afanasyev
+# afanasyev.code@gmail.com
+# https://github.com/afanasyevp/cryoem_tools
+
+'''
+Streaming validation of star files: one pass over the file (plain or compressed), data rows checked in
+large vectorized blocks. Reported problems, with their line numbers:
+    - labels of a loop without "#N", column numbers repeated (#12 twice), missing or out of order
+    - repeated column names, data rows without labels, labels without values
+    - rows with a wrong number of fields (also a truncated last line), a last line without a line end
+    - values of numeric Relion columns (NUMERIC_COLUMNS, util/star_helper.py) which are not numbers
+
+    problems, summary = validate_star("particles.star", max_problems=20)
+'''
+
+import os
+import time
+
+import numpy as np
+
+from util.star_helper import NUMERIC_COLUMNS, open_star
+from util.star_table import READ_BYTES, star_sections
+
+ver=20261017
+
+
+class Problems:
+    "First max_problems problems (line, message) and the number of all problems found"
+    def __init__(self, max_problems=20):
+        self.max_problems = max_problems
+        self.found = []
+        self.count = 0
+
+    def add(self, line, message):
+        self.count += 1
+        if len(self.found) < self.max_problems:
+            self.found.append((line, message))
+
+    def add_many(self, lines, message):
+        "One problem per line (NumPy array of line numbers); message is formatted with the index of the line"
+        for i, line in enumerate(lines[:max(self.max_problems - len(self.found), 0)].tolist()):
+            self.found.append((line, message(i)))
+        self.count += len(lines)
+
+
+# weight of every byte in the sums over the numeric fields, 5 bits per class: "." 1, "e" 2^5, digit 2^10, sign 2^15,
+# any byte which cannot appear in a number 2^20 (longer fields are checked one by one, so the sums never carry over)
+MAX_NUMBER_BYTES = 31
+BYTE_WEIGHTS = np.full(256, 1 << 20, dtype=np.uint32)
+BYTE_WEIGHTS[:33] = 0
+BYTE_WEIGHTS[ord(".")] = 1
+BYTE_WEIGHTS[[ord("e"), ord("E")]] = 1 << 5
+BYTE_WEIGHTS[list(b"0123456789")] = 1 << 10
+BYTE_WEIGHTS[[ord("+"), ord("-")]] = 1 << 15
+DIGIT_BYTES = np.zeros(256, dtype=bool)
+DIGIT_BYTES[list(b"0123456789")] = True
+
+
+def field_counts(data):
+    "(start flags, starts, ends, fields per line) of a buffer of rows ending with a line end (uint8 array)"
+    space = data <= 32
+    start_flag = ~space
+    end_flag = start_flag.copy()
+    start_flag[1:] &= space[:-1]
+    end_flag[:-1] &= space[1:]
+    starts = np.flatnonzero(start_flag)
+    ends = np.flatnonzero(end_flag) + 1
+    newlines = np.flatnonzero(data == 10)
+    per_line = np.diff(np.concatenate(([0], np.searchsorted(starts, newlines))))
+    return start_flag, starts, ends, per_line
+
+
+def owners(positions, first, last):
+    "(field, position) of the byte positions lying inside the fields [first, last) (sorted, not overlapping)"
+    owner = np.searchsorted(first, positions, side="right") - 1
+    inside = (owner >= 0) & (positions < last[np.maximum(owner, 0)])
+    return owner[inside], positions[inside]
+
+
+def suspicious_numbers(data, start_flag, starts, ends, numeric):
+    '''
+    Positions (in starts) of the numeric fields which may not be numbers: a byte other than digits . + - e E,
+    more than one "." or "e", a sign which is neither first nor after "e", no digit, or a last byte other than
+    a digit or ".". The bytes of every field are summed with BYTE_WEIGHTS (one uint32 cumulative sum over the buffer;
+    differences of the wrapped sums are exact),
+    so a valid buffer costs a few passes over its bytes; the candidates are checked with float()
+    '''
+    fields = np.flatnonzero(numeric)
+    if not len(fields):
+        return fields
+    first, last = starts[fields], ends[fields]
+    total = np.cumsum(BYTE_WEIGHTS[data], dtype=np.uint32)
+    sums = total[last - 1] - np.where(first > 0, total[first - 1], 0).astype(np.uint32)
+    dots, exponents, digits = sums & 31, (sums >> 5) & 31, (sums >> 10) & 31
+    end = data[last - 1]
+    suspicious = (sums >= 1 << 20) | (dots > 1) | (exponents > 1) | (digits == 0) | \
+        (last - first > MAX_NUMBER_BYTES) | ~(DIGIT_BYTES[end] | (end == 46))
+    signs = ((sums >> 15) & 31).astype(np.int64)
+    # signs other than a leading one: each must follow an "e"
+    inner = signs - ((data[first] == 43) | (data[first] == 45))
+    check = ~suspicious & (inner > 0)
+    if check.any():
+        positions = np.flatnonzero((data == 43) | (data == 45))
+        previous = data[positions - 1]
+        owner, positions = owners(positions[~start_flag[positions] & (previous != 101) & (previous != 69)], first, last)
+        suspicious[owner] = True
+    # an "e" must follow a digit (or "digit.") and be followed by no "."
+    check = ~suspicious & (exponents > 0)
+    if check.any():
+        owner, positions = owners(np.flatnonzero((data == 101) | (data == 69)), first, last)
+        keep = check[owner]
+        owner, positions = owner[keep], positions[keep]
+        previous = data[positions - 1]
+        before = data[np.maximum(positions - 2, 0)]
+        mantissa = DIGIT_BYTES[previous] | ((previous == 46) & DIGIT_BYTES[before] & (positions - 2 >= first[owner]))
+        dot_after = ((total[last[owner] - 1] - total[positions]) & 31) > 0
+        suspicious[owner[~mantissa | dot_after]] = True
+    return fields[suspicious]
+
+
+def not_number(value):
+    "True if float() does not accept the text (bytes)"
+    try:
+        float(value)
+        return False
+    except ValueError:
+        return True
+
+
+def check_rows(buffer, first_line, labels, problems):
+    "Field counts and numeric columns of a buffer of data rows; returns the number of rows"
+    n_cols = len(labels)
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    start_flag, starts, ends, per_line = field_counts(data)
+    filled = per_line != 0
+    bad = np.flatnonzero(filled & (per_line != n_cols))
+    if bad.size:
+        counts = per_line[bad]
+        problems.add_many(bad + first_line, lambda i: "%d fields found, %d expected" % (counts[i], n_cols))
+    numeric_column = np.array([label in NUMERIC_COLUMNS for label in labels])
+    if numeric_column.any() and len(starts):
+        # column of every field; lines with a wrong number of fields are not checked further
+        line = np.repeat(np.arange(len(per_line)), per_line)
+        column = np.arange(len(starts)) - np.repeat(np.cumsum(per_line) - per_line, per_line)
+        numeric = (per_line == n_cols)[line] & numeric_column[np.minimum(column, n_cols - 1)]
+        candidates = suspicious_numbers(data, start_flag, starts, ends, numeric)
+        for i in candidates.tolist():
+            value = buffer[starts[i]:ends[i]]
+            if not_number(value):
+                problems.add(first_line + int(line[i]), "%s is not a number in %s (column #%d)"
+                             % (value.decode(errors="replace"), labels[column[i]], column[i] + 1))
+    return int(filled.sum())
+
+
+def validate_star(filename, max_problems=20, chunk_bytes=READ_BYTES):
+    '''
+    Checks a star file in one pass (see the module description).
+    Returns (problems, summary): problems is a Problems object (first max_problems problems with their line numbers
+    and the number of all problems), summary is {block name: number of data rows}
+    '''
+    problems = Problems(max_problems)
+    summary = {}
+    name = None
+    in_loop = False
+    labels = []
+    numbers = {}
+    with open_star(filename, "rb") as star_file:
+        for kind, value, line in star_sections(star_file, chunk_bytes, lines=True):
+            if kind == "data":
+                if value in summary:
+                    problems.add(line, "data_%s is repeated" % value)
+                name, in_loop, labels, numbers = value, False, [], {}
+                summary[name] = 0
+            elif kind == "loop":
+                if name is None:
+                    problems.add(line, "loop_ outside of a data_ block")
+                in_loop, labels, numbers = True, [], {}
+            elif kind == "label":
+                label, number = value
+                if not in_loop:
+                    problems.add(line, "%s #%d outside of a loop_" % (label, number))
+                if label in labels:
+                    problems.add(line, "%s is repeated" % label)
+                if number in numbers:
+                    problems.add(line, "column number #%d of %s is already used by %s" % (number, label, numbers[number]))
+                elif number != len(labels) + 1:
+                    problems.add(line, "column number #%d of %s, #%d expected" % (number, label, len(labels) + 1))
+                labels.append(label)
+                numbers.setdefault(number, label)
+            elif kind == "pair":
+                label, text = value
+                if in_loop:
+                    problems.add(line, "%s without column number in a loop_" % label)
+                    labels.append(label)
+                elif not text:
+                    problems.add(line, "%s has no value" % label)
+                elif label in NUMERIC_COLUMNS and not_number(text):
+                    problems.add(line, "%s is not a number in %s" % (text, label))
+            elif kind == "truncated":
+                problems.add(line, "the last line has no line end (truncated file?)")
+            elif kind == "rows":
+                buffer, first_line = value
+                if name is None or not labels:
+                    problems.add(first_line, "data rows without column labels")
+                    continue
+                summary[name] += check_rows(buffer, first_line, labels, problems)
+    return problems, summary
+
+
+def report(filename, problems, summary, seconds=None):
+    "Prints the result of validate_star; returns True for a valid file"
+    blocks = ", ".join("data_%s: %d rows" % item for item in summary.items())
+    speed = ""
+    if seconds:
+        speed = " (%.2f s, %.0f MB/s)" % (seconds, os.path.getsize(filename) / 1024 ** 2 / seconds)
+    if not problems.count:
+        print(" => %s is valid: %s%s" % (filename, blocks, speed))
+        return True
+    print(" => %s: %d problems found%s" % (filename, problems.count, speed))
+    for line, message in problems.found:
+        print("    line %d: %s" % (line, message))
+    if problems.count > len(problems.found):
+        print("    ... %d more" % (problems.count - len(problems.found)))
+    return False
+
+
+def validate_files(filenames, max_problems=20):
+    "Validates and reports every file; returns True if all are valid"
+    valid = True
+    for filename in filenames:
+        start_time = time.time()
+        problems, summary = validate_star(filename, max_problems)
+        valid &= report(filename, problems, summary, max(time.time() - start_time, 1e-6))
+    return valid